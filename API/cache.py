@@ -0,0 +1,220 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from db import lectura_primaria
+
+# Nombre màxim d'entrades i segons de vida de la memòria cau local de cada procés. Les
+# invalidacions només arriben a la local del worker que escriu: CACHE_TTL_LOCAL és el retard
+# màxim amb què la resta de workers veuen un canvi, com ETAG_TTL a etags.py
+CACHE_MIDA = int(os.getenv('CACHE_MIDA', '10000'))
+CACHE_TTL_LOCAL = float(os.getenv('CACHE_TTL_LOCAL', '1'))
+# Segons de vida de les entrades del backend compartit, que s'invaliden per clau
+CACHE_TTL = float(os.getenv('CACHE_TTL', '60'))
+# Backend compartit opcional entre workers, p. ex. redis://redis:6379/0
+CACHE_BACKEND = os.getenv('CACHE_BACKEND')
+
+
+class CacheLRU:
+    # Memòria cau local amb límit d'entrades (LRU) i caducitat per entrada
+    def __init__(self, mida, ttl):
+        self.mida = mida
+        self.ttl = ttl
+        self._dades = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.caducades = 0
+
+    def get(self, clau):
+        with self._lock:
+            entrada = self._dades.get(clau)
+            if entrada is None:
+                self.misses += 1
+                return False, None
+            valor, caduca = entrada
+            if caduca < time.monotonic():
+                del self._dades[clau]
+                self.caducades += 1
+                self.misses += 1
+                return False, None
+            self._dades.move_to_end(clau)
+            self.hits += 1
+            return True, valor
+
+    def set(self, clau, valor):
+        with self._lock:
+            self._dades[clau] = (valor, time.monotonic() + self.ttl)
+            self._dades.move_to_end(clau)
+            while len(self._dades) > self.mida:
+                self._dades.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, clau):
+        with self._lock:
+            self._dades.pop(clau, None)
+
+    def estadistiques(self):
+        with self._lock:
+            return {
+                'entrades': len(self._dades),
+                'mida': self.mida,
+                'ttl_s': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'caducades': self.caducades,
+            }
+
+
+class BackendMemoria:
+    # Substitut local del backend compartit; té la mateixa interfície que BackendRedis
+    def __init__(self):
+        self._dades = {}
+        self._generacions = {}
+
+    async def get(self, clau):
+        entrada = self._dades.get(clau)
+        if entrada is None or entrada[1] < time.monotonic():
+            return None
+        return json.loads(entrada[0])
+
+    async def set(self, clau, valor, ttl):
+        self._dades[clau] = (json.dumps(valor, default=str), time.monotonic() + ttl)
+
+    async def generacio(self, clau):
+        entrada = self._generacions.get(clau)
+        return 0 if entrada is None or entrada[1] < time.monotonic() else entrada[0]
+
+    async def avancar(self, claus, ttl):
+        for clau in claus:
+            self._generacions[clau] = (await self.generacio(clau) + 1, time.monotonic() + ttl)
+
+
+class BackendRedis:
+    def __init__(self, url, espai='popview:'):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self._espai = espai
+
+    async def get(self, clau):
+        valor = await self._redis.get(self._espai + clau)
+        return None if valor is None else json.loads(valor)
+
+    async def set(self, clau, valor, ttl):
+        await self._redis.set(self._espai + clau, json.dumps(valor, default=str), ex=max(int(ttl), 1))
+
+    async def generacio(self, clau):
+        valor = await self._redis.get(self._espai + 'generacio:' + clau)
+        return 0 if valor is None else int(valor)
+
+    async def avancar(self, claus, ttl):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for clau in claus:
+                pipe.incr(self._espai + 'generacio:' + clau)
+                pipe.expire(self._espai + 'generacio:' + clau, max(int(ttl), 1))
+            await pipe.execute()
+
+
+def crear_backend(url):
+    if not url:
+        return None
+    if url == 'memoria':
+        return BackendMemoria()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return BackendRedis(url)
+    raise ValueError(f"CACHE_BACKEND no suportat: {url}")
+
+
+class Cache:
+    # Lectura a través de la memòria cau: local, després compartida i finalment la base de dades
+    def __init__(self, local, compartit=None, ttl=CACHE_TTL):
+        self.local = local
+        self.compartit = compartit
+        self.ttl = ttl
+        self.hits_compartit = 0
+        self.misses_compartit = 0
+        # S'incrementa a cada invalidació; una càrrega que s'hi creua no desa el resultat
+        self._generacio = 0
+
+    async def obtenir(self, clau, carregar):
+        trobat, valor = self.local.get(clau)
+        if trobat:
+            return valor
+        generacio = self._generacio
+        if self.compartit is not None:
+            # Al backend la clau porta la generació: una càrrega que es creua amb una invalidació
+            # d'un altre worker desa el valor vell sota la generació anterior, que ja no es llegeix
+            clau_compartida = f"{clau}#{await self.compartit.generacio(clau)}"
+            valor = await self.compartit.get(clau_compartida)
+            if valor is not None:
+                self.hits_compartit += 1
+                self.local.set(clau, valor)
+                return valor
+            self.misses_compartit += 1
+        # Sempre de la primària: el valor viu més que la petició
+        with lectura_primaria():
+            valor = await carregar()
+        # Els "no trobat" no es desen perquè una creació posterior no quedi amagada
+        if valor is not None:
+            if generacio == self._generacio:
+                self.local.set(clau, valor)
+            if self.compartit is not None:
+                await self.compartit.set(clau_compartida, valor, self.ttl)
+        return valor
+
+    async def invalidar(self, *claus):
+        self._generacio += 1
+        for clau in claus:
+            self.local.delete(clau)
+        if self.compartit is not None and claus:
+            # La generació ha de durar més que qualsevol entrada desada sota l'anterior
+            await self.compartit.avancar(claus, 2 * self.ttl)
+
+    def estadistiques(self):
+        estadistiques = {'local': self.local.estadistiques()}
+        if self.compartit is not None:
+            estadistiques['compartit'] = {
+                'backend': type(self.compartit).__name__,
+                'hits': self.hits_compartit,
+                'misses': self.misses_compartit,
+            }
+        return estadistiques
+
+
+cache = Cache(CacheLRU(CACHE_MIDA, CACHE_TTL_LOCAL), crear_backend(CACHE_BACKEND))
+
+
+# Claus de les entrades per fila: titol, llista, usuari i llista_titols (els títols d'una llista)
+def clau_cache(tipus, identificador):
+    return f"{tipus}:{identificador}"
+
+
+def invalidar(db, tipus, identificadors):
+    # Dins una transaccio(): les entrades surten de la memòria cau quan el commit ha anat bé
+    claus = [clau_cache(tipus, identificador) for identificador in set(identificadors)]
+    if claus:
+        db.despres_commit(lambda: cache.invalidar(*claus))
+
+
+SQL_LLISTES_DELS_TITOLS = "SELECT DISTINCT llista_id FROM llista_titol WHERE titol_id IN ({})"
+
+
+async def claus_titols(db, titol_ids):
+    # Entrades on surt un títol: la seva fitxa i els títols de cada llista que el conté
+    titol_ids = sorted(set(titol_ids))
+    if not titol_ids:
+        return []
+    files = await db.fetchall(SQL_LLISTES_DELS_TITOLS.format(', '.join(['%s'] * len(titol_ids))), tuple(titol_ids))
+    return ([clau_cache("titol", titol_id) for titol_id in titol_ids]
+            + [clau_cache("llista_titols", fila["llista_id"]) for fila in files])
+
+
+async def invalidar_titols(db, titol_ids):
+    # Com invalidar(); la consulta de les llistes va abans de l'escriptura (un DELETE en cascada les treu)
+    claus = await claus_titols(db, titol_ids)
+    if claus:
+        db.despres_commit(lambda: cache.invalidar(*claus))
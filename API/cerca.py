@@ -0,0 +1,44 @@
+import re
+
+from valoracions import COLUMNES_TITOL, JOIN_VALORACIO
+
+# Índexs FULLTEXT de la migració 5. El del nom sol serveix per puntuar més les coincidències al nom
+COLUMNES_CERCA = "t.nom, t.descripcio, t.genero, t.plataformes"
+PES_NOM = 3
+
+# Tot el que no és lletra o xifra separa termes; així els operadors del mode BOOLEAN
+# (+ - < > ( ) ~ * " @) que escrigui l'usuari no arriben mai a MATCH
+SEPARADORS = re.compile(r"[^\w]+")
+MAX_TERMES = 10
+
+PUNTUACIO = f"(MATCH(t.nom) AGAINST (%s IN BOOLEAN MODE) * {PES_NOM} + MATCH({COLUMNES_CERCA}) AGAINST (%s IN BOOLEAN MODE))"
+
+
+def consulta_booleana(q):
+    # Cada terme és obligatori i es busca com a prefix, de manera que "star wa" ja troba
+    # "Star Wars" mentre s'escriu. Amb el comodí InnoDB no descarta els termes curts
+    termes = [terme for terme in SEPARADORS.split(q.lower()) if terme][:MAX_TERMES]
+    return " ".join(f"+{terme}*" for terme in termes)
+
+
+def consulta_cerca(q, filtres, after, limit):
+    # filtres: [(condició, valor)] ja validats per la ruta; after: (puntuacio, id) o None
+    booleana = consulta_booleana(q)
+    condicions = [f"MATCH({COLUMNES_CERCA}) AGAINST (%s IN BOOLEAN MODE)"]
+    params = [booleana]
+    for condicio, valor in filtres:
+        condicions.append(condicio)
+        params.append(valor)
+    if after is not None:
+        puntuacio, after_id = after
+        condicions.append(f"({PUNTUACIO} < %s OR ({PUNTUACIO} = %s AND t.id > %s))")
+        params += [booleana, booleana, puntuacio, booleana, booleana, puntuacio, after_id]
+    sql = f"""
+        SELECT {COLUMNES_TITOL}, {PUNTUACIO} AS _puntuacio
+        FROM titol t
+        {JOIN_VALORACIO}
+        WHERE {' AND '.join(condicions)}
+        ORDER BY _puntuacio DESC, t.id
+        LIMIT %s
+    """
+    return sql, tuple([booleana, booleana] + params + [limit])
@@ -0,0 +1,56 @@
+import datetime
+
+# Columnes de comentari a usuari_titol: creat és quan es va crear la fila (primera valoració
+# o comentari) i comentat quan es va escriure el comentari actual; és NULL si no n'hi ha
+SQL_COLUMNES = """
+    ALTER TABLE usuari_titol
+        ADD COLUMN IF NOT EXISTS creat DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+        ADD COLUMN IF NOT EXISTS comentat DATETIME(6) NULL
+"""
+# Els comentaris anteriors a la columna no tenen data: prenen la de la migració
+SQL_OMPLIR_COMENTAT = "UPDATE usuari_titol SET comentat = creat WHERE comentaris IS NOT NULL AND comentat IS NULL"
+# Un índex per ordre del feed; es recorren cap enrere per a l'ordre descendent
+SQL_INDEXS = [
+    "CREATE INDEX IF NOT EXISTS idx_usuari_titol_recents ON usuari_titol (titol_id, comentat, usuari_id)",
+    "CREATE INDEX IF NOT EXISTS idx_usuari_titol_valoracio ON usuari_titol (titol_id, rating, usuari_id)",
+]
+
+# Autor unit a la mateixa consulta: nom i imatge de l'usuari de cada comentari
+SQL_FEED = """
+    SELECT ut.usuari_id, u.nom AS usuari_nom, u.imatge AS usuari_imatge,
+           ut.comentaris, ut.rating, ut.comentat
+    FROM usuari_titol ut
+    JOIN usuari u ON u.id = ut.usuari_id
+    WHERE ut.titol_id = %s AND ut.comentat IS NOT NULL
+"""
+
+# ordre: (columna de la clau, condició extra)
+ORDRES = {
+    "recents": ("ut.comentat", ""),
+    "valoracio": ("ut.rating", " AND ut.rating IS NOT NULL"),
+}
+
+EPOCA = datetime.datetime(1970, 1, 1)
+MICROSEGON = datetime.timedelta(microseconds=1)
+
+
+def consulta_feed(titol_id, ordre, despres, limit):
+    # Keyset descendent per (clau, usuari_id). despres: valors del cursor o None
+    columna, condicio = ORDRES[ordre]
+    consulta = SQL_FEED + condicio
+    params = (titol_id,)
+    if despres is not None:
+        valor, usuari_id = despres
+        if ordre == "recents":
+            valor = EPOCA + int(valor) * MICROSEGON
+        consulta += f" AND ({columna} < %s OR ({columna} = %s AND ut.usuari_id < %s))"
+        params += (valor, valor, usuari_id)
+    consulta += f" ORDER BY {columna} DESC, ut.usuari_id DESC LIMIT %s"
+    return consulta, params + (limit,)
+
+
+def clau_cursor(ordre):
+    # El cursor només porta números: la data va en microsegons des de 1970
+    if ordre == "recents":
+        return lambda fila: [(fila["comentat"] - EPOCA) // MICROSEGON, fila["usuari_id"]]
+    return lambda fila: [fila["rating"], fila["usuari_id"]]
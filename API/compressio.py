@@ -0,0 +1,250 @@
+import asyncio
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+import anyio
+from fastapi.responses import Response
+from starlette.datastructures import Headers, MutableHeaders
+
+from etags import etag_codificat
+from metriques import Comptador, registre
+
+try:
+    import brotli
+except ImportError:  # Sense brotli només es negocien zstd i gzip
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Bytes a partir dels quals es comprimeix una resposta; per sota, les capçaleres ja costen més
+COMPRESSIO_MINIMA = int(os.getenv('COMPRESSIO_MINIMA', '1024'))
+# Nivells per a la compressió de cada resposta: ràpids, perquè es paguen a cada petició
+NIVELLS = {"zstd": 3, "br": 4, "gzip": 6}
+# Les instantànies es comprimeixen un cop per versió de les taules: una mica més de CPU que a
+# cada resposta, però sense els nivells màxims (zstd 19, br 11), que triguen centenars de ms
+# en una pàgina gran
+NIVELLS_INSTANTANIA = {"zstd": 9, "br": 7, "gzip": 9}
+# Nombre màxim d'instantànies (una per URL i versió) que es guarden a cada procés
+INSTANTANIES_MIDA = int(os.getenv('INSTANTANIES_MIDA', '64'))
+
+TIPUS_COMPRIMIBLES = ("application/json", "application/x-ndjson", "text/")
+
+# Preferència del servidor quan el client n'accepta diverses amb la mateixa q
+CODIFICACIONS = [nom for nom, disponible in (("zstd", zstandard), ("br", brotli), ("gzip", zlib)) if disponible]
+
+bytes_compressio = registre.afegir(Comptador(
+    "popview_compressio_bytes_total", "Bytes abans i després de comprimir les respostes", ("codificacio", "fase")))
+instantanies_servides = registre.afegir(Comptador(
+    "popview_instantanies_total", "Respostes servides des d'una instantània precomprimida", ("resultat",)))
+
+
+def triar_codificacio(accept_encoding):
+    # Accept-Encoding: "gzip, br;q=0.8, *;q=0" -> la de q més alta que tinguem; None = sense comprimir
+    if not accept_encoding:
+        return None
+    acceptades = {}
+    for element in accept_encoding.split(","):
+        nom, _, parametres = element.strip().partition(";")
+        q = 1.0
+        parametre, _, valor = parametres.strip().partition("=")
+        if parametre.strip() == "q":
+            try:
+                q = float(valor)
+            except ValueError:
+                q = 0.0
+        acceptades[nom.strip().lower()] = q
+    candidates = [(acceptades.get(nom, acceptades.get("*", 0.0)), -index, nom)
+                  for index, nom in enumerate(CODIFICACIONS)]
+    q, _, nom = max(candidates)
+    return nom if q > 0 else None
+
+
+class Compressor:
+    # Compressió per trossos: cada tros es buida sencer perquè el client el pugui llegir
+    # de seguida (NDJSON en streaming)
+    def __init__(self, codificacio, nivell=None):
+        nivell = NIVELLS[codificacio] if nivell is None else nivell
+        self.codificacio = codificacio
+        if codificacio == "gzip":
+            self._objecte = zlib.compressobj(nivell, zlib.DEFLATED, 31)
+        elif codificacio == "br":
+            self._objecte = brotli.Compressor(quality=nivell)
+        else:
+            self._objecte = zstandard.ZstdCompressor(level=nivell).compressobj()
+
+    def comprimir(self, dades):
+        if self.codificacio == "gzip":
+            return self._objecte.compress(dades) + self._objecte.flush(zlib.Z_SYNC_FLUSH)
+        if self.codificacio == "br":
+            return self._objecte.process(dades) + self._objecte.flush()
+        return self._objecte.compress(dades) + self._objecte.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def acabar(self):
+        if self.codificacio == "br":
+            return self._objecte.finish()
+        return self._objecte.flush()
+
+
+def comprimir(dades, codificacio, nivell=None):
+    if codificacio == "gzip":
+        return zlib.compress(dades, NIVELLS["gzip"] if nivell is None else nivell, wbits=31)
+    if codificacio == "br":
+        return brotli.compress(dades, quality=NIVELLS["br"] if nivell is None else nivell)
+    return zstandard.ZstdCompressor(level=NIVELLS["zstd"] if nivell is None else nivell).compress(dades)
+
+
+def comprimible(capcaleres):
+    tipus = capcaleres.get("content-type", "")
+    return "content-encoding" not in capcaleres and tipus.startswith(TIPUS_COMPRIMIBLES)
+
+
+def variar_per_codificacio(capcaleres):
+    # add_vary_header() l'afegiria dues vegades a les respostes que ja en porten (condicional())
+    if "accept-encoding" not in capcaleres.get("vary", "").lower():
+        capcaleres.add_vary_header("Accept-Encoding")
+
+
+def capcaleres_codificades(capcaleres, codificacio):
+    # Cada codificació és una representació diferent: porta el seu propi ETag
+    capcaleres["Content-Encoding"] = codificacio
+    variar_per_codificacio(capcaleres)
+    if "etag" in capcaleres:
+        capcaleres["ETag"] = etag_codificat(capcaleres["etag"], codificacio)
+
+
+class MiddlewareCompressio:
+    # Middleware ASGI: comprimeix segons Accept-Encoding les respostes de tipus text a partir
+    # de COMPRESSIO_MINIMA bytes, o en streaming si la resposta arriba en diversos trossos
+    def __init__(self, app, minima=COMPRESSIO_MINIMA):
+        self.app = app
+        self.minima = minima
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        codificacio = triar_codificacio(Headers(scope=scope).get("accept-encoding"))
+        if codificacio is None:
+            await self.app(scope, receive, send)
+            return
+        inici = None
+        compressor = None
+
+        async def enviar(missatge):
+            nonlocal inici, compressor
+            if missatge["type"] == "http.response.start":
+                if missatge["status"] in (204, 304) or not comprimible(Headers(raw=missatge["headers"])):
+                    await send(missatge)
+                else:
+                    inici = missatge  # s'espera al primer tros del cos per decidir
+                return
+            if missatge["type"] != "http.response.body" or inici is None:
+                await send(missatge)
+                return
+            cos = missatge.get("body", b"")
+            mes = missatge.get("more_body", False)
+            if compressor is None:
+                capcaleres = MutableHeaders(raw=list(inici["headers"]))
+                if not mes and len(cos) < self.minima:
+                    variar_per_codificacio(capcaleres)
+                    await send(dict(inici, headers=capcaleres.raw))
+                    await send(missatge)
+                    inici = None
+                    return
+                capcaleres_codificades(capcaleres, codificacio)
+                del capcaleres["content-length"]
+                if not mes:
+                    comprimit = comprimir(cos, codificacio)
+                    capcaleres["Content-Length"] = str(len(comprimit))
+                    bytes_compressio.inc(codificacio, "original", valor=len(cos))
+                    bytes_compressio.inc(codificacio, "comprimit", valor=len(comprimit))
+                    await send(dict(inici, headers=capcaleres.raw))
+                    await send({"type": "http.response.body", "body": comprimit})
+                    return
+                compressor = Compressor(codificacio)
+                await send(dict(inici, headers=capcaleres.raw))
+            comprimit = compressor.comprimir(cos) if mes else compressor.comprimir(cos) + compressor.acabar()
+            bytes_compressio.inc(codificacio, "original", valor=len(cos))
+            bytes_compressio.inc(codificacio, "comprimit", valor=len(comprimit))
+            await send({"type": "http.response.body", "body": comprimit, "more_body": mes})
+
+        await self.app(scope, receive, enviar)
+
+
+class Instantania:
+    # Cos JSON d'una resposta i les seves versions comprimides, fetes la primera vegada que
+    # algú les demana. No caduca: la clau és l'ETag, que canvia amb les taules.
+    # Només per a lectures les taules de les quals canvien poc
+    def __init__(self, cos, capcaleres, tipus):
+        self.cos = cos
+        self.capcaleres = {clau: valor for clau, valor in capcaleres.items() if clau != "content-length"}
+        self.tipus = tipus
+        self._comprimides = {}  # codificació -> tasca de compressió
+
+    async def comprimida(self, codificacio):
+        # Es comprimeix en un fil, fora del bucle d'esdeveniments; peticions simultànies
+        # esperen la mateixa tasca
+        tasca = self._comprimides.get(codificacio)
+        if tasca is None:
+            tasca = asyncio.ensure_future(anyio.to_thread.run_sync(
+                comprimir, self.cos, codificacio, NIVELLS_INSTANTANIA[codificacio]))
+            self._comprimides[codificacio] = tasca
+
+            def oblidar_si_falla(acabada):
+                # Una compressió fallida es torna a intentar a la propera petició
+                if acabada.cancelled() or acabada.exception() is not None:
+                    self._comprimides.pop(codificacio, None)
+            tasca.add_done_callback(oblidar_si_falla)
+        return await asyncio.shield(tasca)
+
+    async def resposta(self, codificacio):
+        if codificacio is None or len(self.cos) < COMPRESSIO_MINIMA:
+            return Response(self.cos, headers=self.capcaleres, media_type=self.tipus)
+        capcaleres = MutableHeaders(self.capcaleres)
+        capcaleres_codificades(capcaleres, codificacio)
+        return Response(await self.comprimida(codificacio), headers=capcaleres, media_type=self.tipus)
+
+
+class Instantanies:
+    def __init__(self, mida):
+        self.mida = mida
+        self._dades = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, etag):
+        with self._lock:
+            instantania = self._dades.get(etag)
+            if instantania is not None:
+                self._dades.move_to_end(etag)
+            return instantania
+
+    def set(self, etag, instantania):
+        with self._lock:
+            self._dades[etag] = instantania
+            self._dades.move_to_end(etag)
+            while len(self._dades) > self.mida:
+                self._dades.popitem(last=False)
+
+
+instantanies = Instantanies(INSTANTANIES_MIDA)
+
+
+async def resposta_instantania(request, response, generar):
+    # Per a les lectures grans i repetides: generar() torna la Response JSON i només es crida
+    # quan no hi ha instantània per a l'ETag actual (que ja ha deixat condicional())
+    etag = response.headers.get("etag")
+    instantania = instantanies.get(etag) if etag else None
+    if instantania is None:
+        resposta = await generar()
+        if etag is None or resposta.status_code != 200:
+            return resposta
+        instantania = Instantania(resposta.body, resposta.headers, resposta.media_type)
+        instantanies.set(etag, instantania)
+        instantanies_servides.inc("generada")
+    else:
+        instantanies_servides.inc("reaprofitada")
+    return await instantania.resposta(triar_codificacio(request.headers.get("accept-encoding")))
@@ -0,0 +1,158 @@
+import asyncio
+import functools
+import hmac
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import anyio
+
+from metriques import BUCKETS_LATENCIA, Comptador, Histograma, registre
+
+try:
+    import argon2
+except ImportError:  # Només cal per crear usuaris, canviar contrasenyes i iniciar sessió
+    argon2 = None
+
+# Cost d'argon2id: passades, memòria (KiB) i fils per hash. Canviar-los no invalida res: els
+# hashes antics es continuen verificant i es tornen a fer amb els valors nous en iniciar sessió
+CONTRASENYA_TEMPS = int(os.getenv('CONTRASENYA_TEMPS', '3'))
+CONTRASENYA_MEMORIA = int(os.getenv('CONTRASENYA_MEMORIA', '65536'))
+CONTRASENYA_PARALLELISME = int(os.getenv('CONTRASENYA_PARALLELISME', '1'))
+PARAMETRES = (CONTRASENYA_TEMPS, CONTRASENYA_MEMORIA, CONTRASENYA_PARALLELISME)
+
+# Processos dedicats als hashes, per worker: la CPU d'un pic d'altes no treu fils ni bucle
+# d'esdeveniments a les rutes. Sota gunicorn el fixa gunicorn.conf.py repartint el pressupost de
+# la màquina (CREDENCIALS_PROCESSOS_MAQUINA) entre els workers. 0 els fa als fils d'AnyIO
+# (només per comparar al benchmark)
+CREDENCIALS_PROCESSOS = int(os.getenv('CREDENCIALS_PROCESSOS', '2'))
+# Operacions que poden esperar un procés lliure; a partir d'aquí es respon 503
+CREDENCIALS_CUA = int(os.getenv('CREDENCIALS_CUA', '64'))
+
+PREFIX_HASH = "$argon2"
+MIDA_LOT_MIGRACIO = 500
+
+operacions = registre.afegir(Comptador(
+    "popview_credencials_total", "Operacions de contrasenya", ("operacio", "resultat")))
+durada_operacions = registre.afegir(Histograma(
+    "popview_credencials_durada_segons", "Durada de les operacions de contrasenya, amb l'espera a la cua",
+    BUCKETS_LATENCIA, ("operacio",)))
+
+
+class CredencialsSaturades(Exception):
+    pass
+
+
+@functools.lru_cache(maxsize=4)
+def _hasher(parametres):
+    temps, memoria, parallelisme = parametres
+    return argon2.PasswordHasher(time_cost=temps, memory_cost=memoria, parallelism=parallelisme)
+
+
+# Les funcions *_sync s'executen als processos del pool (o a la migració)
+def xifrar_sync(contrasenya, parametres=PARAMETRES):
+    return _hasher(parametres).hash(contrasenya)
+
+
+def verificar_sync(hash_desat, contrasenya, parametres=PARAMETRES):
+    # (vàlida, hash nou o None). El hash nou hi és quan cal tornar-lo a fer amb els paràmetres
+    # actuals o quan la contrasenya encara estava desada en clar (usuaris d'abans de la migració 9)
+    hasher = _hasher(parametres)
+    if hash_desat is None:
+        # Usuari inexistent: el mateix cost que una verificació, perquè el temps no ho delati
+        hasher.hash(contrasenya)
+        return False, None
+    if not hash_desat.startswith(PREFIX_HASH):
+        valida = hmac.compare_digest(hash_desat.encode(), contrasenya.encode())
+        return valida, hasher.hash(contrasenya) if valida else None
+    try:
+        hasher.verify(hash_desat, contrasenya)
+    except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHashError):
+        return False, None
+    return True, hasher.hash(contrasenya) if hasher.check_needs_rehash(hash_desat) else None
+
+
+_executor = None
+_en_curs = 0
+
+
+def _obtenir_executor():
+    global _executor
+    if _executor is None:
+        # forkserver: el procés de l'API té fils i un bucle d'esdeveniments que fork copiaria
+        _executor = ProcessPoolExecutor(CREDENCIALS_PROCESSOS, mp_context=multiprocessing.get_context("forkserver"))
+    return _executor
+
+
+async def _executar(operacio, funcio, *args):
+    global _en_curs
+    if argon2 is None:
+        raise RuntimeError("Les contrasenyes necessiten el paquet argon2-cffi")
+    if _en_curs >= max(CREDENCIALS_PROCESSOS, 1) + CREDENCIALS_CUA:
+        operacions.inc(operacio, "rebutjada")
+        raise CredencialsSaturades("Massa operacions de contrasenya en curs")
+    _en_curs += 1
+    inici = time.perf_counter()
+    try:
+        if CREDENCIALS_PROCESSOS == 0:
+            return await anyio.to_thread.run_sync(funcio, *args)
+        return await asyncio.get_running_loop().run_in_executor(_obtenir_executor(), funcio, *args)
+    finally:
+        _en_curs -= 1
+        durada_operacions.observar(time.perf_counter() - inici, operacio)
+
+
+async def xifrar(contrasenya):
+    resultat = await _executar("xifrar", xifrar_sync, contrasenya, PARAMETRES)
+    operacions.inc("xifrar", "ok")
+    return resultat
+
+
+async def verificar(hash_desat, contrasenya):
+    valida, nou_hash = await _executar("verificar", verificar_sync, hash_desat, contrasenya, PARAMETRES)
+    operacions.inc("verificar", "valida" if valida else "invalida")
+    if nou_hash is not None:
+        operacions.inc("verificar", "rehash")
+    return valida, nou_hash
+
+
+async def escalfar():
+    # Arrenca els processos i els hi deixa argon2 importat abans de la primera alta
+    if argon2 is None or CREDENCIALS_PROCESSOS == 0:
+        return
+    await asyncio.gather(*(_executar("escalfament", xifrar_sync, "escalfament", PARAMETRES)
+                           for _ in range(CREDENCIALS_PROCESSOS)))
+
+
+def tancar():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def estadistiques():
+    return {"en_curs": _en_curs, "processos": CREDENCIALS_PROCESSOS, "cua": CREDENCIALS_CUA}
+
+
+registre.afegir_indicadors("popview_credencials", "Estat del pool de credencials", estadistiques)
+
+
+def xifrar_existents_sync(cursor):
+    # Pas de migració: xifra les contrasenyes desades en clar, per lots d'id i amb tots els nuclis
+    darrer = 0
+    with ProcessPoolExecutor(os.cpu_count()) as executor:
+        while True:
+            cursor.execute("""
+                SELECT id, contrasenya FROM usuari
+                WHERE id > %s AND LEFT(contrasenya, 7) <> %s
+                ORDER BY id LIMIT %s
+            """, (darrer, PREFIX_HASH, MIDA_LOT_MIGRACIO))
+            files = cursor.fetchall()
+            if not files:
+                return
+            darrer = files[-1][0]
+            hashes = executor.map(xifrar_sync, [contrasenya for _, contrasenya in files], chunksize=16)
+            cursor.executemany("UPDATE usuari SET contrasenya = %s WHERE id = %s",
+                               [(hash_nou, usuari_id) for hash_nou, (usuari_id, _) in zip(hashes, files)])
@@ -1,22 +1,881 @@
+import asyncio
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque, namedtuple
+from contextlib import asynccontextmanager, contextmanager
+
+import anyio
 import mysql.connector
-from mysql.connector import pooling
+from mysql.connector import errors
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import cookie_parser
+
+from metriques import Comptador, mesurar_consulta, registre
+
+try:
+    import aiomysql
+    import pymysql
+except ImportError:  # Només cal per al mode async
+    aiomysql = None
+    pymysql = None
 
 # Configura la connexió a MariaDB
 db_config = {
-    'host': 'mariadb',
-    'user': 'popview',
-    'password': 'pirineus',
-    'database': 'pop_view',
+    'host': os.getenv('DB_HOST', 'mariadb'),
+    'port': int(os.getenv('DB_PORT', '3306')),
+    'user': os.getenv('DB_USER', 'popview'),
+    'password': os.getenv('DB_PASSWORD', 'pirineus'),
+    'database': os.getenv('DB_NAME', 'pop_view'),
     'collation': 'utf8mb4_general_ci'
 }
 
-# Pool de connexions
-db_pool = pooling.MySQLConnectionPool(pool_name="mypool", pool_size=5, **db_config)
+# "async" fa servir aiomysql des del bucle d'esdeveniments; "sync" torna al pool de
+# mysql.connector, executat en fils perquè les rutes async no bloquegin el bucle
+DB_MODE = os.getenv('DB_MODE', 'async')
+
+# Mida del pool per procés. Amb N workers el total de connexions pot arribar a
+# N * (DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW), que ha de quedar per sota de max_connections;
+# gunicorn.conf.py les calcula a partir del nombre de workers
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+# Connexions extra que s'obren en moments de càrrega i es tanquen en tornar al pool
+DB_POOL_MAX_OVERFLOW = int(os.getenv('DB_POOL_MAX_OVERFLOW', '5'))
+# Segons que una petició pot esperar una connexió abans de donar error
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+# Les connexions més velles que això (segons) es tanquen i se n'obre una de nova
+DB_POOL_RECYCLE = float(os.getenv('DB_POOL_RECYCLE', '1800'))
+# Les connexions inactives més d'aquests segons es comproven amb un ping abans de donar-les
+DB_POOL_PING_INACTIVA = float(os.getenv('DB_POOL_PING_INACTIVA', '10'))
+
+# Sentències preparades al servidor (només DB_MODE=sync: aiomysql no en té). Cada connexió en
+# guarda fins a DB_PREPARADES_MIDA; el total de workers * connexions * mida ha de quedar per
+# sota de max_prepared_stmt_count de MariaDB
+DB_PREPARADES = os.getenv('DB_PREPARADES', '1') == '1'
+DB_PREPARADES_MIDA = int(os.getenv('DB_PREPARADES_MIDA', '64'))
+
+# Rèpliques de lectura, "host[:port]" separats per comes, amb el mateix usuari i base de dades
+# que la primària. Les peticions GET hi llegeixen (MiddlewareLectures); la resta va a la primària.
+# L'usuari necessita el privilegi SLAVE MONITOR a les rèpliques per llegir-ne el retard
+DB_REPLIQUES = [valor.strip() for valor in os.getenv('DB_REPLIQUES', '').split(',') if valor.strip()]
+DB_REPLICA_POOL_SIZE = int(os.getenv('DB_REPLICA_POOL_SIZE', DB_POOL_SIZE))
+DB_REPLICA_POOL_MAX_OVERFLOW = int(os.getenv('DB_REPLICA_POOL_MAX_OVERFLOW', DB_POOL_MAX_OVERFLOW))
+# Segons entre comprovacions de cada rèplica (connexió i Seconds_Behind_Master)
+DB_REPLICA_COMPROVACIO = float(os.getenv('DB_REPLICA_COMPROVACIO', '2'))
+# Una rèplica amb més retard que això (segons) deixa de rebre lectures; torna quan baixa a la meitat
+DB_REPLICA_RETARD_MAXIM = float(os.getenv('DB_REPLICA_RETARD_MAXIM', '5'))
+# Segons que un client llegeix de la primària després d'escriure, per veure els seus canvis.
+# Ha de cobrir el retard màxim acceptat de les rèpliques
+DB_ENGANXAT = float(os.getenv('DB_ENGANXAT', DB_REPLICA_RETARD_MAXIM + DB_REPLICA_COMPROVACIO))
+COOKIE_PRIMARIA = "popview_primaria"
+
+# Errors de base de dades dels dos controladors
+if pymysql is not None:
+    ERRORS_BD = (mysql.connector.Error, pymysql.err.MySQLError)
+else:
+    ERRORS_BD = (mysql.connector.Error,)
+
+Resultat = namedtuple('Resultat', ['rowcount', 'lastrowid'])
+
+# Errors de restricció que les rutes tradueixen a respostes del client en lloc de comprovar
+# abans amb un SELECT: clau duplicada i clau forana sense fila pare
+ERROR_DUPLICAT = 1062
+ERROR_FK = 1452
+
+
+def codi_error(err):
+    # mysql.connector el porta a errno; pymysql, com a primer argument
+    if getattr(err, 'errno', None):
+        return err.errno
+    return err.args[0] if err.args and isinstance(err.args[0], int) else None
+
+
+def taula_referenciada(err):
+    # Taula pare d'una violació de clau forana, segons el missatge del servidor
+    trobat = re.search(r"REFERENCES `(\w+)`", str(err))
+    return trobat.group(1) if trobat else None
+
+sentencies_preparades = registre.afegir(Comptador(
+    "popview_sentencies_preparades_total", "Execucions de sentències preparades", ("resultat",)))
+lectures = registre.afegir(Comptador(
+    "popview_lectures_total", "Peticions de lectura segons on s'han llegit", ("desti",)))
+
+log = logging.getLogger("popview.bd")
+
+# Consultes de text fix que es preparen al servidor; s'hi afegeixen amb preparada()
+SENTENCIES_PREPARADES = set()
+
+
+def preparada(query):
+    # Marca una consulta fixa (sense parts que canviïn entre crides) per preparar-la
+    SENTENCIES_PREPARADES.add(query)
+    return query
+
+
+def sql_actualitzacio(taula, columnes, on):
+    # UPDATE parcial amb una sola forma: les columnes amb paràmetre NULL es queden com estan
+    assignacions = ", ".join(f"{columna} = COALESCE(%s, {columna})" for columna in columnes)
+    return preparada(f"UPDATE {taula} SET {assignacions} WHERE {on}")
+
+
+class PoolExhaurit(errors.PoolError):
+    pass
+
+
+class EstadistiquesPool:
+    # Comptadors compartits pels dos pools; es consulten a /estat/pool
+    def __init__(self, mida, max_overflow):
+        self._lock = threading.Lock()
+        self.mida = mida
+        self.max_overflow = max_overflow
+        self.en_us = 0
+        self.checkouts = 0
+        self.espera_total = 0.0
+        self.espera_maxima = 0.0
+        self.exhaurits = 0
+        self.reciclades = 0
+        self.pings_fallits = 0
+
+    def checkout(self, espera):
+        with self._lock:
+            self.en_us += 1
+            self.checkouts += 1
+            self.espera_total += espera
+            self.espera_maxima = max(self.espera_maxima, espera)
+
+    def retorn(self):
+        with self._lock:
+            self.en_us -= 1
+
+    def incrementar(self, comptador):
+        with self._lock:
+            setattr(self, comptador, getattr(self, comptador) + 1)
+
+    def instantania(self, inactives):
+        with self._lock:
+            return {
+                'mida': self.mida,
+                'max_overflow': self.max_overflow,
+                'en_us': self.en_us,
+                'inactives': inactives,
+                'checkouts': self.checkouts,
+                'espera_total_s': round(self.espera_total, 6),
+                'espera_mitjana_s': round(self.espera_total / self.checkouts, 6) if self.checkouts else 0.0,
+                'espera_maxima_s': round(self.espera_maxima, 6),
+                'exhaurits': self.exhaurits,
+                'reciclades': self.reciclades,
+                'pings_fallits': self.pings_fallits,
+            }
+
+
+class Preparades:
+    # Cursors preparats d'una connexió, un per consulta; viuen tant com la connexió i es
+    # reaprofiten entre peticions. En sortir de l'LRU el cursor es tanca i el servidor l'allibera
+    def __init__(self, cnx, mida):
+        self._cnx = cnx
+        self.mida = mida
+        self._cursors = OrderedDict()
+
+    def cursor(self, query):
+        cursor = self._cursors.get(query)
+        if cursor is not None:
+            self._cursors.move_to_end(query)
+            sentencies_preparades.inc("reutilitzada")
+            return cursor
+        cursor = self._cnx.cursor(prepared=True, dictionary=True)
+        self._cursors[query] = cursor
+        sentencies_preparades.inc("preparada")
+        if len(self._cursors) > self.mida:
+            _, vell = self._cursors.popitem(last=False)
+            vell.close()
+        return cursor
+
+
+class ConnexioPool:
+    # Embolcall d'una connexió del pool síncron; close() la retorna al pool en lloc de tancar-la
+    def __init__(self, pool, cnx, creada):
+        self._pool = pool
+        self._cnx = cnx
+        self._creada = creada
+
+    def __getattr__(self, nom):
+        return getattr(self._cnx, nom)
+
+    def preparades(self):
+        return self._pool.preparades(self._cnx)
+
+    def close(self):
+        if self._cnx is not None:
+            cnx, self._cnx = self._cnx, None
+            self._pool.retornar(cnx, self._creada)
+
+
+class PoolConnexions:
+    # Pool de mysql.connector amb overflow, cua d'espera limitada, ping i reciclatge
+    def __init__(self, config, mida, max_overflow, timeout, max_edat, ping_inactiva):
+        self.config = config
+        self.mida = mida
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.max_edat = max_edat
+        self.ping_inactiva = ping_inactiva
+        self.estadistiques = EstadistiquesPool(mida, max_overflow)
+        self._inactives = deque()  # (connexió, creada, retornada)
+        self._obertes = 0
+        self._preparades = {}  # connexió -> Preparades
+        self._cond = threading.Condition()
+
+    def obtenir(self):
+        inici = time.monotonic()
+        limit = inici + self.timeout
+        with self._cond:
+            while True:
+                if self._inactives:
+                    cnx, creada, retornada = self._inactives.pop()
+                    break
+                if self._obertes < self.mida + self.max_overflow:
+                    self._obertes += 1
+                    cnx, creada, retornada = None, None, None
+                    break
+                restant = limit - time.monotonic()
+                if restant <= 0:
+                    self.estadistiques.incrementar('exhaurits')
+                    raise PoolExhaurit(f"Cap connexió disponible després de {self.timeout} s")
+                self._cond.wait(restant)
+        try:
+            cnx, creada = self._preparar(cnx, creada, retornada)
+        except Exception:
+            with self._cond:
+                self._obertes -= 1
+                self._cond.notify()
+            raise
+        self.estadistiques.checkout(time.monotonic() - inici)
+        return ConnexioPool(self, cnx, creada)
+
+    def _preparar(self, cnx, creada, retornada):
+        ara = time.monotonic()
+        if cnx is not None and ara - creada > self.max_edat:
+            self.estadistiques.incrementar('reciclades')
+            self._tancar(cnx)
+            cnx = None
+        if cnx is not None and ara - retornada > self.ping_inactiva:
+            try:
+                cnx.ping(reconnect=False)
+            except mysql.connector.Error:
+                self.estadistiques.incrementar('pings_fallits')
+                self._tancar(cnx)
+                cnx = None
+        if cnx is None:
+            cnx = mysql.connector.connect(**self.config)
+            creada = time.monotonic()
+        return cnx, creada
+
+    def retornar(self, cnx, creada):
+        self.estadistiques.retorn()
+        try:
+            if cnx.unread_result:
+                cnx.consume_results()
+            if cnx.in_transaction:
+                cnx.rollback()
+        except mysql.connector.Error:
+            self._tancar(cnx)
+            cnx = None
+        with self._cond:
+            if cnx is not None and len(self._inactives) < self.mida:
+                self._inactives.append((cnx, creada, time.monotonic()))
+            else:
+                # Connexió d'overflow o trencada: es tanca i deixa lloc a una de nova
+                if cnx is not None:
+                    self._tancar(cnx)
+                self._obertes -= 1
+            self._cond.notify()
+
+    def preparades(self, cnx):
+        # Només la fa servir el fil que té la connexió
+        preparades = self._preparades.get(cnx)
+        if preparades is None:
+            preparades = self._preparades[cnx] = Preparades(cnx, DB_PREPARADES_MIDA)
+        return preparades
+
+    def _tancar(self, cnx):
+        # Les sentències preparades són de la sessió: desapareixen amb la connexió
+        self._preparades.pop(cnx, None)
+        try:
+            cnx.close()
+        except mysql.connector.Error:
+            pass
+
+    def inactives(self):
+        return len(self._inactives)
+
+    def tancar(self):
+        with self._cond:
+            while self._inactives:
+                cnx, _, _ = self._inactives.pop()
+                self._tancar(cnx)
+                self._obertes -= 1
+
+
+class PoolAsync:
+    # Pool d'aiomysql amb les mateixes regles: maxsize inclou l'overflow, l'espera té límit
+    # i les connexions velles o inactives es reciclen o es comproven abans de donar-les
+    def __init__(self, pool, mida, max_overflow, timeout, max_edat, ping_inactiva):
+        self._pool = pool
+        self.mida = mida
+        self.timeout = timeout
+        self.max_edat = max_edat
+        self.ping_inactiva = ping_inactiva
+        self.estadistiques = EstadistiquesPool(mida, max_overflow)
+        self._creades = weakref.WeakKeyDictionary()
+
+    async def obtenir(self):
+        inici = time.monotonic()
+        limit = inici + self.timeout
+        while True:
+            try:
+                cnx = await asyncio.wait_for(self._pool.acquire(), max(limit - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                self.estadistiques.incrementar('exhaurits')
+                raise PoolExhaurit(f"Cap connexió disponible després de {self.timeout} s")
+            ara = time.monotonic()
+            creada = self._creades.setdefault(cnx, ara)
+            if ara - creada > self.max_edat:
+                self.estadistiques.incrementar('reciclades')
+                await self._descartar(cnx)
+                continue
+            if asyncio.get_running_loop().time() - cnx.last_usage > self.ping_inactiva:
+                try:
+                    await cnx.ping(reconnect=False)
+                except pymysql.err.MySQLError:
+                    self.estadistiques.incrementar('pings_fallits')
+                    await self._descartar(cnx)
+                    continue
+            self.estadistiques.checkout(time.monotonic() - inici)
+            return cnx
+
+    async def retornar(self, cnx):
+        self.estadistiques.retorn()
+        # aiomysql tanca les connexions que tornen al pool amb una transacció oberta
+        try:
+            if not cnx.closed and cnx.get_transaction_status():
+                await cnx.rollback()
+        except pymysql.err.MySQLError:
+            cnx.close()
+        if self._pool.freesize >= self.mida:
+            # Connexió d'overflow: es tanca en comptes de quedar inactiva
+            cnx.close()
+        await self._pool.release(cnx)
+
+    async def _descartar(self, cnx):
+        cnx.close()
+        await self._pool.release(cnx)
+
+    def inactives(self):
+        return self._pool.freesize
+
+    async def tancar(self):
+        self._pool.close()
+        await self._pool.wait_closed()
+
+
+# Pool de connexions síncron; es crea en el primer ús i no en importar el mòdul
+db_pool = None
+_db_pool_lock = threading.Lock()
+
+def obtenir_pool_sync():
+    global db_pool
+    if db_pool is None:
+        with _db_pool_lock:
+            if db_pool is None:
+                db_pool = PoolConnexions(db_config, DB_POOL_SIZE, DB_POOL_MAX_OVERFLOW,
+                                         DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PING_INACTIVA)
+    return db_pool
 
 def get_db_connection():
-    return db_pool.get_connection()
+    return obtenir_pool_sync().obtenir()
+
+# Pool de connexions asíncron
+_pool_async = None
+_pool_async_lock = asyncio.Lock()
+
+async def crear_pool_async(config, mida, max_overflow):
+    if aiomysql is None:
+        raise RuntimeError("DB_MODE=async necessita el paquet aiomysql")
+    pool = await aiomysql.create_pool(
+        host=config['host'],
+        port=config['port'],
+        user=config['user'],
+        password=config['password'],
+        db=config['database'],
+        charset='utf8mb4',
+        init_command=f"SET NAMES utf8mb4 COLLATE {config['collation']}",
+        autocommit=False,
+        minsize=1,
+        maxsize=mida + max_overflow,
+    )
+    return PoolAsync(pool, mida, max_overflow, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PING_INACTIVA)
+
+async def obtenir_pool_async():
+    global _pool_async
+    if _pool_async is None:
+        async with _pool_async_lock:
+            if _pool_async is None:
+                _pool_async = await crear_pool_async(db_config, DB_POOL_SIZE, DB_POOL_MAX_OVERFLOW)
+    return _pool_async
+
+async def obrir_pool():
+    # Obre les DB_POOL_SIZE connexions fixes del pool del mode actiu (escalfament d'arrencada)
+    if DB_MODE == 'sync':
+        pool = obtenir_pool_sync()
+        cnxs = [await anyio.to_thread.run_sync(pool.obtenir) for _ in range(pool.mida)]
+        for cnx in cnxs:
+            cnx.close()
+    else:
+        pool = await obtenir_pool_async()
+        cnxs = [await pool.obtenir() for _ in range(pool.mida)]
+        for cnx in cnxs:
+            await pool.retornar(cnx)
+
+async def tancar_pools():
+    global _pool_async, _vigilancia
+    if _vigilancia is not None:
+        _vigilancia.cancel()
+        _vigilancia = None
+    for replica in REPLIQUES:
+        await replica.tancar()
+    if _pool_async is not None:
+        await _pool_async.tancar()
+        _pool_async = None
+    if db_pool is not None:
+        db_pool.tancar()
+
+def estadistiques_pool():
+    pool = _pool_async if DB_MODE != 'sync' else db_pool
+    if pool is None:
+        estadistiques = {'mode': DB_MODE, 'creat': False}
+    else:
+        estadistiques = {'mode': DB_MODE, 'creat': True, **pool.estadistiques.instantania(pool.inactives())}
+    if REPLIQUES:
+        estadistiques['repliques'] = {replica.nom: replica.estadistiques() for replica in REPLIQUES}
+    return estadistiques
+
+
+class Replica:
+    # Rèplica de lectura: pools propis (creats al primer ús, com els de la primària) i l'estat
+    # de l'última comprovació. Comença fora de servei fins que una comprovació la dona per bona
+    def __init__(self, nom, config):
+        self.nom = nom
+        self.config = config
+        self.sana = False
+        self.retard = None
+        self.error = None
+        self._pool_sync = None
+        self._pool_sync_lock = threading.Lock()
+        self._pool_async = None
+        self._pool_async_lock = asyncio.Lock()
 
-# Estructura SQL de la base de dades
+    def pool_sync(self):
+        if self._pool_sync is None:
+            with self._pool_sync_lock:
+                if self._pool_sync is None:
+                    self._pool_sync = PoolConnexions(self.config, DB_REPLICA_POOL_SIZE, DB_REPLICA_POOL_MAX_OVERFLOW,
+                                                     DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PING_INACTIVA)
+        return self._pool_sync
+
+    async def pool_async(self):
+        if self._pool_async is None:
+            async with self._pool_async_lock:
+                if self._pool_async is None:
+                    self._pool_async = await crear_pool_async(self.config, DB_REPLICA_POOL_SIZE,
+                                                              DB_REPLICA_POOL_MAX_OVERFLOW)
+        return self._pool_async
+
+    def en_us(self):
+        pool = self._pool_async if DB_MODE != 'sync' else self._pool_sync
+        return 0 if pool is None else pool.estadistiques.en_us
+
+    def fallar(self, error):
+        # Una connexió que no s'obre la treu de servei fins a la propera comprovació bona
+        self.sana, self.error = False, f"{type(error).__name__}: {error}"
+        log.warning("Rèplica %s fora de servei: %s", self.nom, self.error)
+
+    async def comprovar(self):
+        tallada = False
+
+        def tallar():
+            nonlocal tallada
+            tallada = True
+            db.tallar()
+
+        try:
+            db, alliberar = await _agafar(self)
+            # Sense wait_for: cancel·lar la consulta a mitges deixaria una resposta pendent a la
+            # connexió i tornaria al pool. Si triga massa es talla: la consulta falla aquí i la
+            # connexió es descarta
+            rellotge = asyncio.get_running_loop().call_later(DB_REPLICA_COMPROVACIO, tallar)
+            try:
+                estat = await db.fetchone("SHOW SLAVE STATUS")
+            finally:
+                rellotge.cancel()
+                await alliberar()
+        except Exception as e:
+            if tallada:
+                e = TimeoutError(f"la comprovació ha trigat més de {DB_REPLICA_COMPROVACIO} s")
+            if self.sana:
+                self.fallar(e)
+            else:
+                self.error = f"{type(e).__name__}: {e}"
+            return
+        # Sense files el servidor no replica de ningú (p. ex. un segon MariaDB de proves): retard 0
+        retard = 0.0 if estat is None else estat.get('Seconds_Behind_Master')
+        if retard is None:
+            self.fallar(RuntimeError("la replicació està aturada"))
+            self.retard = None
+            return
+        self.retard, self.error = float(retard), None
+        # Histèresi: per tornar a entrar ha de baixar a la meitat del retard màxim
+        limit = DB_REPLICA_RETARD_MAXIM if self.sana else DB_REPLICA_RETARD_MAXIM / 2
+        sana = self.retard <= limit
+        if sana != self.sana:
+            log.warning("Rèplica %s %s (retard %.1f s)", self.nom, "en servei" if sana else "fora de servei", self.retard)
+        self.sana = sana
+
+    def estadistiques(self):
+        pool = self._pool_async if DB_MODE != 'sync' else self._pool_sync
+        estadistiques = {'host': self.config['host'], 'sana': int(self.sana), 'retard_s': self.retard,
+                         'error': self.error}
+        if pool is not None:
+            estadistiques.update(pool.estadistiques.instantania(pool.inactives()))
+        return estadistiques
+
+    async def tancar(self):
+        if self._pool_async is not None:
+            await self._pool_async.tancar()
+            self._pool_async = None
+        if self._pool_sync is not None:
+            self._pool_sync.tancar()
+
+
+def config_replica(adreca):
+    host, _, port = adreca.partition(':')
+    return {**db_config, 'host': host, 'port': int(port) if port else db_config['port']}
+
+REPLIQUES = [Replica(f"replica{index}", config_replica(adreca)) for index, adreca in enumerate(DB_REPLIQUES)]
+_vigilancia = None
+_torn = 0
+
+async def vigilar_repliques():
+    while True:
+        await asyncio.sleep(DB_REPLICA_COMPROVACIO)
+        await asyncio.gather(*(replica.comprovar() for replica in REPLIQUES))
+
+async def iniciar_repliques():
+    # Primera comprovació abans d'acceptar peticions; després, cada DB_REPLICA_COMPROVACIO segons
+    global _vigilancia
+    if not REPLIQUES or _vigilancia is not None:
+        return
+    await asyncio.gather(*(replica.comprovar() for replica in REPLIQUES))
+    _vigilancia = asyncio.get_running_loop().create_task(vigilar_repliques())
+
+def triar_replica():
+    # La rèplica sana amb menys connexions en ús; els empats es reparteixen per torns
+    global _torn
+    sanes = [replica for replica in REPLIQUES if replica.sana]
+    if not sanes:
+        return None
+    _torn += 1
+    return min(sanes, key=lambda replica: (replica.en_us(), (REPLIQUES.index(replica) - _torn) % len(REPLIQUES)))
+
+
+class Lectura:
+    # Destí de les lectures d'una petició GET. Es tria al primer accés i tota la petició hi
+    # llegeix, perquè les versions dels ETags i les dades surtin del mateix servidor
+    def __init__(self, enganxada):
+        self.enganxada = enganxada
+        self.triada = False
+        self.replica = None
+
+
+_lectura = contextvars.ContextVar('lectura', default=None)
+
+def replica_lectura():
+    lectura = _lectura.get()
+    if lectura is None:
+        return None
+    if not lectura.triada:
+        lectura.triada = True
+        if lectura.enganxada:
+            lectures.inc("primaria_enganxada")
+        else:
+            lectura.replica = triar_replica()
+            lectures.inc("replica" if lectura.replica is not None else "primaria_sense_repliques")
+    return lectura.replica
+
+def origen_lectura():
+    # Servidor d'on llegeix la petició actual: "primaria" o el nom de la rèplica
+    replica = replica_lectura()
+    return "primaria" if replica is None else replica.nom
+
+@contextmanager
+def lectura_primaria():
+    # Per a lectures que sobreviuen a la petició (la memòria cau): una rèplica endarrerida hi
+    # podria deixar un valor anterior a la darrera invalidació
+    token = _lectura.set(None)
+    try:
+        yield
+    finally:
+        _lectura.reset(token)
+
+
+class MiddlewareLectures:
+    # Middleware ASGI: les peticions GET i HEAD llegeixen d'una rèplica, llevat que el client
+    # hagi escrit fa menys de DB_ENGANXAT segons (cookie); les escriptures bones posen la cookie
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not REPLIQUES:
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] in ("GET", "HEAD"):
+            galetes = cookie_parser(Headers(scope=scope).get("cookie", ""))
+            token = _lectura.set(Lectura(enganxada=COOKIE_PRIMARIA in galetes))
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                _lectura.reset(token)
+            return
+
+        async def enviar(missatge):
+            if missatge["type"] == "http.response.start" and missatge["status"] < 400:
+                capcaleres = MutableHeaders(raw=list(missatge["headers"]))
+                capcaleres.append("Set-Cookie", f"{COOKIE_PRIMARIA}=1; Max-Age={int(DB_ENGANXAT + 0.5)}; "
+                                                "Path=/; HttpOnly; SameSite=Lax")
+                missatge = dict(missatge, headers=capcaleres.raw)
+            await send(missatge)
+
+        await self.app(scope, receive, enviar)
+
+
+class ConnexioAsync:
+    # Connexió d'aiomysql; totes les crides són natives del bucle d'esdeveniments
+    def __init__(self, cnx):
+        self._cnx = cnx
+
+    async def execute(self, query, params=()):
+        async with self._cnx.cursor() as cursor:
+            with mesurar_consulta(query):
+                await cursor.execute(query, params)
+            return Resultat(cursor.rowcount, cursor.lastrowid)
+
+    async def executemany(self, query, seq_params):
+        async with self._cnx.cursor() as cursor:
+            with mesurar_consulta(query):
+                await cursor.executemany(query, seq_params)
+            return Resultat(cursor.rowcount, cursor.lastrowid)
+
+    async def fetchone(self, query, params=()):
+        async with self._cnx.cursor(aiomysql.DictCursor) as cursor:
+            with mesurar_consulta(query):
+                await cursor.execute(query, params)
+                return await cursor.fetchone()
+
+    async def fetchall(self, query, params=()):
+        async with self._cnx.cursor(aiomysql.DictCursor) as cursor:
+            with mesurar_consulta(query):
+                await cursor.execute(query, params)
+                return list(await cursor.fetchall())
+
+    async def iterar(self, query, params=(), mida_lot=500):
+        # Cursor al costat del servidor: les files arriben per lots i no es buferitza el resultat.
+        # Només es mesura l'execució: la lectura dels lots depèn del ritme del client
+        async with self._cnx.cursor(aiomysql.SSDictCursor) as cursor:
+            with mesurar_consulta(query):
+                await cursor.execute(query, params)
+            while True:
+                files = await cursor.fetchmany(mida_lot)
+                if not files:
+                    break
+                for fila in files:
+                    yield fila
+
+    async def commit(self):
+        await self._cnx.commit()
+
+    async def rollback(self):
+        await self._cnx.rollback()
+
+    def tallar(self):
+        # Tanca el socket sense esperar res del servidor: la consulta en curs falla i el pool
+        # descarta la connexió en tornar-la
+        self._cnx.close()
+
+
+class ConnexioSync:
+    # Connexió de mysql.connector; cada crida bloquejant s'executa en un fil del pool d'AnyIO
+    def __init__(self, cnx):
+        self._cnx = cnx
+
+    def _preparat(self, query):
+        # Cursor preparat si la consulta s'ha marcat amb preparada(); si no, protocol de text
+        if DB_PREPARADES and query in SENTENCIES_PREPARADES:
+            return self._cnx.preparades().cursor(query)
+        return None
+
+    def _execute(self, query, params):
+        cursor = self._preparat(query)
+        if cursor is not None:
+            cursor.execute(query, params)
+            return Resultat(cursor.rowcount, cursor.lastrowid)
+        cursor = self._cnx.cursor()
+        try:
+            cursor.execute(query, params)
+            return Resultat(cursor.rowcount, cursor.lastrowid)
+        finally:
+            cursor.close()
+
+    def _executemany(self, query, seq_params):
+        cursor = self._cnx.cursor()
+        try:
+            cursor.executemany(query, seq_params)
+            return Resultat(cursor.rowcount, cursor.lastrowid)
+        finally:
+            cursor.close()
+
+    def _fetch(self, query, params, tots):
+        cursor = self._preparat(query)
+        if cursor is not None:
+            # El cursor no es tanca: s'ha de llegir sencer perquè la connexió quedi lliure
+            cursor.execute(query, params)
+            files = cursor.fetchall()
+            return files if tots else (files[0] if files else None)
+        cursor = self._cnx.cursor(dictionary=True)
+        try:
+            cursor.execute(query, params)
+            return cursor.fetchall() if tots else cursor.fetchone()
+        finally:
+            cursor.close()
+
+    # Es mesura des del bucle: el temps inclou l'espera d'un fil lliure, que també és temps de BD
+    async def execute(self, query, params=()):
+        with mesurar_consulta(query):
+            return await anyio.to_thread.run_sync(self._execute, query, params)
+
+    async def executemany(self, query, seq_params):
+        with mesurar_consulta(query):
+            return await anyio.to_thread.run_sync(self._executemany, query, list(seq_params))
+
+    async def fetchone(self, query, params=()):
+        with mesurar_consulta(query):
+            return await anyio.to_thread.run_sync(self._fetch, query, params, False)
+
+    async def fetchall(self, query, params=()):
+        with mesurar_consulta(query):
+            return await anyio.to_thread.run_sync(self._fetch, query, params, True)
+
+    async def iterar(self, query, params=(), mida_lot=500):
+        cursor = self._cnx.cursor(dictionary=True, buffered=False)
+        try:
+            with mesurar_consulta(query):
+                await anyio.to_thread.run_sync(cursor.execute, query, params)
+            while True:
+                files = await anyio.to_thread.run_sync(cursor.fetchmany, mida_lot)
+                if not files:
+                    break
+                for fila in files:
+                    yield fila
+        finally:
+            # Si el client ha tallat la connexió queden files pendents que s'han de buidar
+            # abans de tancar el cursor
+            if self._cnx.unread_result:
+                await anyio.to_thread.run_sync(self._cnx.consume_results)
+            cursor.close()
+
+    async def commit(self):
+        await anyio.to_thread.run_sync(self._cnx.commit)
+
+    async def rollback(self):
+        await anyio.to_thread.run_sync(self._cnx.rollback)
+
+    def tallar(self):
+        # Des del bucle, mentre el fil espera la resposta: shutdown() no envia QUIT, i el recv
+        # bloquejat torna amb error. retornar() la troba trencada i la tanca
+        self._cnx.shutdown()
+
+
+async def _agafar(replica=None):
+    # (connexió, funció que l'allibera) del pool del mode actiu; sense rèplica, de la primària
+    if DB_MODE == 'sync':
+        pool = obtenir_pool_sync() if replica is None else replica.pool_sync()
+        cnx = await anyio.to_thread.run_sync(pool.obtenir)
+        return ConnexioSync(cnx), lambda: anyio.to_thread.run_sync(cnx.close)
+    pool = await (obtenir_pool_async() if replica is None else replica.pool_async())
+    cnx = await pool.obtenir()
+    return ConnexioAsync(cnx), lambda: pool.retornar(cnx)
+
+@asynccontextmanager
+async def connexio(primaria=False):
+    # Dins una petició GET (MiddlewareLectures) llegeix de la rèplica triada; si no n'hi ha cap de
+    # sana o no s'hi pot connectar, de la primària. primaria=True per a escriptures i comprovacions
+    replica = None if primaria else replica_lectura()
+    db = None
+    if replica is not None:
+        try:
+            db, alliberar = await _agafar(replica)
+        except Exception as e:
+            if not isinstance(e, PoolExhaurit):
+                replica.fallar(e)
+            # La resta de la petició també va a la primària
+            _lectura.get().replica = None
+            lectures.inc("primaria_error")
+    if db is None:
+        db, alliberar = await _agafar()
+    try:
+        yield db
+    finally:
+        await alliberar()
+
+class UnitatTreball:
+    # Connexió d'una transacció de transaccio(). Les accions de despres_commit() (invalidar la
+    # memòria cau...) s'executen en ordre quan el commit ha anat bé, i mai si es desfà
+    def __init__(self, db):
+        self._db = db
+        self._despres = []
+
+    def __getattr__(self, nom):
+        return getattr(self._db, nom)
+
+    def despres_commit(self, accio):
+        self._despres.append(accio)
+
+
+@asynccontextmanager
+async def transaccio():
+    # Un sol commit per petició; una excepció dins el bloc desfà tota la feina
+    async with connexio(primaria=True) as db:
+        unitat = UnitatTreball(db)
+        try:
+            yield unitat
+        except Exception:
+            await db.rollback()
+            raise
+        await db.commit()
+    for accio in unitat._despres:
+        await accio()
+
+async def consultar_un(query, params=()):
+    async with connexio() as db:
+        return await db.fetchone(query, params)
+
+async def consultar_tots(query, params=()):
+    async with connexio() as db:
+        return await db.fetchall(query, params)
+
+# Estructura SQL inicial de la base de dades (migració 1). Els canvis posteriors
+# d'esquema van a migracions.py, no aquí
 CREATE_TABLES = {
     "usuari": """
         CREATE TABLE IF NOT EXISTS usuari (
@@ -74,17 +933,23 @@ CREATE_TABLES = {
             FOREIGN KEY (usuari_id) REFERENCES usuari(id) ON DELETE CASCADE,
             FOREIGN KEY (titol_id) REFERENCES titol(id) ON DELETE CASCADE
         )
+    """,
+    "versio_taula": """
+        CREATE TABLE IF NOT EXISTS versio_taula (
+            taula VARCHAR(64) PRIMARY KEY,
+            versio BIGINT NOT NULL DEFAULT 0
+        )
     """
 }
 
 def create_tables():
-    db = get_db_connection()
-    cursor = db.cursor()
-    for table_name, create_stmt in CREATE_TABLES.items():
-        cursor.execute(create_stmt)
-    db.commit()
-    cursor.close()
-    db.close()
+    # L'esquema ara el porta el runner de migracions; CREATE_TABLES n'és la versió 1
+    from migracions import migrar
+    migrar()
 
 if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "importar":
+        from importacio import principal
+        sys.exit(principal(sys.argv[2:]))
     create_tables()
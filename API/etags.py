@@ -0,0 +1,83 @@
+import hashlib
+import os
+import time
+
+from fastapi import Response
+
+from db import consultar_tots, origen_lectura, preparada
+
+# Segons que es reaprofiten les versions llegides de versio_taula abans de tornar-les a consultar.
+# És el retard màxim amb què un worker veu una escriptura feta per un altre
+ETAG_TTL = float(os.getenv('ETAG_TTL', '1'))
+# Capçalera per a les lectures públiques; s-maxage deixa que un CDN o proxy les serveixi uns segons
+CACHE_CONTROL = os.getenv('CACHE_CONTROL', 'public, max-age=0, s-maxage=5, stale-while-revalidate=30')
+
+
+SQL_VERSIONS = preparada("SELECT taula, versio FROM versio_taula")
+
+
+class Versions:
+    # Comptador de canvis per taula. Viu a la base de dades perquè tots els workers
+    # en vegin el mateix valor; els handlers d'escriptura l'incrementen dins la seva transacció.
+    # Es guarden per servidor: amb rèpliques, les versions han de sortir d'on es llegeixen les
+    # dades, o una rèplica endarrerida donaria dades velles amb l'ETag de les noves
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._versions = {}  # origen -> (versions, llegides)
+
+    async def obtenir(self, *taules):
+        origen = origen_lectura()
+        valors, llegides = self._versions.get(origen, ({}, 0.0))
+        if time.monotonic() - llegides > self.ttl:
+            files = await consultar_tots(SQL_VERSIONS)
+            valors = {fila['taula']: fila['versio'] for fila in files}
+            self._versions[origen] = (valors, time.monotonic())
+        return [valors.get(taula, 0) for taula in taules]
+
+    async def incrementar(self, db, *taules):
+        # Ordre fix perquè dues transaccions no bloquegin les files en ordre diferent
+        taules = sorted(set(taules))
+        valors = ", ".join(["(%s, 1)"] * len(taules))
+        await db.execute(f"""
+            INSERT INTO versio_taula (taula, versio) VALUES {valors}
+            ON DUPLICATE KEY UPDATE versio = versio + 1
+        """, tuple(taules))
+        self._versions = {}
+
+
+versions = Versions(ETAG_TTL)
+
+
+def calcular_etag(request, valors):
+    base = f"{request.url.path}?{request.url.query}|{','.join(map(str, valors))}"
+    return '"' + hashlib.sha1(base.encode()).hexdigest()[:20] + '"'
+
+
+def etag_codificat(etag, codificacio):
+    # "abc" -> "abc-gzip": la representació comprimida (compressio.py) té un ETag propi
+    return etag[:-1] + f'-{codificacio}"'
+
+
+def coincideix(if_none_match, etag):
+    # Retorna l'ETag del client que correspon a la versió actual, en qualsevol codificació
+    if if_none_match is None:
+        return None
+    for candidat in if_none_match.split(","):
+        candidat = candidat.strip().removeprefix("W/")
+        if candidat == "*":
+            return etag
+        if candidat == etag or (candidat.startswith(etag[:-1] + "-") and candidat.endswith('"')):
+            return candidat
+    return None
+
+
+async def condicional(request, response, *taules):
+    # Retorna un 304 si el client ja té la versió actual; si no, deixa l'ETag a la resposta
+    etag = calcular_etag(request, await versions.obtenir(*taules))
+    capcaleres = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    coincident = coincideix(request.headers.get("if-none-match"), etag)
+    if coincident:
+        # El 304 porta l'ETag de la representació que el client ja té
+        return Response(status_code=304, headers=dict(capcaleres, ETag=coincident))
+    response.headers.update(capcaleres)
+    return None
@@ -0,0 +1,133 @@
+import re
+import unicodedata
+
+# titol.plataformes i titol.genero es continuen desant tal com arriben (és el que retorna
+# l'API); aquestes taules en són la versió normalitzada, per filtrar per índex i comptar
+# facetes. Es mantenen a cada escriptura de títols amb classificar_titols()
+DIMENSIONS = {
+    # nom del filtre: (columna de titol, taula de noms, taula d'unió, columna d'unió)
+    "plataforma": ("plataformes", "plataforma", "titol_plataforma", "plataforma_id"),
+    "genero": ("genero", "genere", "titol_genere", "genere_id"),
+}
+
+SQL_TAULES = [
+    sql
+    for _, taula, unio, columna in DIMENSIONS.values()
+    for sql in (
+        f"""
+        CREATE TABLE IF NOT EXISTS {taula} (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            nom VARCHAR(100) NOT NULL UNIQUE
+        )
+        """,
+        # La PK comença pel valor: filtrar per plataforma és un rang de l'índex en ordre de títol
+        f"""
+        CREATE TABLE IF NOT EXISTS {unio} (
+            {columna} INT NOT NULL,
+            titol_id INT NOT NULL,
+            PRIMARY KEY ({columna}, titol_id),
+            INDEX idx_{unio}_titol (titol_id),
+            FOREIGN KEY ({columna}) REFERENCES {taula}(id) ON DELETE CASCADE,
+            FOREIGN KEY (titol_id) REFERENCES titol(id) ON DELETE CASCADE
+        )
+        """,
+    )
+]
+
+SEPARADORS = re.compile(r"\s*[,;/|]\s*")
+MIDA_LOT_MIGRACIO = 5000
+
+
+def separar(valor):
+    # "Netflix, HBO / Prime Video" -> ["Netflix", "HBO", "Prime Video"], sense repetits
+    noms = {}
+    for nom in SEPARADORS.split(valor or ""):
+        nom = " ".join(nom.split())[:100]
+        if nom:
+            noms.setdefault(clau(nom), nom)
+    return list(noms.values())
+
+
+def clau(nom):
+    # Aproxima la col·lació de la columna (sense majúscules ni accents) per casar els ids llegits
+    descompost = unicodedata.normalize("NFKD", nom.casefold())
+    return "".join(c for c in descompost if not unicodedata.combining(c))
+
+
+def condicio(filtre, titol_id="t.id"):
+    # Condició per a una clàusula WHERE sobre els títols; rep el nom com a paràmetre
+    _, taula, unio, columna = DIMENSIONS[filtre]
+    return f"{titol_id} IN (SELECT f.titol_id FROM {unio} f JOIN {taula} fn ON fn.id = f.{columna} WHERE fn.nom = %s)"
+
+
+def sql_facetes(filtres):
+    # Recompte de títols per valor de cada dimensió, restringit pels filtres de les altres
+    consultes = {}
+    for nom, (_, taula, unio, columna) in DIMENSIONS.items():
+        altres = [filtre for filtre in filtres if filtre != nom]
+        on = " AND ".join(condicio(filtre, "u.titol_id") for filtre in altres)
+        consultes[nom] = (f"""
+            SELECT n.nom, COUNT(*) AS titols
+            FROM {unio} u
+            JOIN {taula} n ON n.id = u.{columna}
+            {'WHERE ' + on if on else ''}
+            GROUP BY n.id, n.nom
+            ORDER BY titols DESC, n.nom
+        """, tuple(filtres[filtre] for filtre in altres))
+    return consultes
+
+
+async def _ids_noms(db, taula, noms):
+    await db.executemany(f"INSERT IGNORE INTO {taula} (nom) VALUES (%s)", [(nom,) for nom in noms])
+    marcadors = ", ".join(["%s"] * len(noms))
+    files = await db.fetchall(f"SELECT id, nom FROM {taula} WHERE nom IN ({marcadors})", tuple(noms))
+    ids = {clau(fila["nom"]): fila["id"] for fila in files}
+    for nom in noms:
+        if clau(nom) not in ids:
+            # La col·lació els ha considerat iguals però clau() no: ho decideix la base de dades
+            fila = await db.fetchone(f"SELECT id FROM {taula} WHERE nom = %s", (nom,))
+            ids[clau(nom)] = fila["id"]
+    return ids
+
+
+async def classificar_titols(db, condicio_titols, params=()):
+    # Refà les files d'unió dels títols que compleixen condicio_titols (sobre la taula titol)
+    files = await db.fetchall(f"SELECT id, plataformes, genero FROM titol WHERE {condicio_titols}", params)
+    if not files:
+        return
+    titol_ids = [fila["id"] for fila in files]
+    marcadors = ", ".join(["%s"] * len(titol_ids))
+    for columna_titol, taula, unio, columna in DIMENSIONS.values():
+        valors = {fila["id"]: separar(fila[columna_titol]) for fila in files}
+        noms = list({clau(nom): nom for llista in valors.values() for nom in llista}.values())
+        ids = await _ids_noms(db, taula, noms) if noms else {}
+        await db.execute(f"DELETE FROM {unio} WHERE titol_id IN ({marcadors})", tuple(titol_ids))
+        unions = [(ids[clau(nom)], titol_id) for titol_id, llista in valors.items() for nom in llista]
+        if unions:
+            await db.executemany(f"INSERT IGNORE INTO {unio} ({columna}, titol_id) VALUES (%s, %s)", unions)
+
+
+def classificar_tots_sync(cursor):
+    # Pas de migració: omple les taules a partir dels títols existents, per lots d'id
+    darrer = 0
+    while True:
+        cursor.execute("SELECT id, plataformes, genero FROM titol WHERE id > %s ORDER BY id LIMIT %s",
+                       (darrer, MIDA_LOT_MIGRACIO))
+        files = cursor.fetchall()
+        if not files:
+            return
+        darrer = files[-1][0]
+        for index, (_, taula, unio, columna) in enumerate(DIMENSIONS.values(), start=1):
+            valors = [(fila[0], separar(fila[index])) for fila in files]
+            noms = list({clau(nom): nom for _, llista in valors for nom in llista}.values())
+            if not noms:
+                continue
+            cursor.executemany(f"INSERT IGNORE INTO {taula} (nom) VALUES (%s)", [(nom,) for nom in noms])
+            cursor.execute(f"SELECT id, nom FROM {taula}")
+            ids = {clau(nom): id_nom for id_nom, nom in cursor.fetchall()}
+            for nom in noms:
+                if clau(nom) not in ids:
+                    cursor.execute(f"SELECT id FROM {taula} WHERE nom = %s", (nom,))
+                    ids[clau(nom)] = cursor.fetchone()[0]
+            cursor.executemany(f"INSERT IGNORE INTO {unio} ({columna}, titol_id) VALUES (%s, %s)",
+                               [(ids[clau(nom)], titol_id) for titol_id, llista in valors for nom in llista])
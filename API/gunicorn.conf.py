@@ -0,0 +1,70 @@
+# Perfil de producció: gunicorn gestiona diversos workers d'uvicorn
+#
+#   gunicorn -c gunicorn.conf.py main:app
+#
+# kill -HUP <màster> recarrega els workers un a un (els vells acaben les peticions en curs);
+# kill -TERM <màster> atura'ls deixant-los acabar fins a WEB_GRACEFUL_TIMEOUT segons.
+import multiprocessing
+import os
+
+# Workers: per defecte un per nucli
+workers = int(os.getenv('WEB_WORKERS', multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = os.getenv('WEB_BIND', '0.0.0.0:443')
+
+# TLS al mateix procés si hi ha certificat; amb un proxy al davant es deixa WEB_SSL=0
+if os.getenv('WEB_SSL', '1') == '1':
+    keyfile = os.getenv('WEB_SSL_KEYFILE', '/app/ssl/key.pem')
+    certfile = os.getenv('WEB_SSL_CERTFILE', '/app/ssl/cert.pem')
+
+# Un worker que no respon en aquests segons es reinicia; ha de cobrir l'escalfament
+timeout = int(os.getenv('WEB_TIMEOUT', '60'))
+# Temps per acabar les peticions en curs en una recàrrega o aturada
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('WEB_KEEPALIVE', '5'))
+# Reinici periòdic dels workers (0 = mai); el jitter evita que es reiniciïn tots alhora
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.getenv('WEB_MAX_REQUESTS_JITTER', '0'))
+# Cada worker importa l'app per separat: els pools i memòries cau no es comparteixen per fork
+preload_app = False
+
+accesslog = os.getenv('WEB_ACCESSLOG')
+loglevel = os.getenv('WEB_LOGLEVEL', 'info')
+
+
+def mides_pool(workers, max_connexions, reservades, maxim_worker):
+    # Reparteix max_connections entre els workers: la meitat de la part de cadascun fixa
+    # (DB_POOL_SIZE) i la resta overflow, perquè N * (mida + overflow) no el superi mai.
+    # Un sol bucle d'esdeveniments no aprofita gaires més de maxim_worker connexions
+    per_worker = max(min((max_connexions - reservades) // workers, maxim_worker), 2)
+    mida = max(per_worker // 2, 1)
+    return mida, per_worker - mida
+
+
+# max_connections del servidor i connexions que es deixen per a migracions, el servei de
+# recomanacions i administració. Un DB_POOL_SIZE explícit té preferència
+_mida, _overflow = mides_pool(workers, int(os.getenv('DB_MAX_CONNEXIONS', '151')),
+                              int(os.getenv('DB_CONNEXIONS_RESERVADES', '20')),
+                              int(os.getenv('DB_POOL_MAXIM_WORKER', '32')))
+_mida = int(os.getenv('DB_POOL_SIZE', _mida))
+_overflow = int(os.getenv('DB_POOL_MAX_OVERFLOW', _overflow))
+
+
+def processos_credencials(workers, pressupost):
+    # Reparteix els processos d'argon2 de la màquina entre els workers (com a mínim un per
+    # worker): CREDENCIALS_PROCESSOS de credencials.py és per worker, i el mateix valor a tots
+    # multiplicaria la CPU i la memòria dels hashes pel nombre de workers
+    return max(pressupost // workers, 1)
+
+
+# Hashes alhora a tota la màquina: per defecte la meitat dels nuclis, perquè un pic d'altes
+# deixi l'altra meitat a les rutes. Un CREDENCIALS_PROCESSOS explícit té preferència
+_credencials = processos_credencials(
+    workers, int(os.getenv('CREDENCIALS_PROCESSOS_MAQUINA', max(multiprocessing.cpu_count() // 2, 1))))
+_credencials = int(os.getenv('CREDENCIALS_PROCESSOS', _credencials))
+raw_env = [f"DB_POOL_SIZE={_mida}", f"DB_POOL_MAX_OVERFLOW={_overflow}", f"CREDENCIALS_PROCESSOS={_credencials}"]
+
+
+def when_ready(server):
+    server.log.info("%s workers amb un pool de %s connexions (+%s d'overflow) i %s processos de credencials cadascun",
+                    workers, _mida, _overflow, _credencials)
@@ -0,0 +1,261 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+import time
+
+import anyio
+
+from metriques import BUCKETS_LATENCIA, Comptador, Histograma, registre
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Sense Pillow no es fan miniatures: la ruta serveix l'original
+    Image = None
+
+# Magatzem d'imatges adreçat pel contingut: titol.imatge i usuari.imatge guarden només el nom
+# ("<sha256>.<ext>") o una URL externa, mai les dades. Els fitxers no canvien mai per a un nom
+IMATGES_DIR = os.getenv('IMATGES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'imatges'))
+# Base de les URLs públiques: les rutes /imatges de l'API o un CDN que les té d'origen
+IMATGES_URL = os.getenv('IMATGES_URL', '/imatges').rstrip('/')
+# Amplades de miniatura permeses (la primera és la de les llistes); cap altra es genera
+IMATGES_MIDES = tuple(int(mida) for mida in os.getenv('IMATGES_MIDES', '160,480').split(','))
+IMATGES_MIDA_MAXIMA = int(os.getenv('IMATGES_MIDA_MAXIMA', str(5 * 1024 * 1024)))
+# Miniatures que es generen alhora, per worker: un pic d'imatges noves no ocupa tots els fils d'AnyIO
+IMATGES_FILS = int(os.getenv('IMATGES_FILS', '2'))
+
+MIDA_LLISTA = IMATGES_MIDES[0]
+QUALITAT_MINIATURA = 80
+# Per sobre d'aquests píxels Pillow no descodifica la imatge (bombes de descompressió)
+PIXELS_MAXIMS = 40_000_000
+MIDA_LOT_MIGRACIO = 100
+# Els noms depenen del contingut: el navegador i el CDN els poden guardar per sempre
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+FORMATS = {"jpg": "image/jpeg", "png": "image/png", "gif": "image/gif", "webp": "image/webp"}
+NOM = re.compile(r"^[0-9a-f]{64}\.(?:jpg|png|gif|webp)$")
+# Camps de les respostes que contenen una imatge (serialitzacio.py i models.py)
+CAMPS = ("imatge", "usuari_imatge")
+TAULES = ("titol", "usuari")
+
+if Image is not None:
+    Image.MAX_IMAGE_PIXELS = PIXELS_MAXIMS
+
+log = logging.getLogger("popview.imatges")
+
+operacions = registre.afegir(Comptador(
+    "popview_imatges_total", "Operacions del magatzem d'imatges", ("operacio", "resultat")))
+durada_miniatures = registre.afegir(Histograma(
+    "popview_imatges_miniatura_segons", "Temps de generar una miniatura", BUCKETS_LATENCIA))
+
+
+class ImatgeNoValida(ValueError):
+    pass
+
+
+def _format(dades):
+    # Pel contingut, no pel tipus que declara el client
+    if dades.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if dades.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if dades[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if dades[:4] == b"RIFF" and dades[8:12] == b"WEBP":
+        return "webp"
+    raise ImatgeNoValida("Format d'imatge no admès (JPEG, PNG, GIF o WebP)")
+
+
+def cami_original(nom):
+    return os.path.join(IMATGES_DIR, "originals", nom[:2], nom)
+
+
+def cami_miniatura(nom, amplada):
+    return os.path.join(IMATGES_DIR, "miniatures", str(amplada), nom[:2], nom.rsplit(".", 1)[0] + ".webp")
+
+
+def _escriure(cami, dades):
+    # Fitxer temporal al mateix directori i rename: ningú no llegeix mai un fitxer a mitges
+    os.makedirs(os.path.dirname(cami), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(cami), delete=False) as temporal:
+        temporal.write(dades)
+    os.replace(temporal.name, cami)
+
+
+def desar_sync(dades):
+    if not dades:
+        raise ImatgeNoValida("La imatge és buida")
+    if len(dades) > IMATGES_MIDA_MAXIMA:
+        raise ImatgeNoValida(f"La imatge supera els {IMATGES_MIDA_MAXIMA} bytes")
+    nom = f"{hashlib.sha256(dades).hexdigest()}.{_format(dades)}"
+    cami = cami_original(nom)
+    if os.path.exists(cami):
+        operacions.inc("desar", "existent")
+    else:
+        _escriure(cami, dades)
+        operacions.inc("desar", "nova")
+    return nom
+
+
+def llegir_data_uri(valor):
+    capcalera, _, cos = valor.partition(",")
+    if not capcalera.endswith(";base64"):
+        raise ImatgeNoValida("Les imatges inline han de ser data URI en base64")
+    cos = "".join(cos.split())
+    if len(cos) * 3 // 4 > IMATGES_MIDA_MAXIMA + 2:
+        raise ImatgeNoValida(f"La imatge supera els {IMATGES_MIDA_MAXIMA} bytes")
+    try:
+        return base64.b64decode(cos, validate=True)
+    except binascii.Error:
+        raise ImatgeNoValida("La data URI no és base64 vàlid")
+
+
+def referencia(valor):
+    # Nom del magatzem d'un valor rebut: el nom tal qual o una URL nostra (original o miniatura)
+    if NOM.match(valor):
+        return valor
+    if valor.startswith(IMATGES_URL + "/"):
+        nom = valor[len(IMATGES_URL) + 1:].rsplit("/", 1)[-1]
+        if NOM.match(nom):
+            return nom
+    return None
+
+
+def normalitzar_sync(valor):
+    # Valor que es desa a la columna: les data URI van al magatzem i les URL nostres tornen a
+    # ser el nom, perquè sobrevisquin a un canvi d'IMATGES_URL. Les URL externes no es toquen
+    if not valor:
+        return None
+    if valor.startswith("data:"):
+        return desar_sync(llegir_data_uri(valor))
+    return referencia(valor) or valor
+
+
+async def normalitzar(valor):
+    if valor and valor.startswith("data:"):
+        return await anyio.to_thread.run_sync(normalitzar_sync, valor)
+    return normalitzar_sync(valor)
+
+
+async def desar(dades):
+    return await anyio.to_thread.run_sync(desar_sync, dades)
+
+
+def url(valor, amplada=None):
+    # Valor de la columna -> valor de la resposta. amplada: miniatura (les llistes)
+    if not valor:
+        return valor
+    if NOM.match(valor):
+        return f"{IMATGES_URL}/{amplada}/{valor}" if amplada else f"{IMATGES_URL}/{valor}"
+    if amplada and valor.startswith("data:"):
+        # Una fila que la migració 10 encara no ha tret: a les llistes no s'envia
+        return None
+    return valor
+
+
+def url_miniatura(valor):
+    return url(valor, MIDA_LLISTA)
+
+
+def generar_miniatura_sync(original, desti, amplada):
+    with Image.open(original) as imatge:
+        # JPEG: es descodifica directament a una escala propera, molt més ràpid que l'original sencer
+        imatge.draft("RGB", (amplada, amplada * 2))
+        imatge = ImageOps.exif_transpose(imatge)
+        imatge.thumbnail((amplada, amplada * 2))
+        if imatge.mode not in ("RGB", "RGBA"):
+            transparent = "A" in imatge.getbands() or "transparency" in imatge.info
+            imatge = imatge.convert("RGBA" if transparent else "RGB")
+        sortida = io.BytesIO()
+        imatge.save(sortida, "WEBP", quality=QUALITAT_MINIATURA)
+    _escriure(desti, sortida.getvalue())
+
+
+_generant = {}
+_limitador = None
+
+
+async def _generar(original, desti, amplada):
+    global _limitador
+    if _limitador is None:
+        _limitador = anyio.CapacityLimiter(IMATGES_FILS)
+    inici = time.perf_counter()
+    try:
+        await anyio.to_thread.run_sync(generar_miniatura_sync, original, desti, amplada, limiter=_limitador)
+    except (OSError, ValueError, Image.DecompressionBombError) as err:
+        log.warning("No s'ha pogut fer la miniatura de %s: %s", original, err)
+        operacions.inc("miniatura", "error")
+        return False
+    durada_miniatures.observar(time.perf_counter() - inici)
+    operacions.inc("miniatura", "generada")
+    return True
+
+
+async def miniatura(nom, amplada):
+    # (camí, tipus) del fitxer a servir, o None si no hi és. Es genera la primera vegada que es
+    # demana i queda al disc; peticions simultànies de la mateixa esperen una sola generació
+    if amplada not in IMATGES_MIDES or not NOM.match(nom):
+        return None
+    original = cami_original(nom)
+    if not os.path.exists(original):
+        return None
+    desti = cami_miniatura(nom, amplada)
+    if os.path.exists(desti):
+        operacions.inc("miniatura", "disc")
+        return desti, FORMATS["webp"]
+    if Image is None:
+        operacions.inc("miniatura", "sense_pillow")
+        return original, FORMATS[nom.rsplit(".", 1)[1]]
+    tasca = _generant.get(desti)
+    if tasca is None:
+        tasca = asyncio.ensure_future(_generar(original, desti, amplada))
+        _generant[desti] = tasca
+        tasca.add_done_callback(lambda _: _generant.pop(desti, None))
+    # shield: si el client talla, la miniatura s'acaba igualment per als altres
+    if await asyncio.shield(tasca):
+        return desti, FORMATS["webp"]
+    # Imatge que Pillow no sap llegir: millor l'original que res
+    return original, FORMATS[nom.rsplit(".", 1)[1]]
+
+
+def original(nom):
+    if not NOM.match(nom) or not os.path.exists(cami_original(nom)):
+        return None
+    return cami_original(nom), FORMATS[nom.rsplit(".", 1)[1]]
+
+
+def estadistiques():
+    return {"generant": len(_generant), "fils": IMATGES_FILS}
+
+
+registre.afegir_indicadors("popview_imatges", "Miniatures en curs", estadistiques)
+
+
+def extreure_existents_sync(cursor):
+    # Pas de migració: les data URI desades a titol.imatge i usuari.imatge passen al magatzem
+    for taula in TAULES:
+        darrer = 0
+        while True:
+            cursor.execute(f"""
+                SELECT id, imatge FROM {taula}
+                WHERE id > %s AND imatge LIKE %s
+                ORDER BY id LIMIT %s
+            """, (darrer, "data:%", MIDA_LOT_MIGRACIO))
+            files = cursor.fetchall()
+            if not files:
+                break
+            darrer = files[-1][0]
+            canvis = []
+            for fila_id, valor in files:
+                try:
+                    canvis.append((desar_sync(llegir_data_uri(valor)), fila_id))
+                except ImatgeNoValida as err:
+                    # Es queda com està (les llistes ja no l'envien) perquè algú la pugui revisar
+                    log.warning("%s %s: imatge inline no extreta: %s", taula, fila_id, err)
+            if canvis:
+                cursor.executemany(f"UPDATE {taula} SET imatge = %s WHERE id = %s", canvis)
@@ -0,0 +1,207 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from pydantic import ValidationError
+
+from cache import cache, claus_titols
+from db import connexio, tancar_pools, ERRORS_BD
+from etags import versions
+from models import TitolImportacio
+from facetes import classificar_titols
+import imatges
+from valoracions import crear_agregats
+
+# Files per INSERT multi-fila i per transacció
+MIDA_LOT_IMPORTACIO = int(os.getenv('MIDA_LOT_IMPORTACIO', '1000'))
+# Errors que es detallen a l'informe; la resta només es compten
+MAX_ERRORS_INFORME = 1000
+
+COLUMNES = ("id", "imatge", "nom", "descripcio", "plataformes", "rating", "comentaris", "genero", "edadRecomendada")
+
+# Un id NULL fa que AUTO_INCREMENT n'assigni un de nou
+FILA = f"({', '.join(['%s'] * len(COLUMNES))})"
+# Amb {} per a les files, per als INSERT multi-fila
+SQL_INSERT_FILES = f"INSERT INTO titol ({', '.join(COLUMNES)}) VALUES {{}}"
+SQL_INSERT = SQL_INSERT_FILES.format(FILA)
+# Els títols sense id: RETURNING torna l'id de cada fila, en l'ordre de VALUES
+SQL_INSERT_NOUS = SQL_INSERT_FILES + " RETURNING id"
+SQL_DUPLICATS = " ON DUPLICATE KEY UPDATE " + ", ".join(
+    f"{columna} = VALUES({columna})" for columna in COLUMNES if columna != "id"
+)
+SQL_UPSERT = SQL_INSERT + SQL_DUPLICATS
+
+
+def valors(titol):
+    return (
+        titol.id,
+        titol.imatge or None,
+        titol.nom,
+        titol.descripcio or None,
+        titol.plataformes,
+        titol.rating,
+        titol.comentaris or None,
+        titol.genero or None,
+        titol.edadRecomendada or None,
+    )
+
+
+class InformeImportacio:
+    def __init__(self):
+        self.rebudes = 0
+        self.desades = 0
+        self.lots = 0
+        self.errors_totals = 0
+        self.errors = []
+
+    def error(self, fila, missatge):
+        self.errors_totals += 1
+        if len(self.errors) < MAX_ERRORS_INFORME:
+            self.errors.append({"fila": fila, "error": missatge})
+
+    def dict(self):
+        return {
+            "rebudes": self.rebudes,
+            "desades": self.desades,
+            "lots": self.lots,
+            "errors_totals": self.errors_totals,
+            "errors": self.errors,
+        }
+
+
+async def _enumerar(files):
+    numero = 0
+    if hasattr(files, "__aiter__"):
+        async for fila in files:
+            numero += 1
+            yield numero, fila
+    else:
+        for fila in files:
+            numero += 1
+            yield numero, fila
+
+
+def _validar(fila):
+    if isinstance(fila, (str, bytes)):
+        fila = json.loads(fila)
+    if not isinstance(fila, dict):
+        raise ValueError("Cada fila ha de ser un objecte JSON")
+    return TitolImportacio(**fila)
+
+
+async def _desar_lot(lot, upsert, informe):
+    sql = SQL_UPSERT if upsert else SQL_INSERT
+    async with connexio() as db:
+        try:
+            explicits = [titol for _, titol in lot if titol.id is not None]
+            nous = [titol for _, titol in lot if titol.id is None]
+            ids = [titol.id for titol in explicits]
+            # Un upsert pot reescriure títols que ja són a la memòria cau
+            claus = await claus_titols(db, ids) if upsert else []
+            if explicits:
+                await db.executemany(sql, [valors(titol) for titol in explicits])
+            if nous:
+                # Una sola sentència, no executemany (aiomysql el pot partir). Els ids surten de
+                # RETURNING i no de lastrowid: no depenen que siguin consecutius (innodb_autoinc_lock_mode,
+                # auto_increment_increment). Amb id NULL no hi pot haver duplicats, així que no cal SQL_DUPLICATS
+                files = await db.fetchall(SQL_INSERT_NOUS.format(", ".join([FILA] * len(nous))),
+                                          tuple(valor for titol in nous for valor in valors(titol)))
+                ids += [fila["id"] for fila in files]
+            await crear_agregats(db, ids)
+            await classificar_titols(db, f"id IN ({', '.join(['%s'] * len(ids))})", tuple(ids))
+            await versions.incrementar(db, "titol")
+            await db.commit()
+            if claus:
+                await cache.invalidar(*claus)
+            informe.desades += len(lot)
+        except ERRORS_BD:
+            await db.rollback()
+            # Un error de base de dades anul·la tot el lot: es repeteix fila a fila per
+            # desar les bones i saber exactament quines fallen
+            for numero, titol in lot:
+                try:
+                    claus = await claus_titols(db, [titol.id]) if upsert and titol.id is not None else []
+                    resultat = await db.execute(sql, valors(titol))
+                    await crear_agregats(db, [titol.id or resultat.lastrowid])
+                    await classificar_titols(db, "id = %s", (titol.id or resultat.lastrowid,))
+                    await versions.incrementar(db, "titol")
+                    await db.commit()
+                    if claus:
+                        await cache.invalidar(*claus)
+                    informe.desades += 1
+                except ERRORS_BD as err:
+                    await db.rollback()
+                    informe.error(numero, str(err))
+    informe.lots += 1
+
+
+async def importar_titols(files, mida_lot=MIDA_LOT_IMPORTACIO, upsert=False):
+    # files pot ser iterable o iterable async de dicts o de línies JSON (NDJSON)
+    informe = InformeImportacio()
+    lot = []
+    async for numero, fila in _enumerar(files):
+        if isinstance(fila, (str, bytes)) and not fila.strip():
+            continue
+        informe.rebudes += 1
+        try:
+            titol = _validar(fila)
+            # Les data URI passen al magatzem d'imatges com a crear_titol; una d'invàlida és un error de la fila
+            titol.imatge = await imatges.normalitzar(titol.imatge)
+            lot.append((numero, titol))
+        except (ValidationError, ValueError) as err:
+            informe.error(numero, str(err))
+            continue
+        if len(lot) >= mida_lot:
+            await _desar_lot(lot, upsert, informe)
+            lot = []
+    if lot:
+        await _desar_lot(lot, upsert, informe)
+    return informe
+
+
+async def linies_ndjson(stream):
+    # Parteix un flux de bytes en línies sense carregar-lo sencer a memòria
+    pendent = b""
+    async for tros in stream:
+        pendent += tros
+        *linies, pendent = pendent.split(b"\n")
+        for linia in linies:
+            yield linia
+    if pendent:
+        yield pendent
+
+
+def _llegir_fitxer(cami):
+    with open(cami, "rb") as fitxer:
+        inici = fitxer.read(1)
+        while inici.isspace():
+            inici = fitxer.read(1)
+        fitxer.seek(0)
+        if inici == b"[":
+            yield from json.load(fitxer)
+        else:
+            yield from fitxer
+
+
+def principal(args=None):
+    parser = argparse.ArgumentParser(description="Importa títols des d'un fitxer JSON (array) o NDJSON")
+    parser.add_argument("fitxer")
+    parser.add_argument("--lot", type=int, default=MIDA_LOT_IMPORTACIO, help="Files per lot")
+    parser.add_argument("--upsert", action="store_true", help="Actualitza els títols que ja existeixen (per id)")
+    args = parser.parse_args(args)
+
+    async def executar():
+        try:
+            return await importar_titols(_llegir_fitxer(args.fitxer), args.lot, args.upsert)
+        finally:
+            await tancar_pools()
+
+    informe = asyncio.run(executar())
+    print(json.dumps(informe.dict(), indent=2, ensure_ascii=False))
+    return 0 if informe.errors_totals == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(principal())
@@ -1,545 +1,934 @@
-from fastapi import FastAPI, HTTPException
-import mysql.connector
-from models import UsuariCreate, Usuari, UsuariUpdate, LlistaCreate, Llista, LlistaUpdate, TitolCreate, Titol, ComentarioCreate, ComentarioUpdate, RatingUpdate
-from db import get_db_connection
-from typing import List
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from models import UsuariCreate, Usuari, Credencials, UsuariExpandit, UsuariUpdate, LlistaCreate, Llista, LlistaExpandida, LlistaUpdate, TitolCreate, Titol, TitolsLot, Comentari, ComentarioCreate, ComentarioUpdate, RatingUpdate
+from db import MiddlewareLectures, iniciar_repliques, connexio, transaccio, consultar_un, consultar_tots, tancar_pools, estadistiques_pool, preparada, sql_actualitzacio, codi_error, taula_referenciada, ERRORS_BD, ERROR_DUPLICAT, ERROR_FK
+from cache import cache, clau_cache, invalidar, invalidar_titols
+from metriques import MiddlewareMetriques, registre
+from compressio import MiddlewareCompressio, resposta_instantania
+from serialitzacio import a_json, projectar, resposta_json
+from etags import versions, condicional
+import salut
+import credencials
+from credencials import CredencialsSaturades
+import imatges
+from imatges import ImatgeNoValida
+from relacions import RELACIONS_LLISTA, RELACIONS_USUARI, llegir_relacions, llegir_camps, carregar_relacions, resposta_expandida
+from valoracions import FROM_TITOL, COLUMNES_TITOL, JOIN_VALORACIO, aplicar_canvis, rating_actual, valoracio_actual, crear_agregats, moment_valoracio
+from comentaris import ORDRES as ORDRES_COMENTARIS, consulta_feed, clau_cursor
+from facetes import condicio, sql_facetes, classificar_titols
+from recomanacions import SQL_RECOMANACIONS, SQL_SEMBLANTS, SQL_MILLOR_VALORATS, marcar_pendents
+from cerca import consulta_booleana, consulta_cerca
+from valoracions_diferides import buffer_valoracions
+from importacio import importar_titols, linies_ndjson, MIDA_LOT_IMPORTACIO
+from paginacio import LIMIT_PER_DEFECTE, LIMIT_MAXIM, MIDA_LOT_STREAM, decodificar_cursor, cursor_seguent, afegir_capcaleres_paginacio
+from typing import List, Optional
 
 app = FastAPI()
+# Rèplica o primària per a cada petició (db.py); va per dins de tot
+app.add_middleware(MiddlewareLectures)
+# Les mètriques van per fora: mesuren els bytes ja comprimits
+app.add_middleware(MiddlewareCompressio)
+app.add_middleware(MiddlewareMetriques)
+registre.afegir_indicadors("popview_pool", "Estat del pool de connexions", estadistiques_pool)
+registre.afegir_indicadors("popview_cache", "Estat de la cache", cache.estadistiques)
+
+# Títols que es poden afegir o treure d'una llista en una sola petició
+MAX_TITOLS_LOT = 1000
+# Resultats per pàgina de /titols/cerca si no es demana limit
+LIMIT_CERCA = 20
+
+# Consultes fixes de les rutes més freqüents: en mode sync es preparen un cop per connexió
+SQL_TITOL = preparada(f"{FROM_TITOL} WHERE t.id = %s")
+SQL_LLISTA = preparada("SELECT * FROM llista WHERE id = %s")
+# Columnes públiques de l'usuari: la contrasenya només es llegeix per verificar-la
+COLUMNES_USUARI = "id, nom, imatge, edat, correu"
+SQL_USUARI = preparada(f"SELECT {COLUMNES_USUARI} FROM usuari WHERE id = %s")
+SQL_PAGINA_LLISTES = preparada("SELECT * FROM llista WHERE id > %s ORDER BY id LIMIT %s")
+SQL_PAGINA_USUARIS = preparada(f"SELECT {COLUMNES_USUARI} FROM usuari WHERE id > %s ORDER BY id LIMIT %s")
+SQL_CREDENCIALS = preparada("SELECT id, contrasenya FROM usuari WHERE correu = %s")
+SQL_AFEGIR_TITOL_LLISTA = preparada("INSERT INTO llista_titol (llista_id, titol_id) VALUES (%s, %s)")
+SQL_TITOLS_DE_LLISTA = preparada(f"""
+    SELECT {COLUMNES_TITOL}
+    FROM titol t
+    JOIN llista_titol lt ON t.id = lt.titol_id
+    {JOIN_VALORACIO}
+    WHERE lt.llista_id = %s
+""")
+SQL_LLISTES_PUBLIQUES = preparada("SELECT * FROM llista WHERE privada = FALSE")
+SQL_LLISTES_USUARI = preparada("""
+    SELECT l.*
+    FROM llista l
+    JOIN usuari_llista ul ON l.id = ul.llista_id
+    WHERE ul.usuari_id = %s
+""")
+SQL_COMENTARI_USUARI = preparada("""
+    SELECT comentaris, rating
+    FROM usuari_titol
+    WHERE usuari_id = %s AND titol_id = %s
+""")
+# Escriptures: les lectures amb bloqueig i els lots, amb {} per als marcadors de l'IN
+SQL_BLOQUEJAR_LLISTA = preparada("SELECT id FROM llista WHERE id = %s FOR UPDATE")
+SQL_TITOLS_EXISTENTS = "SELECT id FROM titol WHERE id IN ({}) LOCK IN SHARE MODE"
+SQL_AFEGIR_TITOLS_LLISTA = "INSERT IGNORE INTO llista_titol (llista_id, titol_id) VALUES {} RETURNING titol_id"
+SQL_TREURE_TITOLS_LLISTA = "DELETE FROM llista_titol WHERE llista_id = %s AND titol_id IN ({}) RETURNING titol_id"
+SQL_VALORACIONS_USUARI = preparada("""
+    SELECT titol_id, rating, comentaris IS NOT NULL AS te_comentari
+    FROM usuari_titol
+    WHERE usuari_id = %s AND (rating IS NOT NULL OR comentaris IS NOT NULL)
+    FOR UPDATE
+""")
+# Actualitzacions parcials amb una sola forma per taula (NULL = no es toca)
+SQL_ACTUALITZAR_LLISTA = sql_actualitzacio("llista", ["titol", "descripcio", "privada"], "id = %s")
+SQL_ACTUALITZAR_USUARI = sql_actualitzacio("usuari", ["nom", "imatge", "edat", "correu", "contrasenya"], "id = %s")
+# Com les altres actualitzacions parcials, però comentat avança quan arriba un comentari nou
+SQL_ACTUALITZAR_COMENTARI = preparada("""
+    UPDATE usuari_titol
+    SET comentaris = COALESCE(%s, comentaris), rating = COALESCE(%s, rating),
+        comentat = IF(%s IS NULL, comentat, NOW(6)), valorat = IF(%s IS NULL, valorat, %s)
+    WHERE usuari_id = %s AND titol_id = %s
+""")
+
+@app.on_event("startup")
+async def escalfar():
+    # Primera comprovació de les rèpliques (DB_REPLIQUES) i vigilància periòdica
+    await iniciar_repliques()
+    # Pool obert, versions llegides i consultes de les rutes executades abans de la primera petició
+    await salut.escalfar()
+    # Amb VALORACIONS_DIFERIDES=1: reprodueix els diaris de processos morts i engega el buidatge
+    await buffer_valoracions.iniciar()
+
+@app.on_event("shutdown")
+async def tancar_connexions():
+    salut.estat.tancant = True
+    await buffer_valoracions.aturar()
+    credencials.tancar()
+    await tancar_pools()
+
+@app.get("/salut/viu", include_in_schema=False)
+async def salut_viu():
+    # Liveness: el procés i el bucle d'esdeveniments responen; no toca la base de dades
+    return salut.viu()
+
+@app.get("/salut/preparat", include_in_schema=False)
+async def salut_preparat():
+    # Readiness: 503 fins que acaba l'escalfament, en tancar o si la base de dades no respon
+    preparat, detall = await salut.preparat()
+    return JSONResponse(detall, status_code=200 if preparat else 503)
+
+@app.get("/estat/pool")
+async def estat_pool():
+    return estadistiques_pool()
+
+@app.get("/estat/cache")
+async def estat_cache():
+    return cache.estadistiques()
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    # Format de text de Prometheus
+    return PlainTextResponse(registre.exposicio(), media_type="text/plain; version=0.0.4")
+
+def resposta_ndjson(query, model, headers=None, params=()):
+    # Una fila per línia; el cursor es llegeix per lots i no es carrega mai la taula sencera.
+    # És una llista: les imatges surten com a miniatures, igual que a resposta_json
+    async def generar():
+        async with connexio() as db:
+            async for fila in db.iterar(query, params, mida_lot=MIDA_LOT_STREAM):
+                yield a_json(projectar(fila, model, miniatures=True)) + b"\n"
+    return StreamingResponse(generar(), media_type="application/x-ndjson", headers=headers)
+
+def llegir_cursor(after, mida):
+    try:
+        valors = decodificar_cursor(after)
+        if len(valors) != mida or not all(isinstance(valor, (int, float)) for valor in valors):
+            raise ValueError
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor no vàlid")
+    return valors
+
+def filtres_facetes(plataforma, genero):
+    return {nom: valor for nom, valor in (("plataforma", plataforma), ("genero", genero)) if valor}
+
+def consulta_titols(ordre, filtres, despres, limit):
+    # Pàgina de /titols/ (sense stream); despres és el cursor llegit o None
+    on = "".join(f" AND {condicio(nom)}" for nom in filtres)
+    params = tuple(filtres.values())
+    if ordre == "valoracio":
+        # Recorre l'índex (mitjana DESC, titol_id) de titol_valoracio i hi uneix els títols per PK
+        consulta = f"SELECT {COLUMNES_TITOL}, v.mitjana AS _mitjana FROM titol_valoracio v JOIN titol t ON t.id = v.titol_id"
+        consulta += " WHERE TRUE" + on
+        if despres is not None:
+            mitjana, after_id = despres
+            consulta += " AND (v.mitjana < %s OR (v.mitjana = %s AND v.titol_id > %s))"
+            params += (mitjana, mitjana, after_id)
+        return consulta + " ORDER BY v.mitjana DESC, v.titol_id LIMIT %s", params + (limit,)
+    return f"{FROM_TITOL} WHERE TRUE{on} AND t.id > %s ORDER BY t.id LIMIT %s", params + (despres or 0, limit)
+
+def error_bd(err, context, no_trobats=None, duplicat=None):
+    # Les escriptures confien en les claus foranes i úniques en lloc de fer SELECT previs.
+    # no_trobats: {taula pare: missatge del 404}; duplicat: missatge del 400
+    codi = codi_error(err)
+    if codi == ERROR_FK and no_trobats:
+        return HTTPException(status_code=404, detail=no_trobats.get(taula_referenciada(err), "Referència no trobada"))
+    if codi == ERROR_DUPLICAT and duplicat:
+        return HTTPException(status_code=400, detail=duplicat)
+    return HTTPException(status_code=500, detail=f"{context}: {err}")
+
+def id_despres_de(after):
+    if after is None:
+        return 0
+    return int(llegir_cursor(after, 1)[0])
+
+# Imatges: magatzem adreçat pel contingut (imatges.py)
+@app.post("/imatges/")
+async def pujar_imatge(request: Request):
+    # El cos és la imatge tal qual (JPEG, PNG, GIF o WebP). La URL retornada es pot desar a imatge
+    dades = bytearray()
+    async for tros in request.stream():
+        dades += tros
+        if len(dades) > imatges.IMATGES_MIDA_MAXIMA:
+            raise HTTPException(status_code=413, detail=f"La imatge supera els {imatges.IMATGES_MIDA_MAXIMA} bytes")
+    try:
+        nom = await imatges.desar(bytes(dades))
+        return {"imatge": imatges.url(nom), "miniatura": imatges.url_miniatura(nom)}
+    except ImatgeNoValida as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al desar la imatge: {str(e)}")
+
+@app.get("/imatges/{nom}", include_in_schema=False)
+async def obtenir_imatge(nom: str):
+    fitxer = imatges.original(nom)
+    if fitxer is None:
+        raise HTTPException(status_code=404, detail="Imatge no trobada")
+    return FileResponse(fitxer[0], media_type=fitxer[1], headers={"Cache-Control": imatges.CACHE_CONTROL})
+
+@app.get("/imatges/{amplada}/{nom}", include_in_schema=False)
+async def obtenir_miniatura(amplada: int, nom: str):
+    # Només les amplades d'IMATGES_MIDES; la primera petició la genera i la deixa al disc
+    try:
+        fitxer = await imatges.miniatura(nom, amplada)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al generar la miniatura: {str(e)}")
+    if fitxer is None:
+        raise HTTPException(status_code=404, detail="Imatge no trobada")
+    return FileResponse(fitxer[0], media_type=fitxer[1], headers={"Cache-Control": imatges.CACHE_CONTROL})
 
 # CRUD Titol
 @app.post("/titols/", response_model=Titol)
-def crear_titol(titol: TitolCreate):
-    try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        cursor.execute("""
-            INSERT INTO titol (imatge, nom, descripcio, plataformes, rating, comentaris, genero, edadRecomendada) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
-            titol.imatge or None, 
-            titol.nom, 
-            titol.descripcio or None, 
-            titol.plataformes, 
-            titol.rating, 
-            titol.comentaris or None, 
-            titol.genero or None,
-            titol.edadRecomendada or None
-        ))
-        db.commit()
-        titol_id = cursor.lastrowid
-        return {"id": titol_id, **titol.dict()}
+async def crear_titol(titol: TitolCreate):
+    try:
+        # Les data URI passen al magatzem d'imatges: a la fila només hi queda el nom
+        imatge = await imatges.normalitzar(titol.imatge)
+        async with transaccio() as db:
+            resultat = await db.execute("""
+                INSERT INTO titol (imatge, nom, descripcio, plataformes, rating, comentaris, genero, edadRecomendada)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, (
+                imatge,
+                titol.nom,
+                titol.descripcio or None,
+                titol.plataformes,
+                titol.rating,
+                titol.comentaris or None,
+                titol.genero or None,
+                titol.edadRecomendada or None
+            ))
+            await crear_agregats(db, [resultat.lastrowid])
+            await classificar_titols(db, "id = %s", (resultat.lastrowid,))
+            await versions.incrementar(db, "titol")
+        titol_id = resultat.lastrowid
+        return {"id": titol_id, **titol.dict(), "imatge": imatge}
+    except ImatgeNoValida as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al crear títol: {str(e)}")
-    finally:
-        if cursor:
-            cursor.close()
-        if db:
-            db.close()
+
+@app.post("/titols/lot")
+async def importar_titols_lot(request: Request, upsert: bool = False,
+                              mida_lot: int = Query(MIDA_LOT_IMPORTACIO, ge=1, le=10000)):
+    # Accepta un array JSON o NDJSON (application/x-ndjson), que es llegeix en streaming
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        files = linies_ndjson(request.stream())
+    else:
+        try:
+            files = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="El cos ha de ser un array JSON o NDJSON")
+        if not isinstance(files, list):
+            raise HTTPException(status_code=400, detail="El cos ha de ser un array JSON o NDJSON")
+    try:
+        informe = await importar_titols(files, mida_lot, upsert)
+        return informe.dict()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error a l'importar títols: {str(e)}")
+
+# Ha d'anar abans de /titols/{titol_id}
+@app.get("/titols/facetes")
+async def obtenir_facetes(request: Request, response: Response,
+                          plataforma: Optional[str] = None, genero: Optional[str] = None):
+    # Títols per plataforma i per gènere; cada dimensió es compta amb els filtres de les altres
+    no_modificat = await condicional(request, response, "titol")
+    if no_modificat:
+        return no_modificat
+    filtres = filtres_facetes(plataforma, genero)
+    try:
+        versio, = await versions.obtenir("titol")
+
+        async def carregar():
+            async with connexio() as db:
+                return {nom: await db.fetchall(sql, params) for nom, (sql, params) in sql_facetes(filtres).items()}
+
+        clau = f"facetes:{versio}:{plataforma or ''}:{genero or ''}"
+        return await cache.obtenir(clau, carregar)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al obtenir les facetes: {str(e)}")
+
+# Ha d'anar abans de /titols/{titol_id}
+@app.get("/titols/cerca", response_model=List[Titol])
+async def cercar_titols(request: Request, response: Response, q: str = Query(..., min_length=1, max_length=255),
+                        es_peli: Optional[bool] = None, plataforma: Optional[str] = None,
+                        genero: Optional[str] = None, edat_maxima: Optional[int] = Query(None, ge=0),
+                        limit: int = Query(LIMIT_CERCA, ge=1, le=LIMIT_MAXIM), after: Optional[str] = None):
+    if not consulta_booleana(q):
+        raise HTTPException(status_code=400, detail="La cerca no conté cap terme")
+    filtres = []
+    if es_peli is not None:
+        filtres.append(("t.es_peli = %s", es_peli))
+    filtres += [(condicio(nom), valor) for nom, valor in filtres_facetes(plataforma, genero).items()]
+    if edat_maxima is not None:
+        filtres.append(("t.edadRecomendada <= %s", edat_maxima))
+    despres = None if after is None else llegir_cursor(after, 2)
+    no_modificat = await condicional(request, response, "titol", "titol_valoracio")
+    if no_modificat:
+        return no_modificat
+    try:
+        consulta, params = consulta_cerca(q, filtres, despres, limit + 1)
+        async with connexio() as db:
+            files = await db.fetchall(consulta, params)
+        titols, seguent = cursor_seguent(files, limit, lambda t: [t["_puntuacio"], t["id"]])
+        afegir_capcaleres_paginacio(request, response, seguent)
+        return resposta_json(titols, Titol, response.headers)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al cercar títols: {str(e)}")
 
 @app.get("/titols/{titol_id}", response_model=Titol)
-def obtenir_titol(titol_id: int):
+async def obtenir_titol(request: Request, response: Response, titol_id: int):
+    no_modificat = await condicional(request, response, "titol", "titol_valoracio")
+    if no_modificat:
+        return no_modificat
     try:
-        db = get_db_connection()
-        cursor = db.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM titol WHERE id = %s", (titol_id,))
-        titol = cursor.fetchone()
+        titol = await cache.obtenir(clau_cache("titol", titol_id),
+                                    lambda: consultar_un(SQL_TITOL, (titol_id,)))
         if titol is None:
             raise HTTPException(status_code=404, detail="Título no encontrado")
-        return titol
+        return resposta_json(titol, Titol, response.headers, un=True)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener el título: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
+
+@app.get("/titols/{titol_id}/semblants", response_model=List[Titol])
+async def obtenir_titols_semblants(request: Request, response: Response, titol_id: int,
+                                   limit: int = Query(LIMIT_CERCA, ge=1, le=LIMIT_MAXIM)):
+    # Veïns precalculats per recomanacions.py
+    no_modificat = await condicional(request, response, "titol_vei", "titol", "titol_valoracio")
+    if no_modificat:
+        return no_modificat
+    try:
+        titols = await consultar_tots(SQL_SEMBLANTS, (titol_id, limit))
+        return resposta_json(titols, Titol, response.headers)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al obtenir títols semblants: {str(e)}")
 
 @app.get("/titols/", response_model=List[Titol])
-def obtenir_tots_els_titols():
+async def obtenir_tots_els_titols(request: Request, response: Response,
+                                  limit: int = Query(LIMIT_PER_DEFECTE, ge=1, le=LIMIT_MAXIM),
+                                  after: Optional[str] = None, stream: bool = False, ordre: str = "id",
+                                  plataforma: Optional[str] = None, genero: Optional[str] = None):
+    if ordre not in ("id", "valoracio"):
+        raise HTTPException(status_code=400, detail="ordre ha de ser 'id' o 'valoracio'")
+    # Filtres per les taules normalitzades (facetes.py), que es resolen per índex
+    filtres = filtres_facetes(plataforma, genero)
+    on = "".join(f" AND {condicio(nom)}" for nom in filtres)
+    no_modificat = await condicional(request, response, "titol", "titol_valoracio")
+    if no_modificat:
+        return no_modificat
+    if stream:
+        return resposta_ndjson(f"{FROM_TITOL} WHERE TRUE{on} ORDER BY t.id", Titol, response.headers,
+                               tuple(filtres.values()))
+    if ordre == "valoracio":
+        despres = None if after is None else llegir_cursor(after, 2)
+        clau = lambda t: [t["_mitjana"], t["id"]]
+    else:
+        despres = id_despres_de(after)
+        clau = lambda t: [t["id"]]
+    consulta, params = consulta_titols(ordre, filtres, despres, limit + 1)
+
     try:
-        db = get_db_connection()
-        cursor = db.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM titol")
-        titols = cursor.fetchall()
-        return titols
+        # Sense instantània: l'ETag inclou titol_valoracio, que canvia amb cada rating, i la
+        # pàgina precomprimida gairebé no es tornaria a servir
+        async with connexio() as db:
+            files = await db.fetchall(consulta, params)
+        titols, seguent = cursor_seguent(files, limit, clau)
+        afegir_capcaleres_paginacio(request, response, seguent)
+        return resposta_json(titols, Titol, response.headers)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener los títulos: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 
 @app.delete("/titols/{titol_id}")
-def eliminar_titol(titol_id: int):
+async def eliminar_titol(titol_id: int):
     try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        cursor.execute("DELETE FROM titol WHERE id = %s", (titol_id,))
-        db.commit()
-        if cursor.rowcount == 0:
+        async with transaccio() as db:
+            await invalidar_titols(db, [titol_id])
+            resultat = await db.execute("DELETE FROM titol WHERE id = %s", (titol_id,))
+            await versions.incrementar(db, "titol", "llista_titol", "usuari_titol")
+        if resultat.rowcount == 0:
             raise HTTPException(status_code=404, detail="Títol no trobat")
         return {"message": "Títol eliminat correctament"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al eliminar títol: {str(e)}")
-    finally:
-        if cursor:
-            cursor.close()
-        if db:
-            db.close()
+def ids_del_lot(lot):
+    ids = list(dict.fromkeys(lot.titols))
+    if not ids:
+        raise HTTPException(status_code=400, detail="La llista de títols és buida")
+    if len(ids) > MAX_TITOLS_LOT:
+        raise HTTPException(status_code=400, detail=f"Com a màxim {MAX_TITOLS_LOT} títols per petició")
+    return ids
+
+@app.post("/llistes/{llista_id}/titols/lot")
+async def afegir_titols_a_llista(llista_id: int, lot: TitolsLot):
+    ids = ids_del_lot(lot)
+    marcadors = ", ".join(["%s"] * len(ids))
+    try:
+        async with transaccio() as db:
+            # La fila de la llista queda bloquejada fins al commit: dos lots a la mateixa llista
+            # s'apliquen un darrere l'altre i la llista no es pot esborrar pel mig
+            if await db.fetchone(SQL_BLOQUEJAR_LLISTA, (llista_id,)) is None:
+                raise HTTPException(status_code=404, detail="Llista no trobada")
+            # LOCK IN SHARE MODE: cap títol del lot no es pot esborrar abans de l'INSERT
+            existents = {fila["id"] for fila in await db.fetchall(SQL_TITOLS_EXISTENTS.format(marcadors), tuple(ids))}
+            inserits = set()
+            if existents:
+                # RETURNING només torna les files inserides: les que IGNORE salta ja hi eren
+                files = await db.fetchall(SQL_AFEGIR_TITOLS_LLISTA.format(", ".join(["(%s, %s)"] * len(existents))),
+                                          tuple(valor for titol_id in sorted(existents) for valor in (llista_id, titol_id)))
+                inserits = {fila["titol_id"] for fila in files}
+            afegits = [titol_id for titol_id in ids if titol_id in inserits]
+            if afegits:
+                await marcar_pendents(db, titols=afegits, llista_id=llista_id)
+                invalidar(db, "llista_titols", [llista_id])
+                await versions.incrementar(db, "llista_titol")
+        return {
+            "afegits": afegits,
+            "ja_presents": [titol_id for titol_id in ids if titol_id in existents and titol_id not in inserits],
+            "inexistents": [titol_id for titol_id in ids if titol_id not in existents],
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al afegir títols a la llista: {str(e)}")
+
+@app.delete("/llistes/{llista_id}/titols/lot")
+async def eliminar_titols_de_llista(llista_id: int, lot: TitolsLot):
+    ids = ids_del_lot(lot)
+    marcadors = ", ".join(["%s"] * len(ids))
+    try:
+        async with transaccio() as db:
+            # RETURNING diu quins hi eren sense un SELECT previ
+            files = await db.fetchall(SQL_TREURE_TITOLS_LLISTA.format(marcadors), (llista_id, *ids))
+            presents = {fila["titol_id"] for fila in files}
+            eliminats = [titol_id for titol_id in ids if titol_id in presents]
+            if eliminats:
+                await marcar_pendents(db, titols=eliminats, llista_id=llista_id)
+                invalidar(db, "llista_titols", [llista_id])
+                await versions.incrementar(db, "llista_titol")
+        return {
+            "eliminats": eliminats,
+            "no_presents": [titol_id for titol_id in ids if titol_id not in presents],
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al eliminar títols de la llista: {str(e)}")
+
 @app.delete("/llistes/{llista_id}/titols/{titol_id}")
-def eliminar_titol_de_llista(llista_id: int, titol_id: int):
-    try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        # Usar el nombre correcto de la tabla: llista_titol
-        cursor.execute("DELETE FROM llista_titol WHERE llista_id = %s AND titol_id = %s", (llista_id, titol_id))
-        db.commit()
-        if cursor.rowcount == 0:
+async def eliminar_titol_de_llista(llista_id: int, titol_id: int):
+    try:
+        async with transaccio() as db:
+            # Usar el nombre correcto de la tabla: llista_titol
+            resultat = await db.execute("DELETE FROM llista_titol WHERE llista_id = %s AND titol_id = %s", (llista_id, titol_id))
+            if resultat.rowcount:
+                await marcar_pendents(db, titols=[titol_id], llista_id=llista_id)
+                invalidar(db, "llista_titols", [llista_id])
+            await versions.incrementar(db, "llista_titol")
+        if resultat.rowcount == 0:
             raise HTTPException(status_code=404, detail="Relació no trobada")
         return {"message": "Títol eliminat de la llista"}
-    except mysql.connector.Error as err:
+    except ERRORS_BD as err:
         raise HTTPException(status_code=500, detail=f"Error de base de dades: {err}")
-    finally:
-        if cursor:
-            cursor.close()
-        if db:
-            db.close()
 
 
 # CRUD Llista
 @app.post("/llistes/", response_model=Llista)
-def crear_llista(llista: LlistaCreate):
+async def crear_llista(llista: LlistaCreate):
     try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        
-        # Verificar que el usuario existe
-        cursor.execute("SELECT * FROM usuari WHERE id = %s", (llista.usuari_id,))
-        usuari = cursor.fetchone()
-
-        if not usuari:
-            raise HTTPException(status_code=404, detail="Usuari no trobat")
-        
-        # Crear la lista (QUITAMOS usuari_id de la inserción)
-        cursor.execute("""
-            INSERT INTO llista (titol, descripcio, privada) 
-            VALUES (%s, %s, %s)
-        """, (llista.titol, llista.descripcio, llista.privada))
-        db.commit()
-        llista_id = cursor.lastrowid
-
-        # Insertar en la tabla intermedia para vincular usuario y lista
-        cursor.execute("""
-            INSERT INTO usuari_llista (usuari_id, llista_id)
-            VALUES (%s, %s)
-        """, (llista.usuari_id, llista_id))
-        db.commit()
+        async with transaccio() as db:
+            # Crear la lista (QUITAMOS usuari_id de la inserción)
+            resultat = await db.execute("""
+                INSERT INTO llista (titol, descripcio, privada)
+                VALUES (%s, %s, %s)
+            """, (llista.titol, llista.descripcio, llista.privada))
+            llista_id = resultat.lastrowid
+
+            # Vincular usuario y lista; la clau forana comprova que l'usuari existeix
+            await db.execute("""
+                INSERT INTO usuari_llista (usuari_id, llista_id)
+                VALUES (%s, %s)
+            """, (llista.usuari_id, llista_id))
+            await versions.incrementar(db, "llista", "usuari_llista")
 
         return {"id": llista_id, **llista.dict()}
-    
+    except ERRORS_BD as err:
+        raise error_bd(err, "Error al crear llista", {"usuari": "Usuari no trobat"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al crear llista: {str(e)}")
-    
-    finally:
-        cursor.close()
-        db.close()
 
 @app.post("/llistes/{llista_id}/titols/{titol_id}", response_model=dict)
-def afegir_titol_a_llista(llista_id: int, titol_id: int):
+async def afegir_titol_a_llista(llista_id: int, titol_id: int):
     try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        # Verificar si la lista y el título existen
-        cursor.execute("SELECT * FROM llista WHERE id = %s", (llista_id,))
-        if cursor.fetchone() is None:
-            raise HTTPException(status_code=404, detail="Llista no trobada")
-        cursor.execute("SELECT * FROM titol WHERE id = %s", (titol_id,))
-        if cursor.fetchone() is None:
-            raise HTTPException(status_code=404, detail="Títol no trobat")
-        # Verificar si el título ya está en la lista
-        cursor.execute("SELECT * FROM llista_titol WHERE llista_id = %s AND titol_id = %s", (llista_id, titol_id))
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="El títol ja està en la llista")
-        # Insertar el título en la lista
-        cursor.execute("INSERT INTO llista_titol (llista_id, titol_id) VALUES (%s, %s)", (llista_id, titol_id))
-        db.commit()
+        async with transaccio() as db:
+            # Les claus foranes diuen si la llista o el títol no existeixen, i la clau primària
+            # si el títol ja hi era
+            await db.execute(SQL_AFEGIR_TITOL_LLISTA, (llista_id, titol_id))
+            await marcar_pendents(db, titols=[titol_id], llista_id=llista_id)
+            invalidar(db, "llista_titols", [llista_id])
+            await versions.incrementar(db, "llista_titol")
         return {"message": "Títol afegit a la llista correctament"}
+    except ERRORS_BD as err:
+        raise error_bd(err, "Error al afegir títol a la llista",
+                       {"llista": "Llista no trobada", "titol": "Títol no trobat"}, "El títol ja està en la llista")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al afegir títol a la llista: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 
 @app.get("/llistes/{llista_id}", response_model=Llista)
-def obtenir_llista(llista_id: int):
+async def obtenir_llista(llista_id: int, include: Optional[str] = None, expand: Optional[str] = None,
+                         fields: Optional[str] = None):
+    incloure = llegir_relacions(include, RELACIONS_LLISTA, "include")
+    expandir = llegir_relacions(expand, RELACIONS_LLISTA, "expand")
+    camps = llegir_camps(fields, LlistaExpandida)
     try:
-        db = get_db_connection()
-        cursor = db.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM llista WHERE id = %s", (llista_id,))
-        llista = cursor.fetchone()
+        llista = await cache.obtenir(clau_cache("llista", llista_id),
+                                     lambda: consultar_un(SQL_LLISTA, (llista_id,)))
         if llista is None:
             raise HTTPException(status_code=404, detail="Llista no trobada")
-        return llista
+        if not (incloure or expandir or camps):
+            return llista
+        # Còpia perquè la fila de la memòria cau no es modifiqui
+        llista = dict(llista)
+        async with connexio() as db:
+            await carregar_relacions(db, [llista], RELACIONS_LLISTA, incloure, expandir)
+        return resposta_expandida([llista], LlistaExpandida, camps, incloure, expandir, un=True)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtenir llista: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 
 @app.get("/llistes/", response_model=List[Llista])
-def obtenir_totes_les_llistes():
+async def obtenir_totes_les_llistes(request: Request, response: Response,
+                                    limit: int = Query(LIMIT_PER_DEFECTE, ge=1, le=LIMIT_MAXIM),
+                                    after: Optional[str] = None, stream: bool = False,
+                                    include: Optional[str] = None, expand: Optional[str] = None,
+                                    fields: Optional[str] = None):
+    if stream:
+        return resposta_ndjson("SELECT * FROM llista ORDER BY id", Llista)
+    after_id = id_despres_de(after)
+    incloure = llegir_relacions(include, RELACIONS_LLISTA, "include")
+    expandir = llegir_relacions(expand, RELACIONS_LLISTA, "expand")
+    camps = llegir_camps(fields, LlistaExpandida)
     try:
-        db = get_db_connection()
-        cursor = db.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM llista")
-        llistes = cursor.fetchall()
-        return llistes
+        async with connexio() as db:
+            files = await db.fetchall(SQL_PAGINA_LLISTES, (after_id, limit + 1))
+            llistes, seguent = cursor_seguent(files, limit, lambda l: [l["id"]])
+            if incloure or expandir:
+                await carregar_relacions(db, llistes, RELACIONS_LLISTA, incloure, expandir)
+        if incloure or expandir or camps:
+            response = resposta_expandida(llistes, LlistaExpandida, camps, incloure, expandir)
+            afegir_capcaleres_paginacio(request, response, seguent)
+            return response
+        afegir_capcaleres_paginacio(request, response, seguent)
+        return resposta_json(llistes, Llista, response.headers)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtenir llistes: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 @app.get("/llistes/publicas/", response_model=List[Llista])
-def obtenir_llistes_publicas():
+async def obtenir_llistes_publicas(request: Request, response: Response):
+    no_modificat = await condicional(request, response, "llista")
+    if no_modificat:
+        return no_modificat
+
+    async def generar():
+        async with connexio() as db:
+            # Filtrar las listas donde el campo `privada` es False
+            llistes = await db.fetchall(SQL_LLISTES_PUBLIQUES)
+        return resposta_json(llistes, Llista, response.headers)
     try:
-        db = get_db_connection()
-        cursor = db.cursor(dictionary=True)
-        # Filtrar las listas donde el campo `privada` es False
-        cursor.execute("SELECT * FROM llista WHERE privada = FALSE")
-        llistes = cursor.fetchall()
-        return llistes
+        return await resposta_instantania(request, response, generar)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener listas públicas: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 
 @app.get("/usuaris/{usuari_id}/llistes", response_model=List[Llista])
-def obtenir_llistes_per_usuari(usuari_id: int):
-    try:
-        db = get_db_connection()
-        cursor = db.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT l.*
-            FROM llista l
-            JOIN usuari_llista ul ON l.id = ul.llista_id
-            WHERE ul.usuari_id = %s
-        """, (usuari_id,))
-        llistes = cursor.fetchall()
+async def obtenir_llistes_per_usuari(usuari_id: int):
+    try:
+        async with connexio() as db:
+            llistes = await db.fetchall(SQL_LLISTES_USUARI, (usuari_id,))
         if not llistes:
             raise HTTPException(status_code=404, detail="No s'han trobat llistes per aquest usuari")
-        return llistes
+        return resposta_json(llistes, Llista)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtenir llistes per usuari: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
+
+@app.get("/usuaris/{usuari_id}/recomanacions", response_model=List[Titol])
+async def obtenir_recomanacions(request: Request, response: Response, usuari_id: int,
+                                limit: int = Query(LIMIT_CERCA, ge=1, le=LIMIT_MAXIM)):
+    # Precalculades per recomanacions.py; qui encara no en té rep els millor valorats
+    no_modificat = await condicional(request, response, "usuari_recomanacio", "titol", "titol_valoracio")
+    if no_modificat:
+        return no_modificat
+    try:
+        titols = await consultar_tots(SQL_RECOMANACIONS, (usuari_id, limit))
+        if not titols:
+            titols = await consultar_tots(SQL_MILLOR_VALORATS, (limit,))
+        return resposta_json(titols, Titol, response.headers)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al obtenir les recomanacions: {str(e)}")
 
 @app.get("/llistes/{llista_id}/titols", response_model=List[Titol])
-def obtenir_titols_de_llista(llista_id: int):
-    try:
-        db = get_db_connection()
-        cursor = db.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT t.*
-            FROM titol t
-            JOIN llista_titol lt ON t.id = lt.titol_id
-            WHERE lt.llista_id = %s
-        """, (llista_id,))
-        titols = cursor.fetchall()
+async def obtenir_titols_de_llista(request: Request, response: Response, llista_id: int):
+    no_modificat = await condicional(request, response, "llista_titol", "titol", "titol_valoracio")
+    if no_modificat:
+        return no_modificat
+    try:
+        titols = await cache.obtenir(clau_cache("llista_titols", llista_id),
+                                     lambda: consultar_tots(SQL_TITOLS_DE_LLISTA, (llista_id,)))
         if not titols:
             raise HTTPException(status_code=404, detail="No s'han trobat títols per aquesta llista")
-        return titols
+        return resposta_json(titols, Titol, response.headers)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtenir els títols de la llista: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 
 @app.put("/llistes/{llista_id}", response_model=Llista)
-def actualizar_llista(llista_id: int, llista_update: LlistaUpdate):
-    try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        fields = []
-        values = []
-        if llista_update.titol is not None:
-            fields.append("titol = %s")
-            values.append(llista_update.titol)
-        if llista_update.descripcio is not None:
-            fields.append("descripcio = %s")
-            values.append(llista_update.descripcio)
-        if llista_update.privada is not None:
-            fields.append("privada = %s")
-            values.append(llista_update.privada)
-        if not fields:
+async def actualizar_llista(llista_id: int, llista_update: LlistaUpdate):
+    try:
+        values = (llista_update.titol, llista_update.descripcio, llista_update.privada)
+        if all(value is None for value in values):
             raise HTTPException(status_code=400, detail="No hi ha camps per actualitzar")
-        values.append(llista_id)
-        query = f"UPDATE llista SET {', '.join(fields)} WHERE id = %s"
-        cursor.execute(query, tuple(values))
-        db.commit()
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Llista no trobada")
-        cursor.execute("SELECT * FROM llista WHERE id = %s", (llista_id,))
-        llista_actualizada = cursor.fetchone()
+        async with transaccio() as db:
+            resultat = await db.execute(SQL_ACTUALITZAR_LLISTA, (*values, llista_id))
+            # Lectura dins la mateixa transacció: la fila tal com queda, o el 404
+            llista_actualizada = await db.fetchone(SQL_LLISTA, (llista_id,))
+            if llista_actualizada is None:
+                raise HTTPException(status_code=404, detail="Llista no trobada")
+            # rowcount 0 amb la fila present vol dir que no ha canviat res
+            if resultat.rowcount:
+                invalidar(db, "llista", [llista_id])
+                await versions.incrementar(db, "llista")
         return llista_actualizada
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al actualizar llista: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 
 @app.delete("/llistes/{llista_id}")
-def eliminar_llista(llista_id: int):
+async def eliminar_llista(llista_id: int):
     try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        cursor.execute("DELETE FROM llista WHERE id = %s", (llista_id,))
-        db.commit()
+        async with transaccio() as db:
+            await db.execute("DELETE FROM llista WHERE id = %s", (llista_id,))
+            invalidar(db, "llista", [llista_id])
+            invalidar(db, "llista_titols", [llista_id])
+            await versions.incrementar(db, "llista", "llista_titol", "usuari_llista")
         return {"message": "Llista eliminada"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al eliminar llista: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 
 # CRUD Usuari
 @app.post("/usuaris/", response_model=Usuari)
-def crear_usuari(usuari: UsuariCreate):
+async def crear_usuari(usuari: UsuariCreate):
     try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        cursor.execute("INSERT INTO usuari (nom, imatge, edat, correu, contrasenya) VALUES (%s, %s, %s, %s, %s)",
-                       (usuari.nom, usuari.imatge, usuari.edat, usuari.correu, usuari.contrasenya))
-        db.commit()
-        user_id = cursor.lastrowid
-        return {"id": user_id, **usuari.dict()}
+        # El hash es fa fora del bucle i dels fils de les rutes (credencials.py), abans d'agafar connexió
+        contrasenya = await credencials.xifrar(usuari.contrasenya)
+        imatge = await imatges.normalitzar(usuari.imatge)
+        async with transaccio() as db:
+            resultat = await db.execute("INSERT INTO usuari (nom, imatge, edat, correu, contrasenya) VALUES (%s, %s, %s, %s, %s)",
+                                        (usuari.nom, imatge, usuari.edat, usuari.correu, contrasenya))
+            await versions.incrementar(db, "usuari")
+        user_id = resultat.lastrowid
+        return {"id": user_id, **usuari.dict(exclude={"contrasenya"}), "imatge": imatge}
+    except ERRORS_BD as err:
+        raise error_bd(err, "Error al crear usuari", duplicat="Ja hi ha un usuari amb aquest correu")
+    except ImatgeNoValida as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except CredencialsSaturades as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al crear usuari: {str(e)}")
-    finally:
-        if cursor:
-            cursor.close()
-        if db:
-            db.close()
 
 @app.get("/usuaris/{usuari_id}", response_model=Usuari)
-def obtenir_usuari(usuari_id: int):
+async def obtenir_usuari(usuari_id: int, include: Optional[str] = None, expand: Optional[str] = None,
+                         fields: Optional[str] = None):
+    incloure = llegir_relacions(include, RELACIONS_USUARI, "include")
+    expandir = llegir_relacions(expand, RELACIONS_USUARI, "expand")
+    camps = llegir_camps(fields, UsuariExpandit)
     try:
-        db = get_db_connection()
-        cursor = db.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM usuari WHERE id = %s", (usuari_id,))
-        usuari = cursor.fetchone()
+        usuari = await cache.obtenir(clau_cache("usuari", usuari_id),
+                                     lambda: consultar_un(SQL_USUARI, (usuari_id,)))
         if usuari is None:
             raise HTTPException(status_code=404, detail="Usuari no trobat")
-        return usuari
+        if not (incloure or expandir or camps):
+            return usuari
+        usuari = dict(usuari)
+        async with connexio() as db:
+            await carregar_relacions(db, [usuari], RELACIONS_USUARI, incloure, expandir)
+        return resposta_expandida([usuari], UsuariExpandit, camps, incloure, expandir, un=True)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtenir usuari: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 
 @app.get("/usuaris/", response_model=List[Usuari])
-def obtenir_tots_els_usuaris():
+async def obtenir_tots_els_usuaris(request: Request, response: Response,
+                                   limit: int = Query(LIMIT_PER_DEFECTE, ge=1, le=LIMIT_MAXIM),
+                                   after: Optional[str] = None, stream: bool = False):
+    if stream:
+        return resposta_ndjson(f"SELECT {COLUMNES_USUARI} FROM usuari ORDER BY id", Usuari)
+    after_id = id_despres_de(after)
+    no_modificat = await condicional(request, response, "usuari")
+    if no_modificat:
+        return no_modificat
+
+    async def generar():
+        async with connexio() as db:
+            files = await db.fetchall(SQL_PAGINA_USUARIS, (after_id, limit + 1))
+        usuaris, seguent = cursor_seguent(files, limit, lambda u: [u["id"]])
+        afegir_capcaleres_paginacio(request, response, seguent)
+        return resposta_json(usuaris, Usuari, response.headers)
     try:
-        db = get_db_connection()
-        cursor = db.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM usuari")
-        usuaris = cursor.fetchall()
-        return usuaris
+        return await resposta_instantania(request, response, generar)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtenir usuaris: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 
-@app.put("/usuaris/{usuari_id}")
-def actualitzar_usuari(usuari_id: int, usuari_update: UsuariUpdate):
+@app.put("/usuaris/{usuari_id}", response_model=Usuari)
+async def actualitzar_usuari(usuari_id: int, usuari_update: UsuariUpdate):
     try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        fields = []
-        values = []
-        if usuari_update.nom is not None:
-            fields.append("nom = %s")
-            values.append(usuari_update.nom)
-
+        values = (usuari_update.nom, usuari_update.imatge, usuari_update.edat, usuari_update.correu,
+                  usuari_update.contrasenya)
+        if all(value is None for value in values):
+            raise HTTPException(status_code=400, detail="No hi ha camps per actualitzar")
         if usuari_update.imatge is not None:
-            fields.append("imatge = %s")
-            values.append(usuari_update.imatge)
-
-        if usuari_update.edat is not None:
-            fields.append("edat = %s")
-            values.append(usuari_update.edat)
-
-        if usuari_update.correu is not None:
-            fields.append("correu = %s")
-            values.append(usuari_update.correu)
-
+            # Com a crear_usuari. "" (treure la imatge) es desa tal qual: NULL vol dir no tocar-la
+            values = (values[0], await imatges.normalitzar(usuari_update.imatge) or "", *values[2:])
         if usuari_update.contrasenya is not None:
-            fields.append("contrasenya = %s")
-            values.append(usuari_update.contrasenya)
-        if not fields:
-            raise HTTPException(status_code=400, detail="No hi ha camps per actualitzar")
-        values.append(usuari_id)
-        query = f"UPDATE usuari SET {', '.join(fields)} WHERE id = %s"
-        cursor.execute(query, tuple(values))
-        db.commit()
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Usuari no trobat")
-        # Retornar el usuario actualizado
-        cursor.execute("SELECT * FROM usuari WHERE id = %s", (usuari_id,))
-        usuari_actualitzat = cursor.fetchone()
+            values = (*values[:4], await credencials.xifrar(usuari_update.contrasenya))
+        async with transaccio() as db:
+            resultat = await db.execute(SQL_ACTUALITZAR_USUARI, (*values, usuari_id))
+            # Retornar el usuario actualizado, llegit dins la mateixa transacció
+            usuari_actualitzat = await db.fetchone(SQL_USUARI, (usuari_id,))
+            if usuari_actualitzat is None:
+                raise HTTPException(status_code=404, detail="Usuari no trobat")
+            if resultat.rowcount:
+                invalidar(db, "usuari", [usuari_id])
+                await versions.incrementar(db, "usuari")
         return usuari_actualitzat
-    except mysql.connector.Error as err:
-        raise HTTPException(status_code=500, detail=f"Error de base de dades: {err}")
-    finally:
-        if cursor:
-            cursor.close()
-        if db:
-            db.close()
+    except ERRORS_BD as err:
+        raise error_bd(err, "Error de base de dades", duplicat="Ja hi ha un usuari amb aquest correu")
+    except ImatgeNoValida as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except CredencialsSaturades as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+@app.post("/usuaris/login", response_model=Usuari)
+async def iniciar_sessio(dades: Credencials):
+    try:
+        fila = await consultar_un(SQL_CREDENCIALS, (dades.correu,))
+        # Amb un correu inexistent també es paga un hash: el temps de resposta no diu si existeix
+        valida, nou_hash = await credencials.verificar(None if fila is None else fila["contrasenya"],
+                                                       dades.contrasenya)
+        if not valida:
+            raise HTTPException(status_code=401, detail="Credencials no vàlides")
+        if nou_hash is not None:
+            # Paràmetres de cost canviats o contrasenya encara en clar. Només si ningú l'ha canviat mentrestant
+            async with transaccio() as db:
+                await db.execute("UPDATE usuari SET contrasenya = %s WHERE id = %s AND contrasenya = %s",
+                                 (nou_hash, fila["id"], fila["contrasenya"]))
+        return await cache.obtenir(clau_cache("usuari", fila["id"]), lambda: consultar_un(SQL_USUARI, (fila["id"],)))
+    except HTTPException:
+        raise
+    except CredencialsSaturades as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al iniciar sessió: {str(e)}")
 
 @app.delete("/usuaris/{usuari_id}")
-def eliminar_usuari(usuari_id: int):
+async def eliminar_usuari(usuari_id: int):
     try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        cursor.execute("DELETE FROM usuari WHERE id = %s", (usuari_id,))
-        db.commit()
-        if cursor.rowcount == 0:
+        async with transaccio() as db:
+            # La cascada esborra les valoracions i comentaris de l'usuari: primer es treuen dels agregats
+            valorades = await db.fetchall(SQL_VALORACIONS_USUARI, (usuari_id,))
+            await aplicar_canvis(db, [(fila["titol_id"], fila["rating"], None, -int(fila["te_comentari"]))
+                                      for fila in valorades])
+            resultat = await db.execute("DELETE FROM usuari WHERE id = %s", (usuari_id,))
+            invalidar(db, "usuari", [usuari_id])
+            taules = ["usuari", "usuari_llista"] + (["titol_valoracio", "usuari_titol"] if valorades else [])
+            await versions.incrementar(db, *taules)
+        if resultat.rowcount == 0:
             raise HTTPException(status_code=404, detail="Usuari no trobat")
         return {"message": "Usuari eliminat"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al eliminar usuari: {str(e)}")
-    finally:
-        if cursor:
-            cursor.close()
-        if db:
-            db.close()
 @app.post("/usuaris/{usuari_id}/titols/{titol_id}/comentarios/")
-def agregar_comentario(usuari_id: int, titol_id: int, comentario: ComentarioCreate):
-    try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        cursor.execute("""
-            INSERT INTO usuari_titol (usuari_id, titol_id, comentaris, rating)
-            VALUES (%s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE comentaris = VALUES(comentaris), rating = VALUES(rating)
-        """, (usuari_id, titol_id, comentario.comentario, comentario.rating))
-        db.commit()
+async def agregar_comentario(usuari_id: int, titol_id: int, comentario: ComentarioCreate):
+    try:
+        await buffer_valoracions.descartar(usuari_id, titol_id)
+        async with transaccio() as db:
+            anterior, tenia_comentari = await valoracio_actual(db, usuari_id, titol_id)
+            await db.execute("""
+                INSERT INTO usuari_titol (usuari_id, titol_id, comentaris, rating, comentat, valorat)
+                VALUES (%s, %s, %s, %s, NOW(6), %s)
+                ON DUPLICATE KEY UPDATE comentaris = VALUES(comentaris), rating = VALUES(rating),
+                                        comentat = VALUES(comentat), valorat = VALUES(valorat)
+            """, (usuari_id, titol_id, comentario.comentario, comentario.rating, moment_valoracio()))
+            await aplicar_canvis(db, [(titol_id, anterior, comentario.rating, 0 if tenia_comentari else 1)])
+            if anterior != comentario.rating:
+                await marcar_pendents(db, titols=[titol_id], usuaris=[usuari_id])
+            await versions.incrementar(db, "titol_valoracio", "usuari_titol")
         return {"message": "Comentario y valoración añadidos"}
+    except ERRORS_BD as err:
+        raise error_bd(err, "Error al añadir comentario", {"usuari": "Usuari no trobat", "titol": "Títol no trobat"})
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al añadir comentario: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 @app.get("/usuaris/{usuari_id}/titols/{titol_id}/comentarios/")
-def obtener_comentarios(usuari_id: int, titol_id: int):
-    try:
-        db = get_db_connection()
-        cursor = db.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT comentaris, rating
-            FROM usuari_titol
-            WHERE usuari_id = %s AND titol_id = %s
-        """, (usuari_id, titol_id))
-        comentarios = cursor.fetchall()
+async def obtener_comentarios(usuari_id: int, titol_id: int):
+    try:
+        async with connexio() as db:
+            comentarios = await db.fetchall(SQL_COMENTARI_USUARI, (usuari_id, titol_id))
         if not comentarios:
             raise HTTPException(status_code=404, detail="Comentarios no encontrados")
         return comentarios
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener comentarios: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
-@app.get("/titols/{titol_id}/comentarios/")
-def obtener_todos_los_comentarios(titol_id: int):
-    try:
-        db = get_db_connection()
-        cursor = db.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT usuari_id, comentaris, rating
-            FROM usuari_titol
-            WHERE titol_id = %s AND comentaris IS NOT NULL
-        """, (titol_id,))
-        comentarios = cursor.fetchall()
-        if not comentarios:
+@app.get("/titols/{titol_id}/comentarios/", response_model=List[Comentari])
+async def obtener_todos_los_comentarios(request: Request, response: Response, titol_id: int,
+                                        limit: int = Query(LIMIT_PER_DEFECTE, ge=1, le=LIMIT_MAXIM),
+                                        after: Optional[str] = None, ordre: str = "recents"):
+    # Feed paginat: els més recents primer o els de millor valoració, amb l'autor a la mateixa consulta
+    if ordre not in ORDRES_COMENTARIS:
+        raise HTTPException(status_code=400, detail="ordre ha de ser 'recents' o 'valoracio'")
+    despres = None if after is None else llegir_cursor(after, 2)
+    no_modificat = await condicional(request, response, "usuari_titol", "usuari")
+    if no_modificat:
+        return no_modificat
+    try:
+        async with connexio() as db:
+            files = await db.fetchall(*consulta_feed(titol_id, ordre, despres, limit + 1))
+        if not files and despres is None:
             raise HTTPException(status_code=404, detail="No hay comentarios para este título")
-        return comentarios
+        comentarios, seguent = cursor_seguent(files, limit, clau_cursor(ordre))
+        afegir_capcaleres_paginacio(request, response, seguent)
+        return resposta_json(comentarios, Comentari, response.headers)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener comentarios: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 @app.put("/usuaris/{usuari_id}/titols/{titol_id}/comentarios/")
-def modificar_comentario(usuari_id: int, titol_id: int, comentario: ComentarioUpdate):
-    try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        fields = []
-        values = []
-        if comentario.comentario is not None:
-            fields.append("comentaris = %s")
-            values.append(comentario.comentario)
-        if comentario.rating is not None:
-            fields.append("rating = %s")
-            values.append(comentario.rating)
-        if not fields:
+async def modificar_comentario(usuari_id: int, titol_id: int, comentario: ComentarioUpdate):
+    try:
+        if comentario.comentario is None and comentario.rating is None:
             raise HTTPException(status_code=400, detail="No hay campos para actualizar")
-        values.append(usuari_id)
-        values.append(titol_id)
-        query = f"UPDATE usuari_titol SET {', '.join(fields)} WHERE usuari_id = %s AND titol_id = %s"
-        cursor.execute(query, tuple(values))
-        db.commit()
-        if cursor.rowcount == 0:
+        if comentario.rating is not None:
+            await buffer_valoracions.descartar(usuari_id, titol_id)
+        async with transaccio() as db:
+            anterior, tenia_comentari = await valoracio_actual(db, usuari_id, titol_id)
+            resultat = await db.execute(SQL_ACTUALITZAR_COMENTARI,
+                                        (comentario.comentario, comentario.rating, comentario.comentario,
+                                         comentario.rating, moment_valoracio(), usuari_id, titol_id))
+            if resultat.rowcount:
+                nou = anterior if comentario.rating is None else comentario.rating
+                comentari_nou = comentario.comentario is not None and not tenia_comentari
+                await aplicar_canvis(db, [(titol_id, anterior, nou, 1 if comentari_nou else 0)])
+                if comentario.rating is not None:
+                    await marcar_pendents(db, titols=[titol_id], usuaris=[usuari_id])
+                await versions.incrementar(db, "titol_valoracio", "usuari_titol")
+        if resultat.rowcount == 0:
             raise HTTPException(status_code=404, detail="Comentario no encontrado")
         return {"message": "Comentario y valoración modificados"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al modificar comentario: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 
 @app.delete("/usuaris/{usuari_id}/titols/{titol_id}/comentarios/")
-def eliminar_comentario(usuari_id: int, titol_id: int):
-    try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        cursor.execute("""
-            UPDATE usuari_titol
-            SET comentaris = NULL, rating = 0
-            WHERE usuari_id = %s AND titol_id = %s
-        """, (usuari_id, titol_id))
-        db.commit()
-        if cursor.rowcount == 0:
+async def eliminar_comentario(usuari_id: int, titol_id: int):
+    try:
+        await buffer_valoracions.descartar(usuari_id, titol_id)
+        async with transaccio() as db:
+            anterior, tenia_comentari = await valoracio_actual(db, usuari_id, titol_id)
+            resultat = await db.execute("""
+                UPDATE usuari_titol
+                SET comentaris = NULL, rating = NULL, comentat = NULL, valorat = %s
+                WHERE usuari_id = %s AND titol_id = %s
+            """, (moment_valoracio(), usuari_id, titol_id))
+            if resultat.rowcount:
+                # Sense rating: la valoració surt de l'agregat, no hi queda com un 0
+                await aplicar_canvis(db, [(titol_id, anterior, None, -1 if tenia_comentari else 0)])
+                await marcar_pendents(db, titols=[titol_id], usuaris=[usuari_id])
+                await versions.incrementar(db, "titol_valoracio", "usuari_titol")
+        if resultat.rowcount == 0:
             raise HTTPException(status_code=404, detail="Comentario no encontrado")
         return {"message": "Comentario eliminado"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al eliminar comentario: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
 
 @app.put("/usuaris/{usuari_id}/titols/{titol_id}/rating/")
-def actualizar_rating(usuari_id: int, titol_id: int, rating_update: RatingUpdate):
+async def actualizar_rating(usuari_id: int, titol_id: int, rating_update: RatingUpdate):
     try:
-        db = get_db_connection()
-        cursor = db.cursor()
-
         # Verificar que el rating esté en el rango permitido
         if rating_update.rating not in [0, 0.5, 1, 1.5, 2, 2.5, 3, 3.5, 4]:
             raise HTTPException(status_code=400, detail="El rating debe estar entre 0 y 4 con incrementos de 0.5")
 
-        cursor.execute("""
-            UPDATE usuari_titol
-            SET rating = %s
-            WHERE usuari_id = %s AND titol_id = %s
-        """, (rating_update.rating, usuari_id, titol_id))
-        db.commit()
-
-        if cursor.rowcount == 0:
+        if buffer_valoracions.actiu:
+            # Escriptura diferida: s'escriu en el proper lot; si la fila no existeix es descarta llavors
+            await buffer_valoracions.afegir(usuari_id, titol_id, rating_update.rating)
+            return JSONResponse(status_code=202, content={"message": "Rating encolado"})
+
+        async with transaccio() as db:
+            anterior = await rating_actual(db, usuari_id, titol_id)
+            resultat = await db.execute("""
+                UPDATE usuari_titol
+                SET rating = %s, valorat = %s
+                WHERE usuari_id = %s AND titol_id = %s
+            """, (rating_update.rating, moment_valoracio(), usuari_id, titol_id))
+            if resultat.rowcount:
+                await aplicar_canvis(db, [(titol_id, anterior, rating_update.rating)])
+                await marcar_pendents(db, titols=[titol_id], usuaris=[usuari_id])
+                await versions.incrementar(db, "titol_valoracio", "usuari_titol")
+
+        if resultat.rowcount == 0:
             raise HTTPException(status_code=404, detail="Rating no encontrado")
 
         return {"message": "Rating actualizado"}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al actualizar rating: {str(e)}")
-    finally:
-        cursor.close()
-        db.close()
@@ -0,0 +1,228 @@
+import contextvars
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+# Capçalera Server-Timing amb el temps de base de dades i la resta de cada petició
+SERVER_TIMING = os.getenv('SERVER_TIMING', '0') == '1'
+# Segons a partir dels quals una consulta es registra al log com a lenta
+CONSULTA_LENTA = float(os.getenv('CONSULTA_LENTA', '0.2'))
+
+BUCKETS_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKETS_MIDA = (128, 512, 2048, 8192, 32768, 131072, 524288, 2097152, 8388608)
+BUCKETS_CONSULTES = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+log_bd = logging.getLogger("popview.bd")
+
+
+def _etiquetes(noms, valors):
+    if not noms:
+        return ""
+    parelles = []
+    for nom, valor in zip(noms, valors):
+        valor = str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parelles.append(f'{nom}="{valor}"')
+    return "{" + ",".join(parelles) + "}"
+
+
+def _numero(valor):
+    return repr(float(valor)) if valor != int(valor) else str(int(valor))
+
+
+class Comptador:
+    tipus = "counter"
+
+    def __init__(self, nom, ajuda, etiquetes=()):
+        self.nom, self.ajuda, self.etiquetes = nom, ajuda, tuple(etiquetes)
+        self._valors = {}
+
+    def inc(self, *etiquetes, valor=1):
+        self._valors[etiquetes] = self._valors.get(etiquetes, 0) + valor
+
+    def mostres(self):
+        for etiquetes, valor in sorted(self._valors.items()):
+            yield f"{self.nom}{_etiquetes(self.etiquetes, etiquetes)} {_numero(valor)}"
+
+
+class Indicador(Comptador):
+    tipus = "gauge"
+
+    def dec(self, *etiquetes, valor=1):
+        self.inc(*etiquetes, valor=-valor)
+
+
+class Histograma:
+    tipus = "histogram"
+
+    def __init__(self, nom, ajuda, buckets, etiquetes=()):
+        self.nom, self.ajuda, self.etiquetes = nom, ajuda, tuple(etiquetes)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observar(self, valor, *etiquetes):
+        serie = self._series.get(etiquetes)
+        if serie is None:
+            # Recomptes per bucket (no acumulats), suma i total
+            serie = self._series[etiquetes] = [[0] * len(self.buckets), 0.0, 0]
+        for index, limit in enumerate(self.buckets):
+            if valor <= limit:
+                serie[0][index] += 1
+                break
+        serie[1] += valor
+        serie[2] += 1
+
+    def mostres(self):
+        noms = self.etiquetes + ("le",)
+        for etiquetes, (recomptes, suma, total) in sorted(self._series.items()):
+            acumulat = 0
+            for limit, recompte in zip(self.buckets, recomptes):
+                acumulat += recompte
+                yield f"{self.nom}_bucket{_etiquetes(noms, etiquetes + (_numero(limit),))} {acumulat}"
+            yield f"{self.nom}_bucket{_etiquetes(noms, etiquetes + ('+Inf',))} {total}"
+            yield f"{self.nom}_sum{_etiquetes(self.etiquetes, etiquetes)} {_numero(suma)}"
+            yield f"{self.nom}_count{_etiquetes(self.etiquetes, etiquetes)} {total}"
+
+
+class Registre:
+    # Les mètriques són per procés: amb diversos workers, Prometheus n'ha de fer scrape de cadascun
+    def __init__(self):
+        self._metriques = []
+        self._indicadors = []
+
+    def afegir(self, metrica):
+        self._metriques.append(metrica)
+        return metrica
+
+    def afegir_indicadors(self, prefix, ajuda, obtenir):
+        # obtenir() retorna un dict; se n'exposen els valors numèrics en el moment del scrape
+        self._indicadors.append((prefix, ajuda, obtenir))
+
+    def exposicio(self):
+        linies = []
+        for metrica in self._metriques:
+            linies.append(f"# HELP {metrica.nom} {metrica.ajuda}")
+            linies.append(f"# TYPE {metrica.nom} {metrica.tipus}")
+            linies.extend(metrica.mostres())
+        for prefix, ajuda, obtenir in self._indicadors:
+            for clau, valor in _aplanar(obtenir()):
+                nom = f"{prefix}_{clau}"
+                linies.append(f"# HELP {nom} {ajuda}: {clau}")
+                linies.append(f"# TYPE {nom} gauge")
+                linies.append(f"{nom} {_numero(valor)}")
+        return "\n".join(linies) + "\n"
+
+
+def _aplanar(valors, prefix=""):
+    # {"local": {"hits": 3}} -> ("local_hits", 3); es descarta el que no és numèric
+    for clau, valor in valors.items():
+        if isinstance(valor, dict):
+            yield from _aplanar(valor, f"{prefix}{clau}_")
+        elif isinstance(valor, (int, float)) and not isinstance(valor, bool):
+            yield f"{prefix}{clau}", valor
+
+
+registre = Registre()
+
+peticions = registre.afegir(Comptador(
+    "popview_peticions_total", "Peticions HTTP acabades", ("metode", "ruta", "codi")))
+durada_peticions = registre.afegir(Histograma(
+    "popview_peticio_durada_segons", "Latència de les peticions HTTP", BUCKETS_LATENCIA, ("metode", "ruta")))
+mida_respostes = registre.afegir(Histograma(
+    "popview_resposta_mida_bytes", "Mida del cos de les respostes", BUCKETS_MIDA, ("metode", "ruta")))
+peticions_en_curs = registre.afegir(Indicador(
+    "popview_peticions_en_curs", "Peticions HTTP en curs"))
+consultes_per_peticio = registre.afegir(Histograma(
+    "popview_consultes_per_peticio", "Consultes a la base de dades per petició", BUCKETS_CONSULTES, ("metode", "ruta")))
+durada_consultes = registre.afegir(Histograma(
+    "popview_consulta_bd_durada_segons", "Latència de les consultes a la base de dades", BUCKETS_LATENCIA))
+consultes_lentes = registre.afegir(Comptador(
+    "popview_consultes_lentes_total", "Consultes que han superat CONSULTA_LENTA", ("ruta",)))
+
+
+class EstatPeticio:
+    def __init__(self, scope):
+        self.scope = scope
+        self.consultes = 0
+        self.temps_bd = 0.0
+        self.fi_darrera_consulta = None
+
+
+# Petició en curs; l'omple el middleware i la llegeix mesurar_consulta()
+_peticio = contextvars.ContextVar("peticio", default=None)
+
+
+@contextmanager
+def mesurar_consulta(query):
+    inici = time.perf_counter()
+    try:
+        yield
+    finally:
+        final = time.perf_counter()
+        durada = final - inici
+        durada_consultes.observar(durada)
+        estat = _peticio.get()
+        if estat is not None:
+            estat.consultes += 1
+            estat.temps_bd += durada
+            estat.fi_darrera_consulta = final
+        if durada >= CONSULTA_LENTA:
+            ruta = _ruta(estat.scope) if estat is not None else "-"
+            consultes_lentes.inc(ruta)
+            log_bd.warning("Consulta lenta (%.1f ms) a %s: %s", durada * 1000, ruta, " ".join(query.split()))
+
+
+def _ruta(scope):
+    # La plantilla de la ruta (/titols/{titol_id}) i no el camí, perquè les etiquetes no creixin
+    ruta = scope.get("route")
+    return getattr(ruta, "path", None) or "sense_ruta"
+
+
+class MiddlewareMetriques:
+    # Middleware ASGI: compta els bytes de cada missatge del cos, així també mesura les
+    # respostes en streaming, que no porten Content-Length
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        estat = EstatPeticio(scope)
+        token = _peticio.set(estat)
+        peticions_en_curs.inc()
+        inici = time.perf_counter()
+        codi = 500
+        mida = 0
+
+        async def enviar(missatge):
+            nonlocal codi, mida
+            if missatge["type"] == "http.response.start":
+                codi = missatge["status"]
+                if SERVER_TIMING:
+                    missatge = dict(missatge, headers=list(missatge.get("headers", [])) + [
+                        (b"server-timing", server_timing(estat, inici).encode("latin-1"))])
+            elif missatge["type"] == "http.response.body":
+                mida += len(missatge.get("body", b""))
+            await send(missatge)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            durada = time.perf_counter() - inici
+            metode, ruta = scope["method"], _ruta(scope)
+            peticions_en_curs.dec()
+            peticions.inc(metode, ruta, str(codi))
+            durada_peticions.observar(durada, metode, ruta)
+            mida_respostes.observar(mida, metode, ruta)
+            consultes_per_peticio.observar(estat.consultes, metode, ruta)
+            _peticio.reset(token)
+
+
+def server_timing(estat, inici):
+    # bd: temps dins de les consultes; serialitzacio: des de l'última consulta fins que
+    # surt la resposta (model, JSON i el que la ruta faci després de llegir)
+    ara = time.perf_counter()
+    serialitzacio = ara - (estat.fi_darrera_consulta or inici)
+    return (f'bd;dur={estat.temps_bd * 1000:.2f};desc="{estat.consultes} consultes", '
+            f"serialitzacio;dur={serialitzacio * 1000:.2f}, total;dur={(ara - inici) * 1000:.2f}")
@@ -0,0 +1,269 @@
+import re
+import sys
+
+import mysql.connector
+
+from db import get_db_connection, CREATE_TABLES
+import cache
+import cerca
+import comentaris
+import credencials
+import facetes
+import imatges
+import recomanacions
+import relacions
+import valoracions
+
+# Cada migració té una versió, una descripció i una llista de passos. Un pas és una
+# sentència SQL o una funció que rep el cursor (per a migracions de dades).
+# Les sentències han de ser idempotents: a MariaDB el DDL fa commit implícit i una
+# migració que falla a mitges s'ha de poder tornar a executar.
+MIGRACIONS = [
+    (1, "Taules inicials", list(CREATE_TABLES.values())),
+    (2, "Columnes que escriuen crear_titol i agregar_comentario", [
+        """
+        ALTER TABLE titol
+            ADD COLUMN IF NOT EXISTS genero VARCHAR(255) NULL,
+            ADD COLUMN IF NOT EXISTS edadRecomendada INT NULL,
+            MODIFY es_peli BOOLEAN NOT NULL DEFAULT FALSE
+        """,
+        """
+        ALTER TABLE usuari_titol
+            ADD COLUMN IF NOT EXISTS comentaris TEXT NULL,
+            ADD COLUMN IF NOT EXISTS rating FLOAT NULL
+        """,
+    ]),
+    (3, "Índexs secundaris per a les consultes de les rutes", [
+        # obtenir_llistes_publicas: WHERE privada = FALSE, en ordre d'id
+        "CREATE INDEX IF NOT EXISTS idx_llista_privada ON llista (privada, id)",
+        # obtener_todos_los_comentarios: WHERE titol_id = ?
+        "CREATE INDEX IF NOT EXISTS idx_usuari_titol_titol ON usuari_titol (titol_id, usuari_id)",
+        # Cerques inverses: en quines llistes és un títol i de quins usuaris és una llista
+        "CREATE INDEX IF NOT EXISTS idx_llista_titol_titol ON llista_titol (titol_id, llista_id)",
+        "CREATE INDEX IF NOT EXISTS idx_usuari_llista_llista ON usuari_llista (llista_id, usuari_id)",
+    ]),
+    (4, "Agregat de valoracions per títol", [
+        valoracions.SQL_TAULA,
+        # Omple l'agregat a partir de les valoracions que ja hi ha, una fila per títol
+        valoracions.reconstruir_sync,
+    ]),
+    (5, "Índexs FULLTEXT per a /titols/cerca", [
+        # Les columnes han de coincidir exactament amb les de MATCH() a cerca.py
+        "CREATE FULLTEXT INDEX IF NOT EXISTS ft_titol ON titol (nom, descripcio, genero, plataformes)",
+        "CREATE FULLTEXT INDEX IF NOT EXISTS ft_titol_nom ON titol (nom)",
+    ]),
+    (6, "Plataformes i gèneres normalitzats", [
+        *facetes.SQL_TAULES,
+        # Parteix els valors de titol.plataformes i titol.genero que ja hi ha
+        facetes.classificar_tots_sync,
+    ]),
+    (7, "Veïns per títol i recomanacions per usuari", [
+        *(sql.format(taula) for taula, sql in recomanacions.SQL_TAULES.items()),
+        recomanacions.SQL_PENDENTS,
+    ]),
+    (8, "Feed de comentaris per títol i recompte de comentaris", [
+        comentaris.SQL_COLUMNES,
+        comentaris.SQL_OMPLIR_COMENTAT,
+        *comentaris.SQL_INDEXS,
+        valoracions.SQL_COLUMNA_COMENTARIS,
+        # Omple nombre_comentaris amb els comentaris que ja hi ha
+        valoracions.reconstruir_sync,
+    ]),
+    (9, "Contrasenyes xifrades amb argon2", [
+        # Les que encara són en clar; les que quedin (altes d'una versió anterior durant el
+        # desplegament) es xifren en el proper inici de sessió
+        credencials.xifrar_existents_sync,
+    ]),
+    (10, "Imatges inline extretes al magatzem d'imatges", [
+        # Les data URI de titol.imatge i usuari.imatge passen a fitxers i a la fila en queda el nom.
+        # Ha de córrer on hi hagi IMATGES_DIR (el volum de l'API)
+        imatges.extreure_existents_sync,
+        # Les respostes de les dues taules canvien: els ETags que tinguin els clients ja no serveixen
+        """
+        INSERT INTO versio_taula (taula, versio) VALUES ('titol', 1), ('usuari', 1), ('usuari_titol', 1)
+        ON DUPLICATE KEY UPDATE versio = versio + 1
+        """,
+    ]),
+    (11, "Moment de l'últim rating de cada valoració", [
+        # Les files existents queden a NULL: qualsevol rating diferit posterior hi guanya
+        valoracions.SQL_COLUMNA_VALORAT,
+    ]),
+    (12, "Comentaris esborrats fora de l'agregat de valoracions", [
+        # Els esborrats d'abans deixaven rating = 0, que l'agregat comptava com una valoració
+        valoracions.SQL_ESBORRATS_A_NULL,
+        valoracions.reconstruir_sync,
+        """
+        INSERT INTO versio_taula (taula, versio) VALUES ('usuari_titol', 1), ('titol_valoracio', 1)
+        ON DUPLICATE KEY UPDATE versio = versio + 1
+        """,
+    ]),
+    (13, "Una sola marca pendent de recomanacions per títol i usuari", recomanacions.SQL_PENDENTS_UNICS),
+]
+
+def consultes_rutes():
+    # Les consultes de lectura de les rutes, amb paràmetres d'exemple: les mateixes constants i
+    # funcions que executen les rutes, perquè la comprovació no se'n separi. main s'importa aquí
+    # i no a dalt perquè main importa salut, que importa aquest mòdul
+    import main
+    un = "%s"
+    return [
+        ("obtenir_titol", main.SQL_TITOL, (1,)),
+        ("obtenir_tots_els_titols", *main.consulta_titols("id", {}, None, 101)),
+        ("obtenir_tots_els_titols (plataforma)", *main.consulta_titols("id", {"plataforma": "Netflix"}, None, 101)),
+        ("obtenir_tots_els_titols (ordre=valoracio)", *main.consulta_titols("valoracio", {}, [3.5, 1], 101)),
+        *((f"obtenir_facetes {nom} (sense filtres)", *consulta)
+          for nom, consulta in facetes.sql_facetes({}).items()),
+        *((f"obtenir_facetes {nom} (filtrada)", *consulta)
+          for nom, consulta in facetes.sql_facetes({"plataforma": "Netflix", "genero": "Drama"}).items()),
+        ("cercar_titols", *cerca.consulta_cerca("star wa", [], None, 21)),
+        ("obtenir_titols_semblants", recomanacions.SQL_SEMBLANTS, (1, 20)),
+        ("obtenir_recomanacions", recomanacions.SQL_RECOMANACIONS, (1, 20)),
+        ("obtenir_recomanacions (sense recomanacions)", recomanacions.SQL_MILLOR_VALORATS, (20,)),
+        ("obtenir_llista", main.SQL_LLISTA, (1,)),
+        ("obtenir_totes_les_llistes", main.SQL_PAGINA_LLISTES, (0, 101)),
+        ("obtenir_llistes_publicas", main.SQL_LLISTES_PUBLIQUES, ()),
+        ("obtenir_llistes_per_usuari", main.SQL_LLISTES_USUARI, (1,)),
+        ("obtenir_titols_de_llista", main.SQL_TITOLS_DE_LLISTA, (1,)),
+        *((f"include={nom} (llistes)", consulta_ids.format(un), (1,))
+          for nom, (consulta_ids, _) in relacions.RELACIONS_LLISTA.items()),
+        *((f"expand={nom} (llistes)", consulta_detall.format(un), (1,))
+          for nom, (_, consulta_detall) in relacions.RELACIONS_LLISTA.items()),
+        *((f"include={nom} (usuaris)", consulta_ids.format(un), (1,))
+          for nom, (consulta_ids, _) in relacions.RELACIONS_USUARI.items()),
+        *((f"expand={nom} (usuaris)", consulta_detall.format(un), (1,))
+          for nom, (_, consulta_detall) in relacions.RELACIONS_USUARI.items()),
+        ("obtenir_usuari", main.SQL_USUARI, (1,)),
+        ("obtenir_tots_els_usuaris", main.SQL_PAGINA_USUARIS, (0, 101)),
+        ("iniciar_sessio", main.SQL_CREDENCIALS, ("usuari@exemple.cat",)),
+        ("obtener_comentarios", main.SQL_COMENTARI_USUARI, (1, 1)),
+        ("obtener_todos_los_comentarios", *comentaris.consulta_feed(1, "recents", None, 21)),
+        ("obtener_todos_los_comentarios (ordre=valoracio)", *comentaris.consulta_feed(1, "valoracio", [3.5, 1], 21)),
+    ]
+
+
+def consultes_escriptures():
+    # Les lectures amb bloqueig i els lots de les escriptures. Només es comproven amb EXPLAIN:
+    # l'escalfament no les pot executar
+    import main
+    import valoracions_diferides
+    un = "%s"
+    return [
+        ("afegir_titols_a_llista (llista)", main.SQL_BLOQUEJAR_LLISTA, (1,)),
+        ("afegir_titols_a_llista (títols)", main.SQL_TITOLS_EXISTENTS.format(un), (1,)),
+        ("eliminar_titols_de_llista", main.SQL_TREURE_TITOLS_LLISTA.format(un), (1, 1)),
+        ("valoracio_actual", valoracions.SQL_RATING_ACTUAL, (1, 1)),
+        ("eliminar_usuari", main.SQL_VALORACIONS_USUARI, (1,)),
+        ("modificar_comentario", main.SQL_ACTUALITZAR_COMENTARI, (None, 3.5, None, 3.5, None, 1, 1)),
+        ("valoracions diferides", valoracions_diferides.sql_bloquejar([(1, 1)]), (1, 1)),
+        ("invalidacio de la memòria cau", cache.SQL_LLISTES_DELS_TITOLS.format(un), (1,)),
+    ]
+
+
+def versio_actual(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migracio (
+            versio INT PRIMARY KEY,
+            descripcio VARCHAR(255) NOT NULL,
+            aplicada TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("SELECT COALESCE(MAX(versio), 0) FROM schema_migracio")
+    return cursor.fetchone()[0]
+
+
+def migrar(fins_a=None, sortida=print):
+    db = get_db_connection()
+    cursor = db.cursor()
+    # Bloqueig amb nom perquè dos workers que arrenquen alhora no migrin en paral·lel
+    cursor.execute("SELECT GET_LOCK('popview_migracions', 60)")
+    if cursor.fetchone()[0] != 1:
+        cursor.close()
+        db.close()
+        raise RuntimeError("No s'ha pogut obtenir el bloqueig de migracions")
+    try:
+        actual = versio_actual(cursor)
+        for versio, descripcio, passos in MIGRACIONS:
+            if versio <= actual or (fins_a is not None and versio > fins_a):
+                continue
+            sortida(f"Migració {versio}: {descripcio}")
+            for pas in passos:
+                if callable(pas):
+                    pas(cursor)
+                else:
+                    cursor.execute(pas)
+            cursor.execute("INSERT INTO schema_migracio (versio, descripcio) VALUES (%s, %s)", (versio, descripcio))
+            db.commit()
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK('popview_migracions')")
+        cursor.fetchone()
+        cursor.close()
+        db.close()
+
+
+# Taules de desenes de files (els noms de les facetes) que les consultes poden recórrer senceres
+TAULES_PETITES = {"plataforma", "genere"}
+# Accessos d'EXPLAIN que llegeixen la taula sencera (ALL) o un índex sencer (index)
+RECORREGUTS = {"ALL": "recorregut complet", "index": "recorregut complet de l'índex"}
+# Recorreguts complets coneguts, per (consulta, taula). Comptar els títols de cada valor d'una
+# faceta sense filtre de l'altra dimensió ha de llegir totes les files d'unió: l'índex és el més
+# estret possible (dos INT) i el resultat es desa a la memòria cau fins al proper canvi de titol
+# (obtenir_facetes). Amb un sol filtre, la faceta de la mateixa dimensió fa aquest mateix recorregut
+RECORREGUTS_ACCEPTATS = {
+    (f"obtenir_facetes {nom} (sense filtres)", unio) for nom, (_, _, unio, _) in facetes.DIMENSIONS.items()
+}
+CLAUSULES = r"ON|WHERE|JOIN|LEFT|INNER|ORDER|GROUP|LIMIT"
+TAULA_I_ALIES = re.compile(rf"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?!(?:{CLAUSULES})\b)(\w+))?", re.IGNORECASE)
+
+
+def taules_consulta(query):
+    # Àlies -> taula, perquè EXPLAIN dona l'àlies a la columna table
+    return {alies or taula: taula for taula, alies in TAULA_I_ALIES.findall(query)}
+
+
+def comprovar_plans(sortida=print):
+    # Falla si el pla d'alguna consulta recorre una taula o un índex sencers, encara que hi hagi
+    # índexs possibles: amb les dades de proves l'optimitzador pot triar un ALL que en producció
+    # seria lent, i és millor saber-ho. Les taules de TAULES_PETITES no es marquen, ni les
+    # temporals (<derived2>, <subquery3>) que ja surten de files comprovades, ni els recorreguts
+    # de RECORREGUTS_ACCEPTATS
+    consultes = consultes_rutes() + consultes_escriptures()
+    db = get_db_connection()
+    cursor = db.cursor(dictionary=True)
+    errors = []
+    try:
+        for ruta, query, params in consultes:
+            taules = taules_consulta(query)
+            cursor.execute("EXPLAIN " + query, params)
+            for fila in cursor.fetchall():
+                taula = taules.get(fila["table"], fila["table"]) or ""
+                if (fila["type"] in RECORREGUTS and taula not in TAULES_PETITES and not taula.startswith("<")
+                        and (ruta, taula) not in RECORREGUTS_ACCEPTATS):
+                    errors.append(f"{ruta}: {RECORREGUTS[fila['type']]} de {taula} "
+                                  f"(índexs possibles: {fila['possible_keys'] or 'cap'})")
+    finally:
+        cursor.close()
+        db.close()
+    for error in errors:
+        sortida(error)
+    if not errors:
+        sortida(f"{len(consultes)} consultes sense recorreguts complets no acceptats")
+    return not errors
+
+
+if __name__ == "__main__":
+    ordre = sys.argv[1] if len(sys.argv) > 1 else "migrar"
+    try:
+        if ordre == "migrar":
+            migrar(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+        elif ordre == "estat":
+            db = get_db_connection()
+            cursor = db.cursor()
+            print(f"Versió actual: {versio_actual(cursor)} de {MIGRACIONS[-1][0]}")
+            cursor.close()
+            db.close()
+        elif ordre == "comprovar-plans":
+            sys.exit(0 if comprovar_plans() else 1)
+        else:
+            sys.exit(f"Ordre desconeguda: {ordre} (migrar [versió] | estat | comprovar-plans)")
+    except mysql.connector.Error as err:
+        sys.exit(f"Error de base de dades: {err}")
@@ -1,7 +1,12 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 from typing import Optional
 from typing import Optional, List
-from datetime import date
+from datetime import date, datetime
+import imatges
+
+def url_imatge(camp):
+    # Les files guarden el nom del magatzem (imatges.py); les respostes en porten la URL
+    return validator(camp, allow_reuse=True)(lambda cls, valor: imatges.url(valor))
 
 class Usuari(BaseModel):
     id: int
@@ -9,14 +14,18 @@ class Usuari(BaseModel):
     imatge: Optional[str] = None
     edat: int
     correu: str
-    contrasenya: str
-    llistes: List[int] = []
+    llistes: List[int] = []  # La contrasenya no surt mai a les respostes
+
+    _url_imatge = url_imatge("imatge")
 class UsuariCreate(BaseModel):
     nom: str
     imatge: Optional[str] = None
     edat: int
     correu: str
     contrasenya: str 
+class Credencials(BaseModel):
+    correu: str
+    contrasenya: str
 class UsuariUpdate(BaseModel):
     nom: Optional[str] = None
     imatge: Optional[str] = None
@@ -48,6 +57,20 @@ class Titol(BaseModel):
     comentaris: Optional[str] = None
     genero: Optional[str] = None
     edadRecomendada: Optional[int] = None
+    # Agregat de titol_valoracio: nombre de valoracions, mitjana i recompte per cubetes de 0.5 (0..4)
+    valoracions: int = 0
+    valoracio_mitjana: Optional[float] = None
+    histograma_valoracions: Optional[List[int]] = None
+    nombre_comentaris: int = 0
+
+    _url_imatge = url_imatge("imatge")
+
+    @validator("histograma_valoracions", pre=True)
+    def llegir_histograma(cls, valor):
+        # La consulta el retorna com a text separat per comes (CONCAT_WS); buit si no hi ha agregat
+        if isinstance(valor, str):
+            return [int(n) for n in valor.split(",")] if valor else None
+        return valor
 
     class Config:
         orm_mode = True  # Permite trabajar con los objetos de SQLAlchemy o consultas directas
@@ -60,6 +83,33 @@ class TitolCreate(BaseModel):
     comentaris: Optional[str] = None
     genero: Optional[str] = None
     edadRecomendada: Optional[int] = None
+class UsuariResum(BaseModel):
+    id: int
+    nom: str
+    imatge: Optional[str] = None
+
+    _url_imatge = url_imatge("imatge")
+class LlistaExpandida(Llista):
+    # Camps que només s'omplen amb include= / expand=
+    usuaris: Optional[List[int]] = None
+    titols_detall: Optional[List[Titol]] = None
+    usuaris_detall: Optional[List[UsuariResum]] = None
+class UsuariExpandit(Usuari):
+    llistes_detall: Optional[List[Llista]] = None
+class TitolImportacio(TitolCreate):
+    id: Optional[int] = None  # Si hi és i ja existeix, l'importació amb upsert actualitza la fila
+class TitolsLot(BaseModel):
+    titols: List[int]
+class Comentari(BaseModel):
+    # Element del feed de comentaris d'un títol, amb el nom i la imatge de l'autor
+    usuari_id: int
+    usuari_nom: str
+    usuari_imatge: Optional[str] = None
+    comentaris: str
+    rating: Optional[float] = None
+    comentat: datetime
+
+    _url_imatge = url_imatge("usuari_imatge")
 class ComentarioCreate(BaseModel):
     comentario: str
     rating: float
@@ -0,0 +1,42 @@
+import base64
+import json
+
+# Límits de les pàgines per als llistats
+LIMIT_PER_DEFECTE = 100
+LIMIT_MAXIM = 1000
+
+# Files que es llegeixen del cursor en cada lot quan es fa streaming
+MIDA_LOT_STREAM = 500
+
+
+def codificar_cursor(valors):
+    # El cursor és opac per al client: base64 dels valors de la clau de l'última fila
+    cru = json.dumps(list(valors), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(cru).decode().rstrip("=")
+
+
+def decodificar_cursor(cursor):
+    try:
+        farciment = "=" * (-len(cursor) % 4)
+        valors = json.loads(base64.urlsafe_b64decode(cursor + farciment))
+    except (ValueError, TypeError):
+        raise ValueError("Cursor no vàlid")
+    if not isinstance(valors, list) or not valors:
+        raise ValueError("Cursor no vàlid")
+    return valors
+
+
+def cursor_seguent(files, limit, clau):
+    # Es demana una fila de més per saber si hi ha pàgina següent; si hi és, es descarta
+    if len(files) <= limit:
+        return files, None
+    files = files[:limit]
+    return files, codificar_cursor(clau(files[-1]))
+
+
+def afegir_capcaleres_paginacio(request, response, cursor):
+    if cursor is None:
+        return
+    url = request.url.include_query_params(after=cursor)
+    response.headers["X-Next-Cursor"] = cursor
+    response.headers["Link"] = f'<{url}>; rel="next"'
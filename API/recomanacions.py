@@ -0,0 +1,481 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+from db import connexio, tancar_pools
+from etags import versions
+from valoracions import COLUMNES_TITOL, JOIN_VALORACIO
+
+# Veïns que es guarden per títol i recomanacions per usuari
+VEINS_PER_TITOL = int(os.getenv('RECOMANACIONS_VEINS', '50'))
+RECOMANACIONS_PER_USUARI = int(os.getenv('RECOMANACIONS_PER_USUARI', '100'))
+# Similitud de cosinus per sota de la qual un veí no es desa
+SIMILITUD_MINIMA = 0.01
+# Pes de cada font al vector d'un títol: aparicions a llistes públiques i valoracions centrades
+PES_LLISTES = 1.0
+PES_VALORACIONS = 1.0
+# Interès que aporta a un usuari tenir un títol en una llista pròpia (les valoracions hi sumen centrades)
+PES_LLISTA_PROPIA = 1.0
+# Títols per bloc del producte de similituds: limita la memòria de la matriu intermèdia
+MIDA_BLOC = 2000
+MIDA_LOT_ESCRIPTURA = 5000
+
+log = logging.getLogger("popview.recomanacions")
+
+# Les taules són derivades: no tenen claus foranes perquè el recàlcul complet les pugui
+# reconstruir al costat i intercanviar-les amb RENAME. Les lectures fan JOIN amb titol,
+# així que un títol esborrat deixa de sortir encara que en quedi alguna fila
+SQL_TAULES = {
+    "titol_vei": """
+        CREATE TABLE IF NOT EXISTS {} (
+            titol_id INT NOT NULL,
+            vei_id INT NOT NULL,
+            similitud FLOAT NOT NULL,
+            PRIMARY KEY (titol_id, vei_id),
+            INDEX idx_titol_vei_similitud (titol_id, similitud DESC)
+        )
+    """,
+    "usuari_recomanacio": """
+        CREATE TABLE IF NOT EXISTS {} (
+            usuari_id INT NOT NULL,
+            titol_id INT NOT NULL,
+            puntuacio FLOAT NOT NULL,
+            PRIMARY KEY (usuari_id, titol_id),
+            INDEX idx_usuari_recomanacio_puntuacio (usuari_id, puntuacio DESC)
+        )
+    """,
+}
+
+# Cua de títols i usuaris afectats per escriptures des de l'últim recàlcul incremental. Una
+# fila per títol o usuari: una marca repetida incrementa revisio, i el recàlcul només esborra
+# les files que no han canviat mentre calculava
+SQL_PENDENTS = """
+    CREATE TABLE IF NOT EXISTS recomanacio_pendent (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        tipus ENUM('titol', 'usuari') NOT NULL,
+        ref_id INT NOT NULL,
+        revisio INT NOT NULL DEFAULT 0,
+        UNIQUE KEY uq_recomanacio_pendent (tipus, ref_id)
+    )
+"""
+
+# Migració 13: les instal·lacions anteriors tenien una fila per escriptura
+SQL_PENDENTS_UNICS = [
+    "ALTER TABLE recomanacio_pendent ADD COLUMN IF NOT EXISTS revisio INT NOT NULL DEFAULT 0",
+    """
+    DELETE p FROM recomanacio_pendent p
+    JOIN recomanacio_pendent q ON q.tipus = p.tipus AND q.ref_id = p.ref_id AND q.id < p.id
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_recomanacio_pendent ON recomanacio_pendent (tipus, ref_id)",
+]
+
+SQL_RECOMANACIONS = f"""
+    SELECT {COLUMNES_TITOL}
+    FROM usuari_recomanacio r
+    JOIN titol t ON t.id = r.titol_id
+    {JOIN_VALORACIO}
+    WHERE r.usuari_id = %s
+    ORDER BY r.puntuacio DESC
+    LIMIT %s
+"""
+
+SQL_SEMBLANTS = f"""
+    SELECT {COLUMNES_TITOL}
+    FROM titol_vei tv
+    JOIN titol t ON t.id = tv.vei_id
+    {JOIN_VALORACIO}
+    WHERE tv.titol_id = %s
+    ORDER BY tv.similitud DESC
+    LIMIT %s
+"""
+
+# Per als usuaris sense cap senyal: els millor valorats, per l'índex de titol_valoracio
+SQL_MILLOR_VALORATS = f"""
+    SELECT {COLUMNES_TITOL}
+    FROM titol_valoracio v
+    JOIN titol t ON t.id = v.titol_id
+    ORDER BY v.mitjana DESC, v.titol_id
+    LIMIT %s
+"""
+
+
+async def marcar_pendents(db, titols=(), usuaris=(), llista_id=None):
+    # Es crida dins la transacció de l'escriptura. Amb llista_id també es marquen els
+    # propietaris de la llista, perquè els seus títols són part del seu perfil
+    files = [("titol", titol_id) for titol_id in titols] + [("usuari", usuari_id) for usuari_id in usuaris]
+    if files:
+        await db.executemany("""
+            INSERT INTO recomanacio_pendent (tipus, ref_id) VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE revisio = revisio + 1
+        """, files)
+    if llista_id is not None:
+        await db.execute("""
+            INSERT INTO recomanacio_pendent (tipus, ref_id)
+            SELECT 'usuari', usuari_id FROM usuari_llista WHERE llista_id = %s
+            ON DUPLICATE KEY UPDATE revisio = revisio + 1
+        """, (llista_id,))
+
+
+async def _pendents(db):
+    return await db.fetchall("SELECT id, tipus, ref_id, revisio FROM recomanacio_pendent ORDER BY id")
+
+
+async def _esborrar_pendents(db, pendents):
+    # Una marca que ha canviat mentre es calculava es queda per a la propera passada
+    await db.executemany("DELETE FROM recomanacio_pendent WHERE id = %s AND revisio = %s",
+                         [(fila["id"], fila["revisio"]) for fila in pendents])
+
+
+async def _columnes(db, query, params=()):
+    # Llegeix una consulta per lots i en retorna cada columna com a llista
+    columnes = None
+    async for fila in db.iterar(query, params, mida_lot=10000):
+        if columnes is None:
+            columnes = {clau: [] for clau in fila}
+        for clau, valor in fila.items():
+            columnes[clau].append(valor)
+    return columnes
+
+
+async def carregar_interaccions():
+    async with connexio() as db:
+        titols = await _columnes(db, "SELECT id FROM titol ORDER BY id")
+        llistes = await _columnes(db, """
+            SELECT lt.llista_id, lt.titol_id
+            FROM llista_titol lt
+            JOIN llista l ON l.id = lt.llista_id
+            WHERE l.privada = FALSE
+        """)
+        valoracions = await _columnes(db, """
+            SELECT usuari_id, titol_id, rating
+            FROM usuari_titol
+            WHERE rating IS NOT NULL
+        """)
+        propies = await _columnes(db, """
+            SELECT DISTINCT ul.usuari_id, lt.titol_id
+            FROM usuari_llista ul
+            JOIN llista_titol lt ON lt.llista_id = ul.llista_id
+        """)
+    return Interaccions(titols, llistes, valoracions, propies)
+
+
+def _marcadors(ids):
+    return ", ".join(["%s"] * len(ids))
+
+
+async def _ids(db, query, ids):
+    # Primera columna de query per a ids (query té un {} on van els marcadors)
+    if not ids:
+        return set()
+    return {next(iter(fila.values())) for fila in await db.fetchall(query.format(_marcadors(ids)), tuple(ids))}
+
+
+async def carregar_veinatge(db, titols):
+    # Interaccions suficients per refer els veïns de titols sense llegir totes les taules:
+    # les files (llistes públiques i usuaris) on surten, els títols d'aquestes files (els únics
+    # que poden ser veïns) i la columna sencera de cadascun, perquè les normes del cosinus siguin
+    # les del recàlcul complet. Dels usuaris que valoren algun candidat es llegeixen totes les
+    # valoracions: la mitjana per centrar-les és la de l'usuari sencer
+    llistes = await _ids(db, """
+        SELECT DISTINCT lt.llista_id FROM llista_titol lt JOIN llista l ON l.id = lt.llista_id
+        WHERE l.privada = FALSE AND lt.titol_id IN ({})
+    """, titols)
+    usuaris = await _ids(db, "SELECT DISTINCT usuari_id FROM usuari_titol WHERE rating IS NOT NULL AND titol_id IN ({})",
+                         titols)
+    candidats = set(titols)
+    candidats |= await _ids(db, "SELECT DISTINCT titol_id FROM llista_titol WHERE llista_id IN ({})", sorted(llistes))
+    candidats |= await _ids(db, """
+        SELECT DISTINCT titol_id FROM usuari_titol WHERE rating IS NOT NULL AND usuari_id IN ({})
+    """, sorted(usuaris))
+    candidats = sorted(candidats)
+    marcadors = _marcadors(candidats)
+    return Interaccions(
+        await _columnes(db, f"SELECT id FROM titol WHERE id IN ({marcadors}) ORDER BY id", tuple(candidats)),
+        await _columnes(db, f"""
+            SELECT lt.llista_id, lt.titol_id
+            FROM llista_titol lt
+            JOIN llista l ON l.id = lt.llista_id
+            WHERE l.privada = FALSE AND lt.titol_id IN ({marcadors})
+        """, tuple(candidats)),
+        await _columnes(db, f"""
+            SELECT usuari_id, titol_id, rating
+            FROM usuari_titol
+            WHERE rating IS NOT NULL AND usuari_id IN (
+                SELECT usuari_id FROM usuari_titol WHERE rating IS NOT NULL AND titol_id IN ({marcadors})
+            )
+        """, tuple(candidats)),
+        None,
+    )
+
+
+async def carregar_perfils(db, usuaris):
+    # (Interaccions amb els perfils d'usuaris, veïns desats dels títols dels perfils)
+    import numpy as np
+    marcadors = _marcadors(usuaris)
+    valoracions = await _columnes(db, f"""
+        SELECT usuari_id, titol_id, rating
+        FROM usuari_titol
+        WHERE rating IS NOT NULL AND usuari_id IN ({marcadors})
+    """, tuple(usuaris))
+    propies = await _columnes(db, f"""
+        SELECT DISTINCT ul.usuari_id, lt.titol_id
+        FROM usuari_llista ul
+        JOIN llista_titol lt ON lt.llista_id = ul.llista_id
+        WHERE ul.usuari_id IN ({marcadors})
+    """, tuple(usuaris))
+    titols_perfil = sorted({*(valoracions or {}).get("titol_id", []), *(propies or {}).get("titol_id", [])})
+    desats = {}
+    if titols_perfil:
+        for fila in await db.fetchall(
+                f"SELECT titol_id, vei_id, similitud FROM titol_vei WHERE titol_id IN ({_marcadors(titols_perfil)})",
+                tuple(titols_perfil)):
+            desats.setdefault(fila["titol_id"], []).append((fila["vei_id"], fila["similitud"]))
+    necessaris = sorted({*titols_perfil, *(vei_id for llista in desats.values() for vei_id, _ in llista)})
+    titols = None
+    if necessaris:
+        titols = await _columnes(db, f"SELECT id FROM titol WHERE id IN ({_marcadors(necessaris)}) ORDER BY id",
+                                 tuple(necessaris))
+    veins = [
+        (titol_id, np.array([v for v, _ in llista], dtype=np.int64), np.array([s for _, s in llista], dtype=np.float32))
+        for titol_id, llista in desats.items()
+    ]
+    return Interaccions(titols, None, valoracions, propies), veins
+
+
+def posicions(ordenats, valors):
+    # Posició de cada valor dins l'array ordenat, o -1 si no hi és
+    import numpy as np
+    valors = np.asarray(valors, dtype=np.int64)
+    if len(ordenats) == 0:
+        return np.full(len(valors), -1)
+    index = np.minimum(np.searchsorted(ordenats, valors), len(ordenats) - 1)
+    return np.where(ordenats[index] == valors, index, -1)
+
+
+class Interaccions:
+    # Matrius disperses construïdes a partir de les taules. Els títols són les columnes,
+    # en l'ordre de self.titol_ids
+    def __init__(self, titols, llistes, valoracions, propies):
+        import numpy as np
+        import scipy.sparse as sp
+
+        self.titol_ids = np.array(titols["id"] if titols else [], dtype=np.int64)
+        n_titols = len(self.titol_ids)
+
+        def dispersa(files_ids, titol_ids, valors):
+            # Una fila per id diferent de files_ids; els títols que ja no existeixen es descarten
+            ids_files, index_files = np.unique(np.asarray(files_ids, dtype=np.int64), return_inverse=True)
+            columnes = posicions(self.titol_ids, titol_ids)
+            valides = columnes >= 0
+            matriu = sp.csr_matrix(
+                (np.asarray(valors, dtype=np.float64)[valides], (index_files[valides], columnes[valides])),
+                shape=(len(ids_files), n_titols),
+            )
+            matriu.sum_duplicates()
+            return ids_files, matriu
+
+        buida = sp.csr_matrix((0, n_titols))
+        # Llistes públiques: 1 si el títol hi és
+        matriu_llistes = buida
+        if llistes:
+            _, matriu_llistes = dispersa(llistes["llista_id"], llistes["titol_id"], np.ones(len(llistes["titol_id"])))
+
+        # Valoracions centrades per la mitjana de cada usuari (cosinus ajustat)
+        matriu_valoracions = buida
+        perfils = []
+        if valoracions:
+            ratings = np.asarray(valoracions["rating"], dtype=np.float64)
+            _, index_usuaris = np.unique(np.asarray(valoracions["usuari_id"], dtype=np.int64), return_inverse=True)
+            mitjanes = np.bincount(index_usuaris, weights=ratings) / np.bincount(index_usuaris)
+            centrades = ratings - mitjanes[index_usuaris]
+            _, matriu_valoracions = dispersa(valoracions["usuari_id"], valoracions["titol_id"], centrades)
+            perfils.append((valoracions["usuari_id"], valoracions["titol_id"], centrades))
+
+        vectors = sp.vstack([matriu_llistes * PES_LLISTES, matriu_valoracions * PES_VALORACIONS]).tocsc()
+        normes = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=0)).ravel())
+        normes[normes == 0] = 1.0
+        self.vectors = (vectors @ sp.diags(1.0 / normes)).tocsc()
+
+        # Perfil de cada usuari: valoracions centrades més els títols de les seves llistes
+        if propies:
+            perfils.append((propies["usuari_id"], propies["titol_id"], np.full(len(propies["titol_id"]), PES_LLISTA_PROPIA)))
+        self.usuari_ids, self.perfils = np.array([], dtype=np.int64), buida
+        if perfils:
+            self.usuari_ids, self.perfils = dispersa(*(np.concatenate([perfil[i] for perfil in perfils]) for i in range(3)))
+
+    def veins(self, columnes, k=VEINS_PER_TITOL):
+        # Top-k per cosinus de cada títol de columnes, per blocs: (titol_id, vei_ids, similituds)
+        import numpy as np
+        for inici in range(0, len(columnes), MIDA_BLOC):
+            bloc = columnes[inici:inici + MIDA_BLOC]
+            similituds = (self.vectors[:, bloc].T @ self.vectors).tocsr()
+            for fila, columna in enumerate(bloc):
+                desde, fins = similituds.indptr[fila], similituds.indptr[fila + 1]
+                index, valors = similituds.indices[desde:fins], similituds.data[desde:fins]
+                bons = (index != columna) & (valors >= SIMILITUD_MINIMA)
+                index, valors = index[bons], valors[bons]
+                if len(valors) > k:
+                    millors = np.argpartition(-valors, k)[:k]
+                    index, valors = index[millors], valors[millors]
+                yield int(self.titol_ids[columna]), self.titol_ids[index], valors.astype(np.float32)
+
+    def matriu_veins(self, veins):
+        # Matriu títol × títol amb les similituds de veins, sense els ids que ja no existeixen
+        import numpy as np
+        import scipy.sparse as sp
+        veins = list(veins)
+        n_titols = len(self.titol_ids)
+        if not veins:
+            return sp.csr_matrix((n_titols, n_titols))
+        files = posicions(self.titol_ids, np.concatenate([np.full(len(v), t) for t, v, _ in veins]))
+        columnes = posicions(self.titol_ids, np.concatenate([v for _, v, _ in veins]))
+        valors = np.concatenate([s for _, _, s in veins])
+        valides = (files >= 0) & (columnes >= 0)
+        return sp.csr_matrix((valors[valides], (files[valides], columnes[valides])), shape=(n_titols, n_titols))
+
+    def recomanacions(self, index_usuaris, matriu_veins, n=RECOMANACIONS_PER_USUARI):
+        # Puntuació = perfil de l'usuari × veïns; sense els títols que ja ha valorat o té en llistes
+        import numpy as np
+        perfils = self.perfils[index_usuaris]
+        puntuacions = (perfils @ matriu_veins).tocsr()
+        for fila, index_usuari in enumerate(index_usuaris):
+            desde, fins = puntuacions.indptr[fila], puntuacions.indptr[fila + 1]
+            index, valors = puntuacions.indices[desde:fins], puntuacions.data[desde:fins]
+            vistos = perfils.indices[perfils.indptr[fila]:perfils.indptr[fila + 1]]
+            bons = (valors > 0) & ~np.isin(index, vistos)
+            index, valors = index[bons], valors[bons]
+            if len(valors) > n:
+                millors = np.argpartition(-valors, n)[:n]
+                index, valors = index[millors], valors[millors]
+            yield int(self.usuari_ids[index_usuari]), self.titol_ids[index], valors.astype(np.float32)
+
+
+def _files(resultats):
+    # (pare, ids, valors) -> files (pare, id, valor) per a INSERT, sense materialitzar-les totes
+    for pare, ids, valors in resultats:
+        yield from zip([pare] * len(ids), ids.tolist(), valors.tolist())
+
+
+async def _escriure(db, taula, files):
+    sql = f"INSERT INTO {taula} VALUES (%s, %s, %s)"
+    lot = []
+    for fila in files:
+        lot.append(fila)
+        if len(lot) >= MIDA_LOT_ESCRIPTURA:
+            await db.executemany(sql, lot)
+            lot = []
+    if lot:
+        await db.executemany(sql, lot)
+
+
+async def _substituir(taula, files):
+    # Omple una còpia i la intercanvia amb RENAME, que és atòmic: les lectures veuen
+    # la taula vella sencera fins al moment del canvi
+    nova, vella = f"{taula}_nova", f"{taula}_vella"
+    async with connexio() as db:
+        await db.execute(f"DROP TABLE IF EXISTS {nova}, {vella}")
+        await db.execute(SQL_TAULES[taula].format(nova))
+        await _escriure(db, nova, files)
+        await db.commit()
+        await db.execute(f"RENAME TABLE {taula} TO {vella}, {nova} TO {taula}")
+        await db.execute(f"DROP TABLE {vella}")
+        await versions.incrementar(db, taula)
+        await db.commit()
+
+
+async def calcular(sortida=print):
+    # Recàlcul complet: tots els veïns i totes les recomanacions
+    inici = time.monotonic()
+    async with connexio() as db:
+        pendents = await _pendents(db)
+    interaccions = await carregar_interaccions()
+    veins = list(interaccions.veins(list(range(len(interaccions.titol_ids)))))
+    await _substituir("titol_vei", _files(veins))
+    matriu = interaccions.matriu_veins(veins)
+    del veins
+    await _substituir("usuari_recomanacio", _files(
+        interaccions.recomanacions(list(range(len(interaccions.usuari_ids))), matriu)))
+    async with connexio() as db:
+        await _esborrar_pendents(db, pendents)
+        await db.commit()
+    sortida(f"{len(interaccions.titol_ids)} títols i {len(interaccions.usuari_ids)} usuaris "
+            f"en {time.monotonic() - inici:.1f} s")
+
+
+async def actualitzar(sortida=print):
+    # Recàlcul incremental dels títols i usuaris marcats per marcar_pendents(): es refan
+    # les files de veïns dels títols marcats i les recomanacions dels usuaris marcats. Els
+    # veïns dels altres títols (la part simètrica) es posen al dia al recàlcul complet.
+    # Només es llegeixen les interaccions que toquen els marcats (carregar_veinatge i carregar_perfils)
+    async with connexio() as db:
+        pendents = await _pendents(db)
+    if not pendents:
+        return
+    titols = sorted({fila["ref_id"] for fila in pendents if fila["tipus"] == "titol"})
+    usuaris = sorted({fila["ref_id"] for fila in pendents if fila["tipus"] == "usuari"})
+
+    if titols:
+        async with connexio() as db:
+            interaccions = await carregar_veinatge(db, titols)
+        columnes = [int(c) for c in posicions(interaccions.titol_ids, titols) if c >= 0]
+        async with connexio() as db:
+            await db.execute(f"DELETE FROM titol_vei WHERE titol_id IN ({_marcadors(titols)})", tuple(titols))
+            await _escriure(db, "titol_vei", _files(interaccions.veins(columnes)))
+            await versions.incrementar(db, "titol_vei")
+            await db.commit()
+
+    recomanacions = []
+    if usuaris:
+        # Els veïns es llegeixen després d'escriure els dels títols marcats
+        async with connexio() as db:
+            interaccions, veins = await carregar_perfils(db, usuaris)
+        index_usuaris = [int(i) for i in posicions(interaccions.usuari_ids, usuaris) if i >= 0]
+        if index_usuaris:
+            recomanacions = interaccions.recomanacions(index_usuaris, interaccions.matriu_veins(veins))
+    async with connexio() as db:
+        if usuaris:
+            await db.execute(f"DELETE FROM usuari_recomanacio WHERE usuari_id IN ({_marcadors(usuaris)})",
+                             tuple(usuaris))
+            await _escriure(db, "usuari_recomanacio", _files(recomanacions))
+            await versions.incrementar(db, "usuari_recomanacio")
+        await _esborrar_pendents(db, pendents)
+        await db.commit()
+    sortida(f"{len(titols)} títols i {len(usuaris)} usuaris actualitzats")
+
+
+async def servei(interval, sortida=print):
+    # Procés de fons: aplica els pendents cada interval segons. Una passada que falla (base de
+    # dades caiguda, un deadlock) deixa els pendents a la cua i es torna a provar a la següent
+    while True:
+        try:
+            await actualitzar(sortida)
+        except Exception:
+            log.exception("Ha fallat l'actualització de recomanacions; es torna a provar d'aquí a %s s", interval)
+        await asyncio.sleep(interval)
+
+
+def principal(args=None):
+    parser = argparse.ArgumentParser(description="Càlcul de veïns i recomanacions")
+    parser.add_argument("ordre", choices=["calcular", "actualitzar", "servei"])
+    parser.add_argument("--interval", type=float, default=60, help="Segons entre actualitzacions (servei)")
+    args = parser.parse_args(args)
+
+    async def executar():
+        try:
+            if args.ordre == "calcular":
+                await calcular()
+            elif args.ordre == "actualitzar":
+                await actualitzar()
+            else:
+                await servei(args.interval)
+        finally:
+            await tancar_pools()
+
+    asyncio.run(executar())
+
+
+if __name__ == "__main__":
+    sys.exit(principal())
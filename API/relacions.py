@@ -0,0 +1,113 @@
+from collections import defaultdict
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import imatges
+from valoracions import COLUMNES_TITOL, JOIN_VALORACIO
+
+# Per a cada relació: la consulta de la taula d'enllaç (per a include=, només ids) i la
+# consulta que porta també les files relacionades (per a expand=). Totes dues reben el
+# conjunt de pares sencer, de manera que el nombre de consultes no depèn de quants n'hi ha
+RELACIONS_LLISTA = {
+    "titols": (
+        "SELECT llista_id AS _pare, titol_id AS _fill FROM llista_titol WHERE llista_id IN ({})",
+        f"""
+        SELECT lt.llista_id AS _pare, {COLUMNES_TITOL}
+        FROM llista_titol lt
+        JOIN titol t ON t.id = lt.titol_id
+        {JOIN_VALORACIO}
+        WHERE lt.llista_id IN ({{}})
+        ORDER BY t.id
+        """,
+    ),
+    "usuaris": (
+        "SELECT llista_id AS _pare, usuari_id AS _fill FROM usuari_llista WHERE llista_id IN ({})",
+        """
+        SELECT ul.llista_id AS _pare, u.id, u.nom, u.imatge
+        FROM usuari_llista ul
+        JOIN usuari u ON u.id = ul.usuari_id
+        WHERE ul.llista_id IN ({})
+        ORDER BY u.id
+        """,
+    ),
+}
+
+RELACIONS_USUARI = {
+    "llistes": (
+        "SELECT usuari_id AS _pare, llista_id AS _fill FROM usuari_llista WHERE usuari_id IN ({})",
+        """
+        SELECT ul.usuari_id AS _pare, l.*
+        FROM usuari_llista ul
+        JOIN llista l ON l.id = ul.llista_id
+        WHERE ul.usuari_id IN ({})
+        ORDER BY l.id
+        """,
+    ),
+}
+
+
+def llegir_relacions(valor, relacions, parametre):
+    if not valor:
+        return set()
+    noms = {nom.strip() for nom in valor.split(",") if nom.strip()}
+    desconegudes = noms - relacions.keys()
+    if desconegudes:
+        raise HTTPException(status_code=400, detail=f"{parametre} no vàlid: {', '.join(sorted(desconegudes))}")
+    return noms
+
+
+def llegir_camps(valor, model):
+    if not valor:
+        return None
+    camps = {camp.strip() for camp in valor.split(",") if camp.strip()}
+    desconeguts = camps - model.__fields__.keys()
+    if desconeguts:
+        raise HTTPException(status_code=400, detail=f"fields no vàlid: {', '.join(sorted(desconeguts))}")
+    return camps
+
+
+async def carregar_relacions(db, pares, relacions, include, expand):
+    # Una consulta per relació: ids per a include=, files senceres per a expand=
+    if not pares:
+        return
+    ids = [pare["id"] for pare in pares]
+    marcadors = ", ".join(["%s"] * len(ids))
+    for nom in sorted(include | expand):
+        sql_ids, sql_detall = relacions[nom]
+        fills = defaultdict(list)
+        if nom in expand:
+            for fila in await db.fetchall(sql_detall.format(marcadors), tuple(ids)):
+                fills[fila.pop("_pare")].append(fila)
+            for pare in pares:
+                pare[f"{nom}_detall"] = fills.get(pare["id"], [])
+                pare[nom] = [fill["id"] for fill in pare[f"{nom}_detall"]]
+        else:
+            for fila in await db.fetchall(sql_ids.format(marcadors), tuple(ids)):
+                fills[fila["_pare"]].append(fila["_fill"])
+            for pare in pares:
+                pare[nom] = fills.get(pare["id"], [])
+
+
+def _miniatures(fila):
+    return {camp: imatges.url_miniatura(valor) if camp in imatges.CAMPS else valor for camp, valor in fila.items()}
+
+
+def _amb_miniatures(fila, un):
+    # Els elements incrustats (i les files d'una llista) porten la miniatura, com a resposta_json;
+    # el validador del model deixa tal qual les URL que ja hi són
+    fila = dict(fila) if un else _miniatures(fila)
+    for camp, valor in fila.items():
+        if camp.endswith("_detall"):
+            fila[camp] = [_miniatures(fill) for fill in valor]
+    return fila
+
+
+def resposta_expandida(files, model, camps, include, expand, un=False):
+    # Els camps que el model afegeix al de base només surten si s'han demanat; fields= retalla la resta
+    extres = set(model.__fields__) - set(model.__base__.__fields__)
+    demanats = include | expand | {f"{nom}_detall" for nom in expand}
+    visibles = camps if camps is not None else set(model.__fields__) - extres
+    cos = [model(**_amb_miniatures(fila, un)).dict(include=visibles | demanats) for fila in files]
+    return JSONResponse(jsonable_encoder(cos[0] if un else cos))
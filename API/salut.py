@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import os
+import time
+
+import credencials
+from db import REPLIQUES, connexio, obrir_pool
+from etags import versions
+from migracions import consultes_rutes
+from models import Comentari, Llista, Titol, Usuari
+from serialitzacio import projeccio
+
+# Segons que l'arrencada espera l'escalfament abans de començar a acceptar peticions; si no
+# acaba a temps (p. ex. la base de dades encara no respon) es reintenta en segon pla
+ESCALFAMENT_TIMEOUT = float(os.getenv('ESCALFAMENT_TIMEOUT', '30'))
+ESCALFAMENT_REINTENT = float(os.getenv('ESCALFAMENT_REINTENT', '5'))
+# Segons màxims de la consulta de comprovació de /salut/preparat
+SALUT_TIMEOUT = float(os.getenv('SALUT_TIMEOUT', '2'))
+
+log = logging.getLogger("popview.salut")
+
+
+class Estat:
+    def __init__(self):
+        self.inici = time.monotonic()
+        self.escalfat = False
+        self.tancant = False
+        self.error = None
+        self.durada_escalfament = None
+
+
+estat = Estat()
+
+
+async def _escalfar():
+    inici = time.monotonic()
+    # Connexions del pool obertes abans de la primera petició
+    await obrir_pool()
+    # Versions de les taules (ETags) i projeccions de serialització
+    await versions.obtenir()
+    for model in (Titol, Llista, Usuari, Comentari):
+        projeccio(model)
+        projeccio(model, miniatures=True)
+    # Processos de credencials arrencats abans de la primera alta
+    await credencials.escalfar()
+    # Una execució de cada consulta de les rutes: el servidor en deixa les taules obertes i
+    # les pàgines d'índex a memòria
+    async with connexio() as db:
+        for _, query, params in consultes_rutes():
+            await db.fetchall(query, params)
+    estat.durada_escalfament = time.monotonic() - inici
+
+
+async def escalfar():
+    try:
+        await asyncio.wait_for(_escalfar(), ESCALFAMENT_TIMEOUT)
+    except Exception as e:
+        estat.error = f"{type(e).__name__}: {e}"
+        log.warning("L'escalfament ha fallat (%s); es reintenta cada %s s", estat.error, ESCALFAMENT_REINTENT)
+        asyncio.get_running_loop().create_task(_reintentar())
+        return
+    estat.escalfat, estat.error = True, None
+    log.info("Escalfament fet en %.2f s", estat.durada_escalfament)
+
+
+async def _reintentar():
+    while not estat.escalfat and not estat.tancant:
+        await asyncio.sleep(ESCALFAMENT_REINTENT)
+        try:
+            await _escalfar()
+        except Exception as e:
+            estat.error = f"{type(e).__name__}: {e}"
+            continue
+        estat.escalfat, estat.error = True, None
+        log.info("Escalfament fet en %.2f s", estat.durada_escalfament)
+
+
+def viu():
+    return {"estat": "viu", "pid": os.getpid(), "temps_actiu_s": round(time.monotonic() - estat.inici, 1)}
+
+
+async def preparat():
+    # (preparat, detall): escalfat, sense tancar i amb la base de dades responent
+    detall = {"pid": os.getpid(), "escalfat": estat.escalfat, "tancant": estat.tancant}
+    if estat.durada_escalfament is not None:
+        detall["escalfament_s"] = round(estat.durada_escalfament, 3)
+    if estat.error is not None:
+        detall["error"] = estat.error
+    if REPLIQUES:
+        # Informatiu: sense rèpliques sanes les lectures van a la primària
+        detall["repliques"] = {replica.nom: {"sana": replica.sana, "retard_s": replica.retard}
+                               for replica in REPLIQUES}
+    if not estat.escalfat or estat.tancant:
+        return False, detall
+    try:
+        async with connexio(primaria=True) as db:
+            await asyncio.wait_for(db.fetchone("SELECT 1"), SALUT_TIMEOUT)
+    except Exception as e:
+        detall["error"] = f"{type(e).__name__}: {e}"
+        return False, detall
+    return True, detall
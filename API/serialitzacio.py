@@ -0,0 +1,106 @@
+import datetime
+import decimal
+import json
+import os
+import typing
+
+from fastapi.responses import Response
+
+import imatges
+
+try:
+    import orjson
+except ImportError:  # Sense orjson es fa servir el mòdul json, més lent però amb la mateixa sortida
+    orjson = None
+
+# Amb VALIDAR_RESPOSTES=1 (depuració, proves) les files passen pel model de Pydantic com abans
+VALIDAR_RESPOSTES = os.getenv('VALIDAR_RESPOSTES', '0') == '1'
+
+
+def _per_defecte(valor):
+    if isinstance(valor, decimal.Decimal):
+        return float(valor)
+    if isinstance(valor, (datetime.date, datetime.datetime)):
+        return valor.isoformat()
+    raise TypeError(f"No es pot serialitzar {type(valor).__name__}")
+
+
+def a_json(contingut):
+    if orjson is not None:
+        return orjson.dumps(contingut, default=_per_defecte)
+    return json.dumps(contingut, default=_per_defecte, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _opcional(conversio):
+    return lambda valor: None if valor is None else conversio(valor)
+
+
+def _llista_text(valor):
+    # Columnes de llista que la consulta retorna com a text separat per comes (CONCAT_WS)
+    if isinstance(valor, str):
+        return [int(element) for element in valor.split(",")] if valor else None
+    return valor
+
+
+def _conversio(nom, tipus, miniatures):
+    # Només els tipus que la base de dades no retorna ja en la forma del JSON
+    if nom in imatges.CAMPS:
+        # Nom del magatzem -> URL; a les llistes, la de la miniatura
+        return imatges.url_miniatura if miniatures else imatges.url
+    if typing.get_origin(tipus) is typing.Union:
+        arguments = [argument for argument in typing.get_args(tipus) if argument is not type(None)]
+        tipus = arguments[0] if len(arguments) == 1 else tipus
+    if tipus is bool:
+        return _opcional(bool)  # BOOLEAN és TINYINT: arriba com a 0/1
+    if tipus is float:
+        return _opcional(float)  # SUM/AVG poden arribar com a Decimal
+    if typing.get_origin(tipus) is list:
+        return _llista_text
+    return None
+
+
+def _defecte(camp):
+    valor = getattr(camp, "default", None)
+    return None if valor is Ellipsis or type(valor).__name__ == "PydanticUndefinedType" else valor
+
+
+_projeccions = {}
+
+
+def projeccio(model, miniatures=False):
+    # ({camp: valor per defecte}, [(camp, conversió)]) calculat un cop per model
+    if (model, miniatures) not in _projeccions:
+        tipus = typing.get_type_hints(model)
+        defectes = {nom: _defecte(camp) for nom, camp in model.__fields__.items()}
+        conversions = [(nom, _conversio(nom, tipus[nom], miniatures)) for nom in defectes]
+        _projeccions[model, miniatures] = (defectes, [(nom, conversio) for nom, conversio in conversions if conversio])
+    return _projeccions[model, miniatures]
+
+
+def projectar(fila, model, miniatures=False):
+    # Mateixa sortida que model(**fila).dict() per a files de confiança llegides de la base de dades
+    # (amb miniatures, les imatges són les de les llistes)
+    defectes, conversions = projeccio(model, miniatures)
+    resultat = {nom: fila.get(nom, defecte) for nom, defecte in defectes.items()}
+    for nom, conversio in conversions:
+        resultat[nom] = conversio(resultat[nom])
+    return resultat
+
+
+class RespostaJSON(Response):
+    media_type = "application/json"
+
+    def render(self, contingut):
+        return contingut if isinstance(contingut, bytes) else a_json(contingut)
+
+
+def resposta_json(files, model, headers=None, un=False):
+    # Substitueix el response_model de FastAPI per a les lectures: el decorador el manté per a
+    # l'OpenAPI, però en retornar una Response la ruta se salta la validació i jsonable_encoder.
+    # Les capçaleres de la Response injectada (ETag, cursor) s'han de passar explícitament.
+    # Les llistes porten la miniatura de cada imatge; un sol element, l'original
+    if VALIDAR_RESPOSTES:
+        cos = [model(**projectar(fila, model, not un)).dict() for fila in ([files] if un else files)]
+    else:
+        cos = [projectar(fila, model, not un) for fila in ([files] if un else files)]
+    return RespostaJSON(a_json(cos[0] if un else cos), headers=headers)
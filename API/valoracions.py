@@ -0,0 +1,163 @@
+import asyncio
+import datetime
+import math
+import sys
+import time
+
+from cache import invalidar_titols
+from db import connexio, preparada, tancar_pools
+
+# Histograma en passos de 0.5 entre 0 i 4: la cubeta i correspon al rating i / 2
+CUBETES = 9
+COLUMNES_HISTOGRAMA = [f"h{i}" for i in range(CUBETES)]
+
+# Columnes de les respostes Titol: les de la taula i l'agregat de valoracions.
+# Tota consulta que retorni títols ha de fer servir FROM_TITOL (o el JOIN equivalent)
+COLUMNES_TITOL = f"""t.*,
+    COALESCE(v.valoracions, 0) AS valoracions,
+    IF(v.valoracions > 0, v.mitjana, NULL) AS valoracio_mitjana,
+    CONCAT_WS(',', {', '.join('v.' + columna for columna in COLUMNES_HISTOGRAMA)}) AS histograma_valoracions,
+    COALESCE(v.nombre_comentaris, 0) AS nombre_comentaris"""
+JOIN_VALORACIO = "LEFT JOIN titol_valoracio v ON v.titol_id = t.id"
+FROM_TITOL = f"SELECT {COLUMNES_TITOL} FROM titol t {JOIN_VALORACIO}"
+
+SQL_TAULA = f"""
+    CREATE TABLE IF NOT EXISTS titol_valoracio (
+        titol_id INT PRIMARY KEY,
+        valoracions INT NOT NULL DEFAULT 0,
+        suma DOUBLE NOT NULL DEFAULT 0,
+        mitjana DOUBLE NOT NULL DEFAULT 0,
+        {', '.join(f'{columna} INT NOT NULL DEFAULT 0' for columna in COLUMNES_HISTOGRAMA)},
+        nombre_comentaris INT NOT NULL DEFAULT 0,
+        INDEX idx_titol_valoracio_mitjana (mitjana DESC, titol_id),
+        FOREIGN KEY (titol_id) REFERENCES titol(id) ON DELETE CASCADE
+    )
+"""
+
+# Columna afegida a la migració 8 (les instal·lacions noves ja la creen a la 4)
+SQL_COLUMNA_COMENTARIS = "ALTER TABLE titol_valoracio ADD COLUMN IF NOT EXISTS nombre_comentaris INT NOT NULL DEFAULT 0"
+
+# Migració 11: moment de l'últim rating de cada fila. Les escriptures diferides
+# (valoracions_diferides.py) només s'apliquen si són més noves que el que ja hi ha
+SQL_COLUMNA_VALORAT = "ALTER TABLE usuari_titol ADD COLUMN IF NOT EXISTS valorat DATETIME(6) NULL"
+
+# Migració 12: els esborrats de comentaris d'abans deixaven rating = 0, que és una puntuació
+# vàlida. Una fila sense comentari amb rating 0 no es distingeix d'un 0 posat amb PUT .../rating/
+# sense comentari; es tracta com a esborrada
+SQL_ESBORRATS_A_NULL = """
+    UPDATE usuari_titol SET rating = NULL
+    WHERE rating = 0 AND comentaris IS NULL AND comentat IS NULL
+"""
+
+# Les columnes s'assignen d'esquerra a dreta, així que mitjana ja veu els valors nous
+SQL_APLICAR = f"""
+    INSERT INTO titol_valoracio (titol_id, valoracions, suma, mitjana, {', '.join(COLUMNES_HISTOGRAMA)}, nombre_comentaris)
+    VALUES (%s, %s, %s, %s, {', '.join(['%s'] * CUBETES)}, %s)
+    ON DUPLICATE KEY UPDATE
+        valoracions = valoracions + VALUES(valoracions),
+        suma = suma + VALUES(suma),
+        {', '.join(f'{columna} = {columna} + VALUES({columna})' for columna in COLUMNES_HISTOGRAMA)},
+        nombre_comentaris = nombre_comentaris + VALUES(nombre_comentaris),
+        mitjana = IF(valoracions > 0, suma / valoracions, 0)
+"""
+
+# NULL és l'únic valor sense valoració: un rating 0 és una puntuació com les altres
+SQL_RECONSTRUIR = f"""
+    INSERT INTO titol_valoracio (titol_id, valoracions, suma, mitjana, {', '.join(COLUMNES_HISTOGRAMA)}, nombre_comentaris)
+    SELECT t.id,
+           COUNT(ut.rating),
+           COALESCE(SUM(ut.rating), 0),
+           COALESCE(AVG(ut.rating), 0),
+           {', '.join(f'COALESCE(SUM(LEAST({CUBETES - 1}, GREATEST(0, ROUND(ut.rating * 2))) = {i}), 0)' for i in range(CUBETES))},
+           COALESCE(SUM(ut.comentaris IS NOT NULL), 0)
+    FROM titol t
+    LEFT JOIN usuari_titol ut ON ut.titol_id = t.id
+    GROUP BY t.id
+"""
+
+
+def cubeta(rating):
+    # Arrodoniment cap amunt a la meitat, igual que ROUND() de MariaDB per a positius
+    return min(CUBETES - 1, max(0, int(math.floor(rating * 2 + 0.5))))
+
+
+def fila_delta(titol_id, anterior, nou, comentaris=0):
+    # anterior i nou són el rating d'abans i el de després; None vol dir que no n'hi ha.
+    # comentaris: +1 si la fila passa a tenir comentari, -1 si el perd
+    histograma = [0] * CUBETES
+    if anterior is not None:
+        histograma[cubeta(anterior)] -= 1
+    if nou is not None:
+        histograma[cubeta(nou)] += 1
+    valoracions = (nou is not None) - (anterior is not None)
+    suma = (nou or 0) - (anterior or 0)
+    mitjana = suma / valoracions if valoracions > 0 else 0
+    return (titol_id, valoracions, suma, mitjana, *histograma, comentaris)
+
+
+async def aplicar_canvis(db, canvis):
+    # Actualitza l'agregat dins la transacció de l'escriptura (una transaccio())
+    # i en treu de la memòria cau els títols que canvien.
+    # canvis: [(titol_id, anterior, nou)] o [(titol_id, anterior, nou, delta de comentaris)]
+    files = [fila_delta(*canvi) for canvi in canvis if canvi[1] != canvi[2] or any(canvi[3:])]
+    if files:
+        await db.executemany(SQL_APLICAR, files)
+        await invalidar_titols(db, [fila[0] for fila in files])
+
+
+def moment_valoracio(segons=None):
+    # Valor de usuari_titol.valorat: hora UTC de l'API (no NOW() del servidor) perquè els ratings
+    # diferits porten la de la seva petició i s'han de poder comparar amb els directes
+    segons = time.time() if segons is None else segons
+    return datetime.datetime.fromtimestamp(segons, datetime.timezone.utc).replace(tzinfo=None)
+
+
+SQL_RATING_ACTUAL = preparada("""
+    SELECT rating, comentaris IS NOT NULL AS te_comentari
+    FROM usuari_titol WHERE usuari_id = %s AND titol_id = %s FOR UPDATE
+""")
+
+
+async def rating_actual(db, usuari_id, titol_id):
+    # Bloqueja la fila perquè dues escriptures del mateix usuari no calculin el delta amb el mateix valor
+    fila = await db.fetchone(SQL_RATING_ACTUAL, (usuari_id, titol_id))
+    return None if fila is None else fila["rating"]
+
+
+async def valoracio_actual(db, usuari_id, titol_id):
+    # (rating, té comentari) amb la fila bloquejada, per a les escriptures de comentaris
+    fila = await db.fetchone(SQL_RATING_ACTUAL, (usuari_id, titol_id))
+    return (None, False) if fila is None else (fila["rating"], bool(fila["te_comentari"]))
+
+
+async def crear_agregats(db, titol_ids):
+    # Cada títol té la seva fila a titol_valoracio perquè l'ordenació per valoració el trobi
+    if titol_ids:
+        await db.executemany("INSERT IGNORE INTO titol_valoracio (titol_id) VALUES (%s)",
+                             [(titol_id,) for titol_id in titol_ids])
+
+
+async def reconstruir():
+    async with connexio() as db:
+        await db.execute("DELETE FROM titol_valoracio")
+        await db.execute(SQL_RECONSTRUIR)
+        await db.commit()
+
+
+def reconstruir_sync(cursor):
+    # Pas de migració: el runner fa servir mysql.connector directament
+    cursor.execute("DELETE FROM titol_valoracio")
+    cursor.execute(SQL_RECONSTRUIR)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["reconstruir"]:
+        sys.exit("Ús: python valoracions.py reconstruir")
+
+    async def executar():
+        try:
+            await reconstruir()
+        finally:
+            await tancar_pools()
+
+    asyncio.run(executar())
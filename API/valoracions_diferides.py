@@ -0,0 +1,325 @@
+import asyncio
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+import anyio
+
+from db import transaccio
+from etags import versions
+from metriques import BUCKETS_LATENCIA, Comptador, Histograma, registre
+from recomanacions import marcar_pendents
+from valoracions import aplicar_canvis, moment_valoracio
+
+# Escriptura diferida de PUT /usuaris/{u}/titols/{t}/rating/: els ratings s'acumulen en memòria
+# (només l'últim per usuari i títol) i s'escriuen per lots. Desactivat per defecte
+VALORACIONS_DIFERIDES = os.getenv('VALORACIONS_DIFERIDES', '0') == '1'
+# Es buida el buffer quan arriba a aquestes claus o, com a molt tard, cada tants segons
+VALORACIONS_LOT = int(os.getenv('VALORACIONS_LOT', '500'))
+VALORACIONS_INTERVAL = float(os.getenv('VALORACIONS_INTERVAL', '0.5'))
+# Diari append-only que es reprodueix en arrencar si un procés ha mort amb ratings al buffer
+VALORACIONS_DIR = os.getenv('VALORACIONS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            'valoracions_pendents'))
+# 1: fsync a cada rating (sobreviu a una caiguda de la màquina). 0: fsync a cada interval; una
+# caiguda del procés no perd res, una de la màquina com a molt VALORACIONS_INTERVAL segons
+VALORACIONS_FSYNC = os.getenv('VALORACIONS_FSYNC', '0') == '1'
+
+BUCKETS_LOT = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# El SELECT previ garanteix que la fila existeix: l'upsert sempre actualitza. executemany
+# el reescriu en un sol INSERT de diverses files
+SQL_ESCRIURE = """
+    INSERT INTO usuari_titol (usuari_id, titol_id, rating, valorat) VALUES (%s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE rating = VALUES(rating), valorat = VALUES(valorat)
+"""
+
+log = logging.getLogger("popview.valoracions")
+
+valoracions_diferides = registre.afegir(Comptador(
+    "popview_valoracions_diferides_total", "Ratings passats pel buffer d'escriptura diferida", ("resultat",)))
+mida_lots = registre.afegir(Histograma(
+    "popview_valoracions_lot_mida", "Claus (usuari, títol) escrites per lot", BUCKETS_LOT))
+retard_lots = registre.afegir(Histograma(
+    "popview_valoracions_retard_segons", "Temps entre el primer rating pendent d'un lot i el commit",
+    BUCKETS_LATENCIA + (30, 60)))
+
+
+def sql_bloquejar(claus):
+    return f"""
+        SELECT usuari_id, titol_id, rating, valorat FROM usuari_titol
+        WHERE (usuari_id, titol_id) IN ({', '.join(['(%s, %s)'] * len(claus))})
+        FOR UPDATE
+    """
+
+
+class Diari:
+    # Segments append-only d'un procés a VALORACIONS_DIR: <id>.lock, bloquejat amb flock mentre
+    # el procés viu, i <id>.<n>.log amb una línia JSON [usuari_id, titol_id, rating, valorat] per
+    # rating (rating null: descartat per una escriptura directa posterior; valorat: segons UTC de
+    # la petició). S'hi escriu des dels fils d'AnyIO: el lock protegeix el canvi de segment
+    def __init__(self, directori):
+        self.directori = directori
+        # L'id no és només el pid: dins un contenidor els pids es repeteixen entre arrencades
+        self.id = f"{os.getpid()}-{os.urandom(4).hex()}"
+        self.segment = 0
+        self._lock = None
+        self._fitxer = None
+        self._escrivint = threading.Lock()
+
+    def _cami(self, nom):
+        return os.path.join(self.directori, nom)
+
+    def obrir(self):
+        os.makedirs(self.directori, exist_ok=True)
+        self._lock = open(self._cami(f"{self.id}.lock"), "w")
+        fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._obrir_segment()
+
+    def _obrir_segment(self):
+        self.segment += 1
+        self._fitxer = open(self._cami(f"{self.id}.{self.segment}.log"), "a", encoding="utf-8")
+
+    def _segments(self, id_diari):
+        camins = glob.glob(self._cami(f"{glob.escape(id_diari)}.*.log"))
+        return sorted(camins, key=lambda cami: int(cami.rsplit(".", 2)[1]))
+
+    def escriure(self, entrades, sincronitzar=VALORACIONS_FSYNC):
+        with self._escrivint:
+            self._fitxer.write("".join(json.dumps(entrada) + "\n" for entrada in entrades))
+            self._fitxer.flush()
+            if sincronitzar:
+                os.fsync(self._fitxer.fileno())
+
+    def sincronitzar(self):
+        with self._escrivint:
+            os.fsync(self._fitxer.fileno())
+
+    def rotar(self):
+        # Els ratings nous van al segment següent; retorna el que es pot esborrar després del commit
+        with self._escrivint:
+            anterior = self.segment
+            self._fitxer.close()
+            self._obrir_segment()
+            return anterior
+
+    def esborrar_fins(self, segment):
+        for cami in self._segments(self.id):
+            if int(cami.rsplit(".", 2)[1]) <= segment:
+                os.remove(cami)
+
+    def recuperar(self):
+        # Diaris de processos morts (el seu .lock es pot bloquejar): les entrades passen al
+        # segment actual abans d'esborrar els seus fitxers, així no hi ha cap moment sense còpia
+        entrades = []
+        for cami_lock in sorted(glob.glob(self._cami("*.lock"))):
+            id_diari = os.path.basename(cami_lock)[:-len(".lock")]
+            if id_diari == self.id:
+                continue
+            try:
+                lock = open(cami_lock)
+            except FileNotFoundError:  # Un altre worker l'acaba de recuperar
+                continue
+            with lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:  # El procés és viu
+                    continue
+                segments = self._segments(id_diari)
+                recuperades = []
+                for cami in segments:
+                    with open(cami, encoding="utf-8") as fitxer:
+                        for linia in fitxer:
+                            try:
+                                usuari_id, titol_id, rating, *resta = json.loads(linia)
+                            except ValueError:  # Línia a mig escriure quan el procés va morir
+                                continue
+                            # Diaris d'abans de valorat: més antics que qualsevol escriptura directa
+                            recuperades.append((usuari_id, titol_id, rating, resta[0] if resta else 0))
+                if recuperades:
+                    self.escriure(recuperades, sincronitzar=True)
+                for cami in segments:
+                    os.remove(cami)
+                os.remove(cami_lock)
+                entrades.extend(recuperades)
+                log.info("Recuperats %s ratings del diari %s", len(recuperades), id_diari)
+        return entrades
+
+    def tancar(self, net):
+        # net: no queda res pendent i el diari es pot esborrar
+        with self._escrivint:
+            self._fitxer.close()
+        if net:
+            self.esborrar_fins(self.segment)
+            os.remove(self._cami(f"{self.id}.lock"))
+        self._lock.close()
+
+
+class BufferValoracions:
+    def __init__(self, lot, interval, directori):
+        self.lot = lot
+        self.interval = interval
+        self.directori = directori
+        self.actiu = False
+        # (usuari_id, titol_id) -> (rating, moment del primer rating pendent de la clau,
+        #                         segons UTC de la petició del rating)
+        self.pendents = {}
+        self.en_curs = {}
+        self.diari = None
+        self._buidant = asyncio.Lock()
+        self._despertar = asyncio.Event()
+        self._aturant = False
+        self._tasca = None
+
+    def estadistiques(self):
+        return {"pendents": len(self.pendents), "en_curs": len(self.en_curs)}
+
+    def _posar(self, usuari_id, titol_id, rating, moment, valorat):
+        clau = (usuari_id, titol_id)
+        if rating is None:
+            self.pendents.pop(clau, None)
+            return
+        anterior = self.pendents.get(clau)
+        if anterior is not None:
+            valoracions_diferides.inc("coalescida")
+            if anterior[2] > valorat:  # Dues peticions de la mateixa clau acabades en un altre ordre
+                return
+            moment = anterior[1]
+        self.pendents[clau] = (rating, moment, valorat)
+
+    async def iniciar(self):
+        if not VALORACIONS_DIFERIDES:
+            return
+        self.diari = Diari(self.directori)
+        self.diari.obrir()
+        ara = time.monotonic()
+        recuperades = self.diari.recuperar()
+        for usuari_id, titol_id, rating, valorat in recuperades:
+            self._posar(usuari_id, titol_id, rating, ara, valorat)
+        valoracions_diferides.inc("recuperada", valor=len(recuperades))
+        self.actiu = True
+        self._tasca = asyncio.get_running_loop().create_task(self._bucle())
+
+    async def aturar(self):
+        if not self.actiu:
+            return
+        self.actiu = False
+        # Sense cancel·lar el bucle: un lot a mitges s'acaba (o torna els ratings al buffer) abans
+        # de l'últim buidat, i el diari només s'esborra si no queda res per escriure
+        self._aturant = True
+        self._despertar.set()
+        await self._tasca
+        net = False
+        try:
+            await self.buidar()
+            net = not self.pendents and not self.en_curs
+        except Exception as e:
+            log.warning("No s'han pogut escriure %s ratings en aturar (%s); queden al diari", len(self.pendents), e)
+        self.diari.tancar(net)
+
+    async def afegir(self, usuari_id, titol_id, rating):
+        # El rating no s'accepta fins que és al diari. Entra al buffer abans d'escriure'l (en un
+        # fil, fora del bucle): si el lot que el recull rota el segment, la línia va a un segment
+        # que no s'esborra fins que el rating és a la base de dades
+        valorat = time.time()
+        self._posar(usuari_id, titol_id, rating, time.monotonic(), valorat)
+        try:
+            await anyio.to_thread.run_sync(self.diari.escriure, [(usuari_id, titol_id, rating, valorat)])
+        except Exception:
+            if self.pendents.get((usuari_id, titol_id), (None, None, None))[2] == valorat:
+                del self.pendents[usuari_id, titol_id]
+            raise
+        valoracions_diferides.inc("encuada")
+        if len(self.pendents) >= self.lot:
+            self._despertar.set()
+
+    async def descartar(self, usuari_id, titol_id):
+        # Una escriptura directa de la mateixa fila (comentaris) és més nova que el rating
+        # pendent: es descarta, i si ja s'està escrivint s'espera que acabi el lot. Només afecta
+        # aquest procés; entre workers ho resol valorat (_escriure)
+        if not self.actiu:
+            return
+        clau = (usuari_id, titol_id)
+        if clau in self.pendents:
+            del self.pendents[clau]
+            await anyio.to_thread.run_sync(self.diari.escriure, [(usuari_id, titol_id, None, time.time())])
+            valoracions_diferides.inc("descartada")
+        if clau in self.en_curs:
+            async with self._buidant:
+                pass
+
+    async def _bucle(self):
+        while not self._aturant:
+            try:
+                await asyncio.wait_for(self._despertar.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._despertar.clear()
+            if self._aturant:
+                return
+            try:
+                if not VALORACIONS_FSYNC:
+                    await anyio.to_thread.run_sync(self.diari.sincronitzar)
+                await self.buidar()
+            except Exception as e:
+                log.warning("Error escrivint les valoracions diferides (%s); es reintenta", e)
+
+    async def buidar(self):
+        async with self._buidant:
+            if not self.pendents:
+                return
+            # Primer la rotació i després el canvi de buffer: un rating que entra entremig o
+            # és al lot o té la línia al segment nou
+            segment = await anyio.to_thread.run_sync(self.diari.rotar)
+            self.en_curs, self.pendents = self.pendents, {}
+            claus = sorted(self.en_curs)  # Sempre el mateix ordre de bloqueig: sense deadlocks entre lots
+            try:
+                for inici in range(0, len(claus), self.lot):
+                    await self._escriure(claus[inici:inici + self.lot])
+            except BaseException:
+                # El que no s'ha tornat a valorar mentrestant torna al buffer, també si la tasca es
+                # cancel·la; el segment es queda fins al proper lot bo (tornar a escriure un rating
+                # ja escrit no canvia res)
+                for clau, valor in self.en_curs.items():
+                    self.pendents.setdefault(clau, valor)
+                raise
+            finally:
+                self.en_curs = {}
+            await anyio.to_thread.run_sync(self.diari.esborrar_fins, segment)
+
+    async def _escriure(self, claus):
+        async with transaccio() as db:
+            files = await db.fetchall(sql_bloquejar(claus), tuple(valor for clau in claus for valor in clau))
+            fila_de = {(fila["usuari_id"], fila["titol_id"]): fila for fila in files}
+            actuals = {clau: fila["rating"] for clau, fila in fila_de.items()}
+            # Les files que ja no hi són (usuari o títol esborrats, o mai valorades) es descarten, i
+            # també les que ja tenen un rating més nou: una escriptura directa o el lot d'un altre
+            # worker amb una petició posterior. Així l'ordre és el de les peticions, no el dels lots
+            moments = {clau: moment_valoracio(self.en_curs[clau][2]) for clau in claus}
+            existents = [clau for clau in claus if clau in fila_de]
+            superades = [clau for clau in existents
+                         if fila_de[clau]["valorat"] is not None and fila_de[clau]["valorat"] >= moments[clau]]
+            existents = [clau for clau in existents if clau not in superades]
+            if existents:
+                nous = {clau: self.en_curs[clau][0] for clau in existents}
+                await aplicar_canvis(db, [(titol_id, actuals[(usuari_id, titol_id)], rating)
+                                          for (usuari_id, titol_id), rating in nous.items()])
+                await db.executemany(SQL_ESCRIURE, [(*clau, rating, moments[clau]) for clau, rating in nous.items()])
+                canviades = [clau for clau in existents if actuals[clau] != nous[clau]]
+                if canviades:
+                    titols = sorted({titol_id for _, titol_id in canviades})
+                    await marcar_pendents(db, titols=titols, usuaris=sorted({usuari_id for usuari_id, _ in canviades}))
+                    await versions.incrementar(db, "titol_valoracio", "usuari_titol")
+        mida_lots.observar(len(claus))
+        retard_lots.observar(time.monotonic() - min(self.en_curs[clau][1] for clau in claus))
+        valoracions_diferides.inc("escrita", valor=len(existents))
+        valoracions_diferides.inc("superada", valor=len(superades))
+        valoracions_diferides.inc("sense_fila", valor=len(claus) - len(existents) - len(superades))
+
+
+buffer_valoracions = BufferValoracions(VALORACIONS_LOT, VALORACIONS_INTERVAL, VALORACIONS_DIR)
+registre.afegir_indicadors("popview_valoracions_diferides", "Estat del buffer d'escriptura diferida",
+                           buffer_valoracions.estadistiques)
@@ -0,0 +1,150 @@
+# Latència de GET /titols/cerca sobre un corpus gran.
+#
+#   docker compose -f bench/docker-compose.yaml up -d
+#   DB_HOST=127.0.0.1 python API/db.py
+#   DB_HOST=127.0.0.1 python bench/bench_cerca.py --titols 500000 --duracio 30 --p95-maxim 20
+#
+# Omple la taula amb títols sintètics (via POST /titols/lot en NDJSON) si en té menys dels
+# demanats, i llança cerques completes, de prefix (typeahead) i amb filtres. Surt amb codi 1
+# si el p95 supera --p95-maxim.
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+
+from bench_db_mode import DIR_API, esperar_servidor, percentil
+
+PARAULES = [
+    "amor", "guerra", "estrella", "nit", "ciutat", "mar", "foc", "ombra", "rei", "reina", "drac",
+    "viatge", "secret", "somni", "perdut", "última", "família", "muntanya", "riu", "bosc", "temps",
+    "futur", "passat", "silenci", "tempesta", "llum", "camí", "fill", "germans", "illa", "ferro",
+    "vidre", "espasa", "imperi", "planeta", "lluna", "sol", "hivern", "estiu", "tardor",
+]
+PLATAFORMES = ["Netflix", "HBO", "Disney+", "Prime Video", "Filmin", "Apple TV+"]
+GENERES = ["Drama", "Comèdia", "Acció", "Terror", "Animació", "Documental", "Ciència-ficció"]
+
+
+def titol_aleatori(generador):
+    nom = " ".join(generador.choice(PARAULES) for _ in range(generador.randint(1, 4))).capitalize()
+    return {
+        "nom": nom,
+        "descripcio": " ".join(generador.choice(PARAULES) for _ in range(generador.randint(8, 30))),
+        "plataformes": ", ".join(generador.sample(PLATAFORMES, generador.randint(1, 2))),
+        "rating": generador.choice([1, 2, 3, 4]),
+        "genero": generador.choice(GENERES),
+        "edadRecomendada": generador.choice([0, 7, 12, 16, 18]),
+    }
+
+
+async def sembrar(url, titols, lot=5000):
+    generador = random.Random(11)
+    async with httpx.AsyncClient(base_url=url, timeout=600) as client:
+        existents = 0
+        cursor = None
+        # Compta per pàgines grans; és més barat que afegir un endpoint de recompte
+        while True:
+            params = {"limit": 1000}
+            if cursor:
+                params["after"] = cursor
+            resposta = await client.get("/titols/", params=params)
+            existents += len(resposta.json())
+            cursor = resposta.headers.get("x-next-cursor")
+            if not cursor or existents >= titols:
+                break
+        pendents = titols - existents
+        while pendents > 0:
+            mida = min(lot, pendents)
+            cos = "\n".join(json.dumps(titol_aleatori(generador)) for _ in range(mida))
+            resposta = await client.post("/titols/lot", content=cos.encode(),
+                                         headers={"content-type": "application/x-ndjson"})
+            resposta.raise_for_status()
+            pendents -= mida
+            print(f"  sembrats {titols - pendents}/{titols}", file=sys.stderr)
+
+
+def cerca_aleatoria(generador):
+    tipus = generador.random()
+    if tipus < 0.4:
+        # Typeahead: una paraula sencera i el començament de la següent
+        primera, segona = generador.sample(PARAULES, 2)
+        params = {"q": f"{primera} {segona[:generador.randint(2, len(segona))]}"}
+    elif tipus < 0.7:
+        params = {"q": " ".join(generador.sample(PARAULES, generador.randint(1, 3)))}
+    else:
+        params = {"q": generador.choice(PARAULES),
+                  "plataforma": generador.choice(PLATAFORMES),
+                  "genero": generador.choice(GENERES),
+                  "edat_maxima": generador.choice([7, 12, 16])}
+    return params
+
+
+async def carrega(url, duracio, concurrencia):
+    latencies = []
+    errors = 0
+    final = time.monotonic() + duracio
+
+    async def treballador(client, llavor):
+        nonlocal errors
+        generador = random.Random(llavor)
+        while time.monotonic() < final:
+            inici = time.perf_counter()
+            resposta = await client.get("/titols/cerca", params=cerca_aleatoria(generador))
+            latencies.append(time.perf_counter() - inici)
+            if resposta.status_code >= 400:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrencia)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        await asyncio.gather(*(treballador(client, i) for i in range(concurrencia)))
+    return latencies, errors
+
+
+async def principal():
+    parser = argparse.ArgumentParser(description="Benchmark de /titols/cerca")
+    parser.add_argument("--titols", type=int, default=500000)
+    parser.add_argument("--duracio", type=float, default=30)
+    parser.add_argument("--concurrencia", type=int, default=16)
+    parser.add_argument("--p95-maxim", type=float, default=20, help="Llindar de p95 en ms")
+    parser.add_argument("--port", type=int, default=8801)
+    parser.add_argument("--sortida", help="Fitxer JSON on desar els resultats")
+    args = parser.parse_args()
+
+    url = f"http://127.0.0.1:{args.port}"
+    servidor = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+        cwd=DIR_API, env=dict(os.environ),
+    )
+    try:
+        await esperar_servidor(url)
+        await sembrar(url, args.titols)
+        await carrega(url, 2, args.concurrencia)
+        latencies, errors = await carrega(url, args.duracio, args.concurrencia)
+    finally:
+        servidor.terminate()
+        servidor.wait()
+
+    resultat = {
+        "titols": args.titols,
+        "peticions": len(latencies),
+        "errors": errors,
+        "peticions_s": round(len(latencies) / args.duracio, 1),
+        "p50_ms": round(percentil(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentil(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentil(latencies, 99) * 1000, 2),
+    }
+    print(f"{resultat['peticions_s']} pet/s  p50 {resultat['p50_ms']} ms  p95 {resultat['p95_ms']} ms  "
+          f"p99 {resultat['p99_ms']} ms  errors {errors}")
+    if args.sortida:
+        with open(args.sortida, "w") as fitxer:
+            json.dump(resultat, fitxer, indent=2)
+    return 0 if resultat["p95_ms"] <= args.p95_maxim and not errors else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(principal()))
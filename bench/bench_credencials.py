@@ -0,0 +1,116 @@
+# Latència de les lectures durant un pic d'altes d'usuari (hash argon2 de cada contrasenya).
+#
+#   docker compose -f bench/docker-compose.yaml up -d
+#   DB_HOST=127.0.0.1 python API/migracions.py
+#   DB_HOST=127.0.0.1 python bench/bench_credencials.py --duracio 15 --altes 32
+#
+# Arrenca el perfil de producció (gunicorn.conf.py, --workers workers amb DB_MODE=sync: les
+# consultes van als fils d'AnyIO) per a cada manera de fer els hashes: als mateixos fils que les
+# consultes (CREDENCIALS_PROCESSOS=0) i als pools de processos de credencials.py, amb
+# --processos processos per a tota la màquina repartits entre els workers. Per a cadascuna
+# mesura el p99 de GET /titols/{id} sol i amb --altes clients fent POST /usuaris/ sense parar.
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+
+from bench_db_mode import DIR_API, esperar_servidor, percentil, sembrar
+
+
+async def carrega(url, duracio, lectors, altes, max_id):
+    lectures = []
+    registres = []
+    final = time.monotonic() + duracio
+
+    async def lector(client):
+        while time.monotonic() < final:
+            inici = time.perf_counter()
+            await client.get(f"/titols/{random.randint(1, max_id)}")
+            lectures.append(time.perf_counter() - inici)
+
+    async def alta(client):
+        while time.monotonic() < final:
+            inici = time.perf_counter()
+            resposta = await client.post("/usuaris/", json={
+                "nom": "Alta", "edat": 30, "correu": f"alta-{time.time_ns()}-{random.random()}@popview.cat",
+                "contrasenya": "una contrasenya prou llarga"})
+            if resposta.status_code == 200:
+                registres.append(time.perf_counter() - inici)
+
+    limits = httpx.Limits(max_connections=lectors + altes)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        await asyncio.gather(*(lector(client) for _ in range(lectors)), *(alta(client) for _ in range(altes)))
+    return lectures, registres
+
+
+async def mesurar(processos, args):
+    url = f"http://127.0.0.1:{args.port}"
+    entorn = dict(os.environ, DB_MODE="sync", WEB_SSL="0", WEB_BIND=f"127.0.0.1:{args.port}",
+                  WEB_WORKERS=str(args.workers), WEB_LOGLEVEL="warning")
+    entorn.pop("CREDENCIALS_PROCESSOS", None)
+    if processos == 0:
+        entorn["CREDENCIALS_PROCESSOS"] = "0"
+    else:
+        entorn["CREDENCIALS_PROCESSOS_MAQUINA"] = str(processos)
+    servidor = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app"],
+        cwd=DIR_API, env=entorn,
+    )
+    resultats = []
+    try:
+        await esperar_servidor(url)
+        await sembrar(url, args.titols)
+        await carrega(url, 2, args.lectors, 0, args.titols)
+        for altes in (0, args.altes):
+            lectures, registres = await carrega(url, args.duracio, args.lectors, altes, args.titols)
+            resultats.append({
+                "hashes": "fils" if processos == 0 else f"{processos} processos",
+                "workers": args.workers,
+                "altes_concurrents": altes,
+                "lectures_s": round(len(lectures) / args.duracio, 1),
+                "lectura_p50_ms": round(percentil(lectures, 50) * 1000, 2),
+                "lectura_p99_ms": round(percentil(lectures, 99) * 1000, 2),
+                "altes_s": round(len(registres) / args.duracio, 1),
+                "alta_p99_ms": round(percentil(registres, 99) * 1000, 2),
+            })
+    finally:
+        servidor.terminate()
+        servidor.wait()
+    return resultats
+
+
+async def principal():
+    parser = argparse.ArgumentParser(description="Lectures durant un pic d'altes amb hash de contrasenya")
+    parser.add_argument("--duracio", type=float, default=15)
+    parser.add_argument("--lectors", type=int, default=64)
+    parser.add_argument("--altes", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="WEB_WORKERS de gunicorn")
+    parser.add_argument("--processos", type=int, default=max(multiprocessing.cpu_count() // 2, 1),
+                        help="CREDENCIALS_PROCESSOS_MAQUINA del mode amb processos")
+    parser.add_argument("--titols", type=int, default=2000)
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--sortida", help="Fitxer JSON on desar els resultats")
+    args = parser.parse_args()
+
+    resultats = []
+    for processos in (0, args.processos):
+        for resultat in await mesurar(processos, args):
+            resultats.append(resultat)
+            print(f"{resultat['hashes']:>12} altes {resultat['altes_concurrents']:>3}: "
+                  f"{resultat['lectures_s']:>9} lect/s  p50 {resultat['lectura_p50_ms']:>7} ms  "
+                  f"p99 {resultat['lectura_p99_ms']:>8} ms  | {resultat['altes_s']:>6} altes/s  "
+                  f"p99 {resultat['alta_p99_ms']:>8} ms")
+    if args.sortida:
+        with open(args.sortida, "w") as fitxer:
+            json.dump(resultats, fitxer, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(principal())
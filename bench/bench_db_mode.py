@@ -0,0 +1,131 @@
+# Compara el mode async (aiomysql) amb el pool síncron (mysql.connector en fils).
+#
+#   docker compose -f bench/docker-compose.yaml up -d
+#   DB_HOST=127.0.0.1 python API/db.py
+#   DB_HOST=127.0.0.1 python bench/bench_db_mode.py --titols 2000 --duracio 20 --concurrencia 128
+#
+# Arrenca un uvicorn per mode amb la mateixa configuració i hi llança la mateixa
+# càrrega de lectures; mostra peticions/s i latències p50/p99.
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+
+DIR_API = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "API")
+
+
+def percentil(valors, p):
+    if not valors:
+        return 0.0
+    ordenats = sorted(valors)
+    index = min(len(ordenats) - 1, int(round(p / 100 * (len(ordenats) - 1))))
+    return ordenats[index]
+
+
+async def esperar_servidor(url, timeout=30):
+    limit = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < limit:
+            try:
+                await client.get(url + "/openapi.json")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"El servidor {url} no ha arrencat")
+
+
+async def sembrar(url, titols):
+    async with httpx.AsyncClient(base_url=url, timeout=30) as client:
+        resposta = await client.get("/titols/", params={"limit": 1})
+        if resposta.status_code == 200 and resposta.json():
+            return
+        for i in range(titols):
+            await client.post("/titols/", json={
+                "nom": f"Títol {i}",
+                "descripcio": "Descripció de prova " * 5,
+                "plataformes": random.choice(["Netflix", "HBO", "Disney+", "Prime Video"]),
+                "rating": random.choice([1, 2, 3, 4]),
+            })
+
+
+async def carrega(url, duracio, concurrencia, max_id):
+    latencies = []
+    errors = 0
+    final = time.monotonic() + duracio
+
+    async def treballador(client):
+        nonlocal errors
+        while time.monotonic() < final:
+            if random.random() < 0.8:
+                ruta = f"/titols/{random.randint(1, max_id)}"
+            else:
+                ruta = "/titols/?limit=50"
+            inici = time.perf_counter()
+            resposta = await client.get(ruta)
+            latencies.append(time.perf_counter() - inici)
+            if resposta.status_code >= 500:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrencia)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        await asyncio.gather(*(treballador(client) for _ in range(concurrencia)))
+    return latencies, errors
+
+
+async def mesurar(mode, args):
+    port = args.port
+    url = f"http://127.0.0.1:{port}"
+    entorn = dict(os.environ, DB_MODE=mode, DB_POOL_SIZE=str(args.pool))
+    servidor = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=DIR_API, env=entorn,
+    )
+    try:
+        await esperar_servidor(url)
+        await sembrar(url, args.titols)
+        # Escalfament perquè el pool i les connexions HTTP ja estiguin obertes
+        await carrega(url, 2, args.concurrencia, args.titols)
+        latencies, errors = await carrega(url, args.duracio, args.concurrencia, args.titols)
+    finally:
+        servidor.terminate()
+        servidor.wait()
+    return {
+        "mode": mode,
+        "peticions": len(latencies),
+        "errors": errors,
+        "peticions_s": round(len(latencies) / args.duracio, 1),
+        "p50_ms": round(percentil(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentil(latencies, 99) * 1000, 2),
+    }
+
+
+async def principal():
+    parser = argparse.ArgumentParser(description="Benchmark dels modes d'accés a la base de dades")
+    parser.add_argument("--modes", default="async,sync")
+    parser.add_argument("--duracio", type=float, default=20)
+    parser.add_argument("--concurrencia", type=int, default=128)
+    parser.add_argument("--titols", type=int, default=2000)
+    parser.add_argument("--pool", type=int, default=10)
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--sortida", help="Fitxer JSON on desar els resultats")
+    args = parser.parse_args()
+
+    resultats = []
+    for mode in args.modes.split(","):
+        resultat = await mesurar(mode, args)
+        resultats.append(resultat)
+        print(f"{mode:>6}: {resultat['peticions_s']:>9} pet/s  p50 {resultat['p50_ms']:>8} ms  "
+              f"p99 {resultat['p99_ms']:>8} ms  errors {resultat['errors']}")
+    if args.sortida:
+        with open(args.sortida, "w") as fitxer:
+            json.dump(resultats, fitxer, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(principal())
@@ -0,0 +1,164 @@
+# Pàgines de /titols/ amb imatges inline (data URI a titol.imatge) contra el magatzem d'imatges.
+#
+#   docker compose -f bench/docker-compose.yaml up -d
+#   DB_HOST=127.0.0.1 python API/migracions.py 9
+#   DB_HOST=127.0.0.1 python bench/bench_imatges.py --titols 300 --kb 150
+#
+# Insereix --titols títols amb una data URI JPEG de ~--kb KB directament a la taula (com les
+# que desaven els clients abans), i mesura bytes i latència de GET /titols/?limit=--pagina.
+# Després fa el pas de la migració 10 (imatges.extreure_existents_sync) i torna a mesurar;
+# finalment compara la primera petició de cada miniatura (generació) amb les següents (disc).
+# Les llistes ja no envien les data URI que queden: la fase inline mesura el cost de llegir les
+# files grosses, i els bytes que hi sumava la versió anterior es mostren a part.
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench_db_mode import DIR_API, esperar_servidor, percentil
+
+os.environ.setdefault("IMATGES_DIR", tempfile.mkdtemp())
+sys.path.insert(0, DIR_API)
+
+import mysql.connector  # noqa: E402
+from PIL import Image  # noqa: E402
+
+import imatges  # noqa: E402
+from db import db_config  # noqa: E402
+from paginacio import codificar_cursor  # noqa: E402
+
+
+def imatge_jpeg(kb):
+    # Soroll: JPEG gairebé incompressible d'unes kb KB, com una foto
+    costat = int((kb * 1024 / 0.9) ** 0.5)
+    sortida = io.BytesIO()
+    Image.frombytes("RGB", (costat, costat), os.urandom(costat * costat * 3)).save(sortida, "JPEG", quality=90)
+    return sortida.getvalue()
+
+
+def sembrar(titols, kb):
+    cnx = mysql.connector.connect(**db_config)
+    cursor = cnx.cursor()
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM titol")
+    primer = cursor.fetchone()[0] + 1
+    files = []
+    for i in range(titols):
+        uri = "data:image/jpeg;base64," + base64.b64encode(imatge_jpeg(kb)).decode()
+        files.append((uri, f"Pòster {i}", "Netflix", random.choice([1, 2, 3, 4])))
+    cursor.executemany("INSERT INTO titol (imatge, nom, plataformes, rating) VALUES (%s, %s, %s, %s)", files)
+    cnx.commit()
+    cursor.close()
+    cnx.close()
+    return primer, sum(len(uri) for uri, *_ in files) // titols
+
+
+def migrar():
+    cnx = mysql.connector.connect(**db_config)
+    cursor = cnx.cursor()
+    inici = time.perf_counter()
+    imatges.extreure_existents_sync(cursor)
+    cnx.commit()
+    cursor.close()
+    cnx.close()
+    return time.perf_counter() - inici
+
+
+async def pagines(url, primer, args):
+    params = {"limit": args.pagina, "after": codificar_cursor([primer - 1])}
+    latencies = []
+    mida = 0
+    async with httpx.AsyncClient(base_url=url, timeout=60) as client:
+        final = time.monotonic() + args.duracio
+        while time.monotonic() < final:
+            inici = time.perf_counter()
+            resposta = await client.get("/titols/", params=params)
+            latencies.append(time.perf_counter() - inici)
+            mida = len(resposta.content)
+            cos = resposta.json()
+    return latencies, mida, cos
+
+
+async def miniatures(url, pagina):
+    noms = [titol["imatge"] for titol in pagina if titol["imatge"]]
+    resultats = {}
+    async with httpx.AsyncClient(base_url=url, timeout=60) as client:
+        for passada in ("primera", "disc"):
+            latencies = []
+            for nom in noms:
+                inici = time.perf_counter()
+                await client.get(nom)
+                latencies.append(time.perf_counter() - inici)
+            resultats[passada] = latencies
+    return resultats
+
+
+def arrencar(args):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+        cwd=DIR_API, env=dict(os.environ),
+    )
+
+
+async def mesurar(nom, url, primer, args):
+    latencies, mida, cos = await pagines(url, primer, args)
+    resultat = {
+        "imatges": nom,
+        "bytes_pagina": mida,
+        "pagines_s": round(len(latencies) / args.duracio, 1),
+        "p50_ms": round(percentil(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentil(latencies, 99) * 1000, 2),
+    }
+    print(f"{nom:>10}: {mida:>10} bytes/pàgina  {resultat['pagines_s']:>8} pàg/s  "
+          f"p50 {resultat['p50_ms']:>8} ms  p99 {resultat['p99_ms']:>8} ms")
+    return resultat, cos
+
+
+async def principal():
+    parser = argparse.ArgumentParser(description="Llistes amb imatges inline contra el magatzem d'imatges")
+    parser.add_argument("--titols", type=int, default=300)
+    parser.add_argument("--kb", type=int, default=150, help="Mida aproximada de cada imatge")
+    parser.add_argument("--pagina", type=int, default=100)
+    parser.add_argument("--duracio", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--sortida", help="Fitxer JSON on desar els resultats")
+    args = parser.parse_args()
+
+    url = f"http://127.0.0.1:{args.port}"
+    primer, mida_uri = sembrar(args.titols, args.kb)
+    resultats = []
+    for fase in ("inline", "magatzem"):
+        if fase == "magatzem":
+            print(f"migració 10: {migrar():.1f} s")
+        servidor = arrencar(args)
+        try:
+            await esperar_servidor(url)
+            resultat, cos = await mesurar(fase, url, primer, args)
+            resultats.append(resultat)
+            if fase == "inline":
+                resultat["bytes_pagina_amb_data_uri"] = resultat["bytes_pagina"] + mida_uri * len(cos)
+                print(f"{'':>10}  {resultat['bytes_pagina_amb_data_uri']:>10} bytes/pàgina enviant les data URI")
+            if fase == "magatzem":
+                temps = await miniatures(url, cos)
+                for passada, latencies in temps.items():
+                    print(f"miniatures ({passada}): p50 {percentil(latencies, 50) * 1000:.2f} ms  "
+                          f"p99 {percentil(latencies, 99) * 1000:.2f} ms")
+                    resultat[f"miniatura_{passada}_p50_ms"] = round(percentil(latencies, 50) * 1000, 2)
+        finally:
+            servidor.terminate()
+            servidor.wait()
+    if args.sortida:
+        with open(args.sortida, "w") as fitxer:
+            json.dump(resultats, fitxer, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(principal())
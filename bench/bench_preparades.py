@@ -0,0 +1,128 @@
+# Sentències preparades contra protocol de text a la consulta més freqüent per id.
+#
+#   docker compose -f bench/docker-compose.yaml up -d
+#   DB_HOST=127.0.0.1 python API/db.py
+#   DB_HOST=127.0.0.1 python bench/bench_preparades.py --consultes 20000
+#
+# Executa la mateixa consulta amb ids aleatoris de tres maneres sobre una sola connexió:
+# un cursor de text nou per consulta (com feien les rutes), el cursor preparat que reaprofita
+# ConnexioSync (db.Preparades) i la consulta completa de GET /titols/{id}. Mostra consultes/s
+# i latències, els comptadors Com_stmt_* del servidor i, amb el profiling de MariaDB, el temps
+# mitjà de l'etapa "starting" (on el servidor analitza el text de la consulta).
+import argparse
+import json
+import random
+import sys
+import time
+
+from bench_db_mode import DIR_API, percentil
+
+sys.path.insert(0, DIR_API)
+
+import mysql.connector  # noqa: E402
+
+from db import Preparades, db_config  # noqa: E402
+from valoracions import FROM_TITOL  # noqa: E402
+
+CONSULTES = {
+    "titol": "SELECT * FROM titol WHERE id = %s",
+    "titol_amb_valoracions": f"{FROM_TITOL} WHERE t.id = %s",
+}
+# Consultes de les quals es llegeix el perfil (profiling_history_size és com a màxim 100)
+MOSTRES_PERFIL = 100
+
+
+def estat_sessio(cnx):
+    cursor = cnx.cursor()
+    cursor.execute("SHOW SESSION STATUS WHERE Variable_name IN ('Com_stmt_prepare', 'Com_stmt_execute', 'Questions')")
+    valors = {nom: int(valor) for nom, valor in cursor.fetchall()}
+    cursor.close()
+    return valors
+
+
+def temps_analisi(cnx):
+    # Mitjana (µs) de l'etapa "starting" de les últimes consultes amb profiling actiu
+    cursor = cnx.cursor()
+    cursor.execute("""
+        SELECT AVG(DURATION) * 1000000 FROM information_schema.PROFILING
+        WHERE STATE = 'starting'
+    """)
+    valor, = cursor.fetchone()
+    cursor.close()
+    return round(float(valor or 0), 2)
+
+
+def executar(cnx, mode, query, ids):
+    preparades = Preparades(cnx, 1)
+    latencies = []
+    cursor = cnx.cursor()
+    cursor.execute("SET profiling = 0")
+    cursor.close()
+    for index, titol_id in enumerate(ids):
+        if index == len(ids) - MOSTRES_PERFIL:
+            cursor = cnx.cursor()
+            cursor.execute(f"SET profiling_history_size = {MOSTRES_PERFIL}, profiling = 1")
+            cursor.close()
+        inici = time.perf_counter()
+        if mode == "text":
+            cursor = cnx.cursor(dictionary=True)
+            cursor.execute(query, (titol_id,))
+            cursor.fetchall()
+            cursor.close()
+        else:
+            cursor = preparades.cursor(query)
+            cursor.execute(query, (titol_id,))
+            cursor.fetchall()
+        latencies.append(time.perf_counter() - inici)
+    analisi = temps_analisi(cnx)
+    cursor = cnx.cursor()
+    cursor.execute("SET profiling = 0")
+    cursor.close()
+    return latencies, analisi
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sentències preparades contra protocol de text")
+    parser.add_argument("--consultes", type=int, default=20000)
+    parser.add_argument("--sortida", help="fitxer JSON amb els resultats")
+    args = parser.parse_args()
+
+    cnx = mysql.connector.connect(**db_config)
+    cursor = cnx.cursor()
+    cursor.execute("SELECT MIN(id), MAX(id) FROM titol")
+    minim, maxim = cursor.fetchone()
+    cursor.close()
+    if minim is None:
+        sys.exit("La taula titol és buida: omple-la primer (p. ex. bench/bench_cerca.py)")
+    generador = random.Random(1)
+    ids = [generador.randint(minim, maxim) for _ in range(args.consultes)]
+
+    resultats = []
+    for nom, query in CONSULTES.items():
+        for mode in ("text", "preparada"):
+            abans = estat_sessio(cnx)
+            inici = time.perf_counter()
+            latencies, analisi = executar(cnx, mode, query, ids)
+            durada = time.perf_counter() - inici
+            despres = estat_sessio(cnx)
+            resultat = {
+                "consulta": nom,
+                "mode": mode,
+                "consultes_s": round(len(ids) / durada, 1),
+                "p50_us": round(percentil(latencies, 50) * 1e6, 1),
+                "p99_us": round(percentil(latencies, 99) * 1e6, 1),
+                "analisi_us": analisi,
+                **{nom_estat: despres[nom_estat] - abans[nom_estat] for nom_estat in despres},
+            }
+            resultats.append(resultat)
+            print(f"{nom:<24} {mode:<10} {resultat['consultes_s']:>9} c/s  p50 {resultat['p50_us']:>7} µs  "
+                  f"p99 {resultat['p99_us']:>8} µs  starting {analisi:>6} µs  "
+                  f"prepare {resultat['Com_stmt_prepare']} execute {resultat['Com_stmt_execute']}")
+    cnx.close()
+    if args.sortida:
+        with open(args.sortida, "w") as fitxer:
+            json.dump(resultats, fitxer, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+# Càrrega mixta de lectures i escriptures sobre totes les rutes de main.py.
+#
+#   docker compose -f bench/docker-compose.yaml up -d
+#   DB_HOST=127.0.0.1 python API/db.py
+#   DB_HOST=127.0.0.1 python bench/bench_rutes.py --sortida resultats.json
+#   python bench/comparar.py base.json resultats.json --llindar 10
+#
+# Arrenca un uvicorn amb SERVER_TIMING=1 (d'on es llegeixen les consultes per petició),
+# sembra dades sintètiques fins a l'escala demanada si no hi són, i llança la càrrega
+# amb els pesos de PESOS. Mostra i desa per operació peticions/s, p50/p95/p99 i consultes.
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+
+import httpx
+
+from bench_cerca import PARAULES, titol_aleatori
+from bench_db_mode import DIR_API, esperar_servidor, percentil
+
+# Pes relatiu de cada operació: ~85 % lectures, ~15 % escriptures
+PESOS = {
+    "obtenir_titol": 20,
+    "llistar_titols": 8,
+    "titols_per_valoracio": 3,
+    "titols_per_plataforma": 2,
+    "cercar_titols": 6,
+    "facetes": 2,
+    "titols_semblants": 3,
+    "recomanacions": 4,
+    "comentaris_titol": 4,
+    "comentari_usuari": 2,
+    "obtenir_llista": 5,
+    "obtenir_llista_expandida": 2,
+    "llistar_llistes": 3,
+    "llistes_publiques": 3,
+    "llistes_usuari": 3,
+    "titols_llista": 6,
+    "obtenir_usuari": 4,
+    "llistar_usuaris": 2,
+    "estat_pool": 0.1,
+    "estat_cache": 0.1,
+    "valorar": 4,
+    "actualitzar_rating": 3,
+    "modificar_comentari": 1,
+    "eliminar_comentari": 0.5,
+    "afegir_a_llista": 2,
+    "treure_de_llista": 1,
+    "afegir_lot_a_llista": 0.3,
+    "treure_lot_de_llista": 0.3,
+    "crear_titol": 1,
+    "importar_lot": 0.1,
+    "eliminar_titol": 0.2,
+    "crear_llista": 0.5,
+    "actualitzar_llista": 0.5,
+    "eliminar_llista": 0.2,
+    "crear_usuari": 0.3,
+    "actualitzar_usuari": 0.5,
+    "eliminar_usuari": 0.2,
+}
+
+CONSULTES = re.compile(r'bd;[^,]*desc="(\d+) consultes"')
+
+
+class Dades:
+    # Ids sembrats que fa servir la càrrega; les eliminacions només toquen el que creen elles
+    def __init__(self, usuaris, titols, llistes):
+        self.usuaris, self.titols, self.llistes = usuaris, titols, llistes
+
+
+async def llegir_ids(client, ruta):
+    ids, cursor = [], None
+    while True:
+        params = {"limit": 1000, **({"after": cursor} if cursor else {})}
+        resposta = await client.get(ruta, params=params)
+        resposta.raise_for_status()
+        ids += [fila["id"] for fila in resposta.json()]
+        cursor = resposta.headers.get("x-next-cursor")
+        if not cursor:
+            return ids
+
+
+def usuari_aleatori(generador):
+    numero = generador.randrange(10 ** 12)
+    return {"nom": f"Usuari {numero}", "edat": generador.randint(12, 80),
+            "correu": f"usuari{numero}@exemple.cat", "contrasenya": "contrasenya"}
+
+
+async def en_paral_lel(corrutines, concurrencia=32):
+    semafor = asyncio.Semaphore(concurrencia)
+
+    async def amb_semafor(corrutina):
+        async with semafor:
+            return await corrutina
+
+    return await asyncio.gather(*(amb_semafor(c) for c in corrutines))
+
+
+async def sembrar(client, args, generador):
+    usuaris = await llegir_ids(client, "/usuaris/")
+    if len(usuaris) < args.usuaris:
+        noves = await en_paral_lel(client.post("/usuaris/", json=usuari_aleatori(generador))
+                                   for _ in range(args.usuaris - len(usuaris)))
+        usuaris += [resposta.json()["id"] for resposta in noves if resposta.status_code == 200]
+
+    titols = await llegir_ids(client, "/titols/")
+    pendents = args.titols - len(titols)
+    while pendents > 0:
+        mida = min(5000, pendents)
+        cos = "\n".join(json.dumps(titol_aleatori(generador)) for _ in range(mida))
+        resposta = await client.post("/titols/lot", content=cos.encode(),
+                                     headers={"content-type": "application/x-ndjson"})
+        resposta.raise_for_status()
+        pendents -= mida
+    titols = await llegir_ids(client, "/titols/")
+
+    llistes = await llegir_ids(client, "/llistes/")
+    if len(llistes) < args.llistes:
+        noves = await en_paral_lel(client.post("/llistes/", json={
+            "titol": " ".join(generador.sample(PARAULES, 2)).capitalize(),
+            "descripcio": "Llista de prova",
+            "privada": generador.random() < 0.3,
+            "usuari_id": generador.choice(usuaris),
+        }) for _ in range(args.llistes - len(llistes)))
+        noves = [resposta.json()["id"] for resposta in noves if resposta.status_code == 200]
+        await en_paral_lel(client.post(f"/llistes/{llista_id}/titols/lot", json={
+            "titols": generador.sample(titols, min(len(titols), args.titols_per_llista)),
+        }) for llista_id in noves)
+        llistes += noves
+
+    # Les valoracions no es poden comptar per l'API; se'n sembren només si la base és nova
+    if args.valoracions and not (await client.get(f"/titols/{titols[0]}")).json().get("valoracions"):
+        await en_paral_lel(client.post(
+            f"/usuaris/{generador.choice(usuaris)}/titols/{generador.choice(titols)}/comentarios/",
+            json={"comentario": "Comentari de prova", "rating": generador.choice([0.5, 1, 1.5, 2, 2.5, 3, 3.5, 4])},
+        ) for _ in range(args.valoracions))
+    return Dades(usuaris, titols, llistes)
+
+
+def operacions(dades, generador):
+    # Cada operació retorna (mètode, ruta, kwargs d'httpx) amb ids de les dades sembrades
+    u = lambda: generador.choice(dades.usuaris)
+    t = lambda: generador.choice(dades.titols)
+    ll = lambda: generador.choice(dades.llistes)
+    return {
+        "obtenir_titol": lambda: ("GET", f"/titols/{t()}", {}),
+        "llistar_titols": lambda: ("GET", "/titols/", {"params": {"limit": 50}}),
+        "titols_per_valoracio": lambda: ("GET", "/titols/", {"params": {"limit": 50, "ordre": "valoracio"}}),
+        "titols_per_plataforma": lambda: ("GET", "/titols/", {"params": {"limit": 50, "plataforma": "Netflix"}}),
+        "cercar_titols": lambda: ("GET", "/titols/cerca", {"params": {"q": generador.choice(PARAULES)[:4]}}),
+        "facetes": lambda: ("GET", "/titols/facetes", {}),
+        "titols_semblants": lambda: ("GET", f"/titols/{t()}/semblants", {}),
+        "recomanacions": lambda: ("GET", f"/usuaris/{u()}/recomanacions", {}),
+        "comentaris_titol": lambda: ("GET", f"/titols/{t()}/comentarios/", {}),
+        "comentari_usuari": lambda: ("GET", f"/usuaris/{u()}/titols/{t()}/comentarios/", {}),
+        "obtenir_llista": lambda: ("GET", f"/llistes/{ll()}", {}),
+        "obtenir_llista_expandida": lambda: ("GET", f"/llistes/{ll()}", {"params": {"expand": "titols", "include": "usuaris"}}),
+        "llistar_llistes": lambda: ("GET", "/llistes/", {"params": {"limit": 50}}),
+        "llistes_publiques": lambda: ("GET", "/llistes/publicas/", {}),
+        "llistes_usuari": lambda: ("GET", f"/usuaris/{u()}/llistes", {}),
+        "titols_llista": lambda: ("GET", f"/llistes/{ll()}/titols", {}),
+        "obtenir_usuari": lambda: ("GET", f"/usuaris/{u()}", {}),
+        "llistar_usuaris": lambda: ("GET", "/usuaris/", {"params": {"limit": 50}}),
+        "estat_pool": lambda: ("GET", "/estat/pool", {}),
+        "estat_cache": lambda: ("GET", "/estat/cache", {}),
+        "valorar": lambda: ("POST", f"/usuaris/{u()}/titols/{t()}/comentarios/",
+                            {"json": {"comentario": "Comentari", "rating": generador.randint(0, 8) / 2}}),
+        "actualitzar_rating": lambda: ("PUT", f"/usuaris/{u()}/titols/{t()}/rating/",
+                                       {"json": {"rating": generador.randint(0, 8) / 2}}),
+        "modificar_comentari": lambda: ("PUT", f"/usuaris/{u()}/titols/{t()}/comentarios/",
+                                        {"json": {"comentario": "Comentari editat"}}),
+        "eliminar_comentari": lambda: ("DELETE", f"/usuaris/{u()}/titols/{t()}/comentarios/", {}),
+        "afegir_a_llista": lambda: ("POST", f"/llistes/{ll()}/titols/{t()}", {}),
+        "treure_de_llista": lambda: ("DELETE", f"/llistes/{ll()}/titols/{t()}", {}),
+        "afegir_lot_a_llista": lambda: ("POST", f"/llistes/{ll()}/titols/lot",
+                                        {"json": {"titols": generador.sample(dades.titols, min(20, len(dades.titols)))}}),
+        "treure_lot_de_llista": lambda: ("DELETE", f"/llistes/{ll()}/titols/lot",
+                                         {"json": {"titols": generador.sample(dades.titols, min(20, len(dades.titols)))}}),
+        "crear_titol": lambda: ("POST", "/titols/", {"json": titol_aleatori(generador)}),
+        "importar_lot": lambda: ("POST", "/titols/lot", {"json": [titol_aleatori(generador) for _ in range(100)]}),
+        "crear_llista": lambda: ("POST", "/llistes/", {"json": {"titol": "Llista nova", "privada": False, "usuari_id": u()}}),
+        "actualitzar_llista": lambda: ("PUT", f"/llistes/{ll()}", {"json": {"descripcio": "Descripció nova"}}),
+        "crear_usuari": lambda: ("POST", "/usuaris/", {"json": usuari_aleatori(generador)}),
+        "actualitzar_usuari": lambda: ("PUT", f"/usuaris/{u()}", {"json": {"edat": generador.randint(12, 80)}}),
+        # Les eliminacions treuen ids que ha creat la mateixa càrrega, no les dades sembrades
+        "eliminar_titol": lambda: ("DELETE", "/titols/{creat}", {"crear": "crear_titol"}),
+        "eliminar_llista": lambda: ("DELETE", "/llistes/{creat}", {"crear": "crear_llista"}),
+        "eliminar_usuari": lambda: ("DELETE", "/usuaris/{creat}", {"crear": "crear_usuari"}),
+    }
+
+
+async def carrega(url, duracio, concurrencia, dades, llavor):
+    mostres = {nom: [] for nom in PESOS}
+    consultes = {nom: [] for nom in PESOS}
+    errors = {nom: 0 for nom in PESOS}
+    final = time.monotonic() + duracio
+    noms, pesos = list(PESOS), list(PESOS.values())
+
+    async def treballador(client, generador):
+        ops = operacions(dades, generador)
+        while time.monotonic() < final:
+            nom = generador.choices(noms, pesos)[0]
+            metode, ruta, opcions = ops[nom]()
+            creacio = opcions.pop("crear", None)
+            if creacio:
+                # Crea l'element i n'esborra l'id; només es mesura l'esborrat
+                metode_crear, ruta_crear, opcions_crear = ops[creacio]()
+                creat = await client.request(metode_crear, ruta_crear, **opcions_crear)
+                if creat.status_code != 200:
+                    continue
+                ruta = ruta.format(creat=creat.json()["id"])
+            inici = time.perf_counter()
+            resposta = await client.request(metode, ruta, **opcions)
+            mostres[nom].append(time.perf_counter() - inici)
+            trobat = CONSULTES.search(resposta.headers.get("server-timing", ""))
+            if trobat:
+                consultes[nom].append(int(trobat.group(1)))
+            if resposta.status_code >= 500:
+                errors[nom] += 1
+
+    limits = httpx.Limits(max_connections=concurrencia)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        await asyncio.gather(*(treballador(client, random.Random(llavor + i)) for i in range(concurrencia)))
+    return mostres, consultes, errors
+
+
+def resum(latencies, consultes, errors, duracio):
+    return {
+        "peticions": len(latencies),
+        "errors": errors,
+        "peticions_s": round(len(latencies) / duracio, 1),
+        "p50_ms": round(percentil(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentil(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentil(latencies, 99) * 1000, 2),
+        "consultes_peticio": round(sum(consultes) / len(consultes), 2) if consultes else None,
+    }
+
+
+async def rutes_no_cobertes(client):
+    # Rutes de l'OpenAPI que cap operació de PESOS no toca
+    cobertes = set()
+    plantilles = (await client.get("/openapi.json")).json()["paths"]
+    generador = random.Random(0)
+    ops = operacions(Dades([1], [1], [1]), generador)
+    for nom in PESOS:
+        metode, ruta, _ = ops[nom]()
+        for plantilla in plantilles:
+            patro = "^" + re.sub(r"\\{[^}]+\\}", r"[^/]+", re.escape(plantilla)) + "$"
+            if re.match(patro, ruta.replace("{creat}", "1")):
+                cobertes.add((metode, plantilla))
+    return sorted(
+        f"{metode.upper()} {plantilla}"
+        for plantilla, metodes in plantilles.items() for metode in metodes
+        if (metode.upper(), plantilla) not in cobertes
+    )
+
+
+def commit_actual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=DIR_API).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def principal():
+    parser = argparse.ArgumentParser(description="Benchmark de càrrega mixta de totes les rutes")
+    parser.add_argument("--usuaris", type=int, default=1000)
+    parser.add_argument("--titols", type=int, default=20000)
+    parser.add_argument("--llistes", type=int, default=2000)
+    parser.add_argument("--titols-per-llista", type=int, default=20)
+    parser.add_argument("--valoracions", type=int, default=20000)
+    parser.add_argument("--duracio", type=float, default=60)
+    parser.add_argument("--escalfament", type=float, default=5)
+    parser.add_argument("--concurrencia", type=int, default=32)
+    parser.add_argument("--llavor", type=int, default=15)
+    parser.add_argument("--port", type=int, default=8802)
+    parser.add_argument("--sense-recomanacions", action="store_true",
+                        help="No calcula veïns ni recomanacions després de sembrar")
+    parser.add_argument("--sortida", help="Fitxer JSON on desar els resultats")
+    args = parser.parse_args()
+
+    url = f"http://127.0.0.1:{args.port}"
+    servidor = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+        cwd=DIR_API, env=dict(os.environ, SERVER_TIMING="1"),
+    )
+    try:
+        await esperar_servidor(url)
+        async with httpx.AsyncClient(base_url=url, timeout=600) as client:
+            dades = await sembrar(client, args, random.Random(args.llavor))
+            for ruta in await rutes_no_cobertes(client):
+                print(f"Ruta sense càrrega: {ruta}", file=sys.stderr)
+        if not args.sense_recomanacions:
+            subprocess.run([sys.executable, "recomanacions.py", "calcular"], cwd=DIR_API, check=True)
+        await carrega(url, args.escalfament, args.concurrencia, dades, args.llavor)
+        mostres, consultes, errors = await carrega(url, args.duracio, args.concurrencia, dades, args.llavor)
+    finally:
+        servidor.terminate()
+        servidor.wait()
+
+    totes = [latencia for latencies in mostres.values() for latencia in latencies]
+    resultat = {
+        "meta": {
+            "commit": commit_actual(),
+            "data": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "db_mode": os.getenv("DB_MODE", "async"),
+            **{clau: valor for clau, valor in vars(args).items() if clau != "sortida"},
+        },
+        "total": resum(totes, [c for llista in consultes.values() for c in llista],
+                       sum(errors.values()), args.duracio),
+        "operacions": {nom: resum(mostres[nom], consultes[nom], errors[nom], args.duracio) for nom in PESOS},
+    }
+    print(f"{'operació':<26}{'pet/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'consultes':>11}{'errors':>8}")
+    for nom, fila in [*resultat["operacions"].items(), ("TOTAL", resultat["total"])]:
+        print(f"{nom:<26}{fila['peticions_s']:>9}{fila['p50_ms']:>9}{fila['p95_ms']:>9}{fila['p99_ms']:>9}"
+              f"{fila['consultes_peticio'] if fila['consultes_peticio'] is not None else '-':>11}{fila['errors']:>8}")
+    if args.sortida:
+        with open(args.sortida, "w") as fitxer:
+            json.dump(resultat, fitxer, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    asyncio.run(principal())
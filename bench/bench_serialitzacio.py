@@ -0,0 +1,125 @@
+# Rendiment de la serialització de llistes de títols, sense base de dades.
+#
+#   python bench/bench_serialitzacio.py --files 100 1000 --duracio 5
+#
+# Munta una app FastAPI amb les mateixes files servides de tres maneres: amb
+# response_model=List[Titol] (validació de Pydantic i jsonable_encoder, com abans), amb
+# resposta_json() (serialitzacio.py) i amb resposta_json() en mode VALIDAR_RESPOSTES.
+# Les peticions passen per ASGI en procés (httpx.ASGITransport), així el que es mesura és
+# només la feina de la ruta i de la serialització. També es mesura la serialització sola
+# (files -> bytes), que és la part que canvia entre els dos camins.
+import argparse
+import asyncio
+import decimal
+import json
+import random
+import sys
+import time
+import timeit
+from typing import List
+
+import httpx
+from fastapi import FastAPI
+from fastapi.encoders import jsonable_encoder
+
+from bench_db_mode import DIR_API
+
+sys.path.insert(0, DIR_API)
+
+import serialitzacio  # noqa: E402
+from models import Titol  # noqa: E402
+from serialitzacio import resposta_json  # noqa: E402
+
+PLATAFORMES = ["Netflix", "HBO", "Disney+", "Prime Video", "Filmin"]
+
+
+def fila_titol(generador, titol_id):
+    # Com arriba de la base de dades: mitjana DECIMAL i histograma en text (CONCAT_WS)
+    histograma = [generador.randint(0, 50) for _ in range(9)]
+    return {
+        "id": titol_id,
+        "imatge": None,
+        "nom": f"Títol {titol_id}",
+        "descripcio": "Una descripció prou llarga per semblar-se a les reals " * 3,
+        "plataformes": ", ".join(generador.sample(PLATAFORMES, 2)),
+        "rating": generador.choice([1.0, 2.5, 3.0, 4.5]),
+        "comentaris": None,
+        "genero": "Drama",
+        "edadRecomendada": generador.choice([None, 7, 12, 16, 18]),
+        "valoracions": sum(histograma),
+        "valoracio_mitjana": decimal.Decimal(f"{generador.uniform(0, 4):.4f}"),
+        "histograma_valoracions": ",".join(map(str, histograma)),
+    }
+
+
+def crear_app(files):
+    app = FastAPI()
+
+    @app.get("/model", response_model=List[Titol])
+    async def amb_model():
+        return files
+
+    @app.get("/directe", response_model=List[Titol])
+    async def directe():
+        return resposta_json(files, Titol)
+
+    return app
+
+
+async def mesurar(client, ruta, duracio):
+    peticions = 0
+    inici = time.perf_counter()
+    while time.perf_counter() - inici < duracio:
+        resposta = await client.get(ruta)
+        resposta.raise_for_status()
+        peticions += 1
+    return peticions / (time.perf_counter() - inici), len(resposta.content)
+
+
+def temps_serialitzacio(files, repeticions=10):
+    # Mil·lisegons per resposta, sense HTTP: el que fa FastAPI amb response_model i el camí nou
+    model = timeit.timeit(lambda: json.dumps(jsonable_encoder([Titol(**fila) for fila in files])),
+                          number=repeticions) / repeticions
+    directe = timeit.timeit(lambda: resposta_json(files, Titol).body, number=repeticions) / repeticions
+    return model * 1000, directe * 1000
+
+
+async def executar(arguments):
+    resultats = []
+    for mida in arguments.files:
+        generador = random.Random(mida)
+        files = [fila_titol(generador, titol_id) for titol_id in range(1, mida + 1)]
+        transport = httpx.ASGITransport(app=crear_app(files))
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            model = (await client.get("/model")).json()
+            assert (await client.get("/directe")).json() == model, "les dues sortides no coincideixen"
+            for nom, ruta, validar in (("response_model", "/model", False),
+                                       ("resposta_json", "/directe", False),
+                                       ("resposta_json+validar", "/directe", True)):
+                serialitzacio.VALIDAR_RESPOSTES = validar
+                per_segon, mida_cos = await mesurar(client, ruta, arguments.duracio)
+                resultats.append({"files": mida, "cami": nom, "peticions_s": round(per_segon, 1), "bytes": mida_cos})
+                print(f"{mida:>6} files  {nom:<22} {per_segon:>9.1f} pet/s  {mida_cos} bytes")
+        serialitzacio.VALIDAR_RESPOSTES = False
+        model_ms, directe_ms = temps_serialitzacio(files)
+        resultats.append({"files": mida, "serialitzacio_ms": {"response_model": round(model_ms, 3),
+                                                              "resposta_json": round(directe_ms, 3)}})
+        print(f"{mida:>6} files  serialització {model_ms:.2f} ms -> {directe_ms:.2f} ms (x{model_ms / directe_ms:.1f})")
+        base = next(r["peticions_s"] for r in resultats if r["files"] == mida and r.get("cami") == "response_model")
+        rapid = next(r["peticions_s"] for r in resultats if r["files"] == mida and r.get("cami") == "resposta_json")
+        print(f"{mida:>6} files  guany x{rapid / base:.2f}")
+    if arguments.sortida:
+        with open(arguments.sortida, "w") as fitxer:
+            json.dump({"orjson": serialitzacio.orjson is not None, "resultats": resultats}, fitxer, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara response_model amb resposta_json()")
+    parser.add_argument("--files", type=int, nargs="+", default=[20, 100, 1000])
+    parser.add_argument("--duracio", type=float, default=5.0, help="segons per cada camí i mida")
+    parser.add_argument("--sortida", help="fitxer JSON amb els resultats")
+    asyncio.run(executar(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
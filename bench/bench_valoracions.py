@@ -0,0 +1,140 @@
+# Escriptura directa dels ratings contra el buffer d'escriptura diferida (valoracions_diferides.py).
+#
+#   docker compose -f bench/docker-compose.yaml up -d
+#   DB_HOST=127.0.0.1 python API/migracions.py
+#   DB_HOST=127.0.0.1 python bench/bench_valoracions.py --usuaris 500 --titols 20 --duracio 20
+#
+# Simula un esdeveniment en directe: molts usuaris tornen a valorar els mateixos pocs títols en
+# pocs segons (PUT /usuaris/{u}/titols/{t}/rating/). Arrenca un uvicorn amb cada mode i el mateix
+# pool petit (--pool), i mostra peticions/s, latències, errors i, en mode diferit, les mètriques
+# de mida de lot i retard d'escriptura.
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench_db_mode import DIR_API, esperar_servidor, percentil
+
+RATINGS = [0, 0.5, 1, 1.5, 2, 2.5, 3, 3.5, 4]
+
+
+async def sembrar(url, usuaris, titols):
+    # Cada usuari comenta tots els títols perquè les files d'usuari_titol existeixin
+    async with httpx.AsyncClient(base_url=url, timeout=60) as client:
+        titol_ids = []
+        for i in range(titols):
+            resposta = await client.post("/titols/", json={"nom": f"Directe {i}", "plataformes": "Netflix", "rating": 3})
+            titol_ids.append(resposta.json()["id"])
+        usuari_ids = []
+        for i in range(usuaris):
+            resposta = await client.post("/usuaris/", json={
+                "nom": f"Espectador {i}", "edat": 30, "correu": f"espectador{i}-{time.time_ns()}@popview.cat",
+                "contrasenya": "secret"})
+            usuari_ids.append(resposta.json()["id"])
+            for titol_id in titol_ids:
+                await client.post(f"/usuaris/{usuari_ids[-1]}/titols/{titol_id}/comentarios/",
+                                  json={"comentario": "En directe", "rating": 2})
+    return usuari_ids, titol_ids
+
+
+async def carrega(url, duracio, concurrencia, usuari_ids, titol_ids):
+    latencies = []
+    errors = 0
+    final = time.monotonic() + duracio
+
+    async def treballador(client):
+        nonlocal errors
+        while time.monotonic() < final:
+            ruta = f"/usuaris/{random.choice(usuari_ids)}/titols/{random.choice(titol_ids)}/rating/"
+            inici = time.perf_counter()
+            resposta = await client.put(ruta, json={"rating": random.choice(RATINGS)})
+            latencies.append(time.perf_counter() - inici)
+            if resposta.status_code >= 400:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrencia)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        await asyncio.gather(*(treballador(client) for _ in range(concurrencia)))
+    return latencies, errors
+
+
+async def metriques_buffer(url):
+    async with httpx.AsyncClient(base_url=url) as client:
+        text = (await client.get("/metrics")).text
+    valors = {}
+    for linia in text.splitlines():
+        for nom in ("popview_valoracions_lot_mida_sum", "popview_valoracions_lot_mida_count",
+                    "popview_valoracions_retard_segons_sum", "popview_valoracions_retard_segons_count"):
+            if linia.startswith(nom + " "):
+                valors[nom] = float(linia.split()[1])
+    lots = valors.get("popview_valoracions_lot_mida_count", 0)
+    if not lots:
+        return {}
+    return {
+        "lots": int(lots),
+        "mida_mitjana_lot": round(valors["popview_valoracions_lot_mida_sum"] / lots, 1),
+        "retard_mitja_ms": round(valors["popview_valoracions_retard_segons_sum"] / lots * 1000, 1),
+    }
+
+
+async def mesurar(diferit, args, dades):
+    url = f"http://127.0.0.1:{args.port}"
+    entorn = dict(os.environ, DB_POOL_SIZE=str(args.pool), DB_POOL_MAX_OVERFLOW="0",
+                  VALORACIONS_DIFERIDES="1" if diferit else "0", VALORACIONS_DIR=tempfile.mkdtemp())
+    servidor = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+        cwd=DIR_API, env=entorn,
+    )
+    try:
+        await esperar_servidor(url)
+        if dades is None:
+            dades = await sembrar(url, args.usuaris, args.titols)
+        latencies, errors = await carrega(url, args.duracio, args.concurrencia, *dades)
+        buffer = await metriques_buffer(url) if diferit else {}
+    finally:
+        servidor.terminate()
+        servidor.wait()
+    return dades, {
+        "mode": "diferit" if diferit else "directe",
+        "peticions_s": round(len(latencies) / args.duracio, 1),
+        "p50_ms": round(percentil(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentil(latencies, 99) * 1000, 2),
+        "errors": errors,
+        **buffer,
+    }
+
+
+async def principal():
+    parser = argparse.ArgumentParser(description="Ratings amb escriptura directa o diferida")
+    parser.add_argument("--usuaris", type=int, default=500)
+    parser.add_argument("--titols", type=int, default=20)
+    parser.add_argument("--duracio", type=float, default=20)
+    parser.add_argument("--concurrencia", type=int, default=128)
+    parser.add_argument("--pool", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--sortida", help="Fitxer JSON on desar els resultats")
+    args = parser.parse_args()
+
+    dades = None
+    resultats = []
+    for diferit in (False, True):
+        dades, resultat = await mesurar(diferit, args, dades)
+        resultats.append(resultat)
+        print(f"{resultat['mode']:>8}: {resultat['peticions_s']:>9} pet/s  p50 {resultat['p50_ms']:>8} ms  "
+              f"p99 {resultat['p99_ms']:>8} ms  errors {resultat['errors']}"
+              + (f"  lots {resultat['lots']} de {resultat['mida_mitjana_lot']} claus, "
+                 f"retard {resultat['retard_mitja_ms']} ms" if resultat.get("lots") else ""))
+    if args.sortida:
+        with open(args.sortida, "w") as fitxer:
+            json.dump(resultats, fitxer, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(principal())
@@ -0,0 +1,58 @@
+# Compara dos resultats de bench_rutes.py i surt amb codi 1 si hi ha regressions.
+#
+#   python bench/comparar.py base.json nou.json --llindar 10
+#
+# Una operació fa regressió si el p95 empitjora més del llindar (%), si el throughput
+# baixa més del llindar, o si fa més consultes per petició. Les operacions amb poques
+# mostres només es mostren: el seu p95 és massa sorollós per decidir res.
+import argparse
+import json
+import sys
+
+
+def comparar(base, nou, llindar, minim_mostres):
+    regressions = []
+    files = [("TOTAL", base["total"], nou["total"])]
+    files += [(nom, base["operacions"][nom], dades)
+              for nom, dades in nou["operacions"].items() if nom in base["operacions"]]
+    print(f"{'operació':<26}{'p95 base':>10}{'p95 nou':>10}{'Δ %':>8}{'pet/s base':>12}{'pet/s nou':>11}"
+          f"{'consultes':>12}")
+    for nom, abans, ara in files:
+        delta_p95 = 100 * (ara["p95_ms"] - abans["p95_ms"]) / abans["p95_ms"] if abans["p95_ms"] else 0.0
+        consultes = f"{abans['consultes_peticio']}→{ara['consultes_peticio']}"
+        print(f"{nom:<26}{abans['p95_ms']:>10}{ara['p95_ms']:>10}{delta_p95:>8.1f}"
+              f"{abans['peticions_s']:>12}{ara['peticions_s']:>11}{consultes:>12}")
+        if min(abans["peticions"], ara["peticions"]) < minim_mostres:
+            continue
+        if delta_p95 > llindar:
+            regressions.append(f"{nom}: p95 {abans['p95_ms']} → {ara['p95_ms']} ms (+{delta_p95:.1f} %)")
+        if abans["peticions_s"] and 100 * (abans["peticions_s"] - ara["peticions_s"]) / abans["peticions_s"] > llindar:
+            regressions.append(f"{nom}: {abans['peticions_s']} → {ara['peticions_s']} pet/s")
+        # Les consultes per petició gairebé no depenen del soroll: un augment és un canvi de codi
+        if abans["consultes_peticio"] is not None and ara["consultes_peticio"] is not None \
+                and ara["consultes_peticio"] > abans["consultes_peticio"] + 0.5:
+            regressions.append(f"{nom}: {abans['consultes_peticio']} → {ara['consultes_peticio']} consultes per petició")
+        if ara["errors"] > abans["errors"]:
+            regressions.append(f"{nom}: {abans['errors']} → {ara['errors']} errors")
+    return regressions
+
+
+def principal():
+    parser = argparse.ArgumentParser(description="Compara dos resultats de bench_rutes.py")
+    parser.add_argument("base")
+    parser.add_argument("nou")
+    parser.add_argument("--llindar", type=float, default=10, help="Empitjorament màxim acceptat, en %%")
+    parser.add_argument("--minim-mostres", type=int, default=200)
+    args = parser.parse_args()
+    with open(args.base) as fitxer:
+        base = json.load(fitxer)
+    with open(args.nou) as fitxer:
+        nou = json.load(fitxer)
+    regressions = comparar(base, nou, args.llindar, args.minim_mostres)
+    for regressio in regressions:
+        print(f"REGRESSIÓ {regressio}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(principal())
@@ -0,0 +1,2 @@
+-- L'API consulta Seconds_Behind_Master (SHOW SLAVE STATUS) per treure les rèpliques endarrerides
+GRANT SLAVE MONITOR ON *.* TO 'popview'@'%';